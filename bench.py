@@ -0,0 +1,490 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import tcup
+from utils import cksum, encode, decode, HEADER, MAX_HEADER_SIZE, RTTSampler, TCPReceiverBuffer
+
+
+#################
+# configuration #
+#################
+
+parser = argparse.ArgumentParser(description='TCP benchmarks',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-n', '--number',       default=1 << 24,        type=int, help='bytes per measurement')
+parser.add_argument('-m', '--mss',          default=1452,           type=int, help='payload bytes per segment')
+parser.add_argument('-w', '--window-size',  default=65535,          type=int, help='recv window size')
+parser.add_argument('-r', '--reorder',      default=[0., .1, .5, 1.], type=float, nargs='+', help='reorder rates')
+parser.add_argument('-c', '--clients',      default=[1, 2, 4, 8],   type=int, nargs='+', help='concurrent clients')
+parser.add_argument('-k', '--stripes',      default=[1, 2, 4, 8],   type=int, nargs='+', help='stripes of a transfer')
+parser.add_argument('-j', '--workers',      default=[1],            type=int, nargs='+', help='server workers')
+parser.add_argument('-C', '--cc',           default=['none', 'reno', 'cubic', 'vegas'], nargs='+',
+                    help='congestion controls')
+parser.add_argument('-l', '--loss',         default=[0., .01, .05], type=float, nargs='+', help='loss rates')
+parser.add_argument('-x', '--corrupt',      default=[.01, .05],     type=float, nargs='+', help='corruption rates')
+parser.add_argument('-O', '--reorder-rate', default=[.01, .1],      type=float, nargs='+',
+                    help='rates of datagrams reordered by proxy')
+parser.add_argument('-u', '--duplicate',    default=[.01, .1],      type=float, nargs='+', help='duplication rates')
+parser.add_argument('-J', '--jitter',       default=[.005, .02],    type=float, nargs='+', help='jitters in seconds')
+parser.add_argument('-R', '--rate',         default=[1e6, 1e7],     type=float, nargs='+',
+                    help='bandwidth caps in bytes per second')
+parser.add_argument('-d', '--delay',        default=.01,            type=float, help='one-way delay in seconds')
+parser.add_argument('-D', '--ack-delay',    default=[0., .04],      type=float, nargs='+',
+                    help='ACK delays of server')
+parser.add_argument('-f', '--file-size',    default=1 << 22,        type=int, help='bytes per transfer')
+parser.add_argument('-b', '--bench',        default=['cksum', 'codec', 'buffer', 'concurrency', 'cc', 'mss', 'gso', 'ack',
+                                                     'stripes', 'engine', 'rtt', 'impair'],
+                    nargs='+',
+                    help='benchmarks to run')
+parser.add_argument('-U', '--uvloop',       action='store_true',    help='run asyncio engine under uvloop')
+parser.add_argument('-s', '--sizes',        default=[84, 1472, 65507], type=int, nargs='+', help='buffer sizes')
+parser.add_argument('-o', '--output',       default=None,           type=str, help='JSON file to record results in, '
+                    'for regression tracking')
+
+
+##############
+# references #
+##############
+
+def cksum_loop(buf: bytes) -> int:
+    """ 1s complement of the sum of all the 16-bit words, one word at a time """
+    if len(buf) % 2:
+        buf += b'\x00'
+    s = 0
+    for i in range(0, len(buf), 2):
+        s += (ord(buf[i:i+1]) << 8) + ord(buf[i+1:i+2])
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    return ~s & 0xffff
+
+
+##############
+# benchmarks #
+##############
+
+results: list = list()  # of every measurement, as recorded to JSON
+
+
+def record(bench: str, **fields):
+    results.append({'bench': bench, **fields})
+
+
+def throughput(fn, buf: bytes, number: int) -> float:
+    """ MB/s of fn over buf, repeated until number bytes are processed """
+    k = max(1, number // len(buf))
+    t = timeit.timeit(lambda: fn(buf), number=k)
+    return len(buf) * k / t / 1e6
+
+
+def bench_cksum(sizes: list, number: int):
+    print(f"{'size':>8} {'loop MB/s':>12} {'cksum MB/s':>12} {'speedup':>8}")
+    for size in sizes:
+        buf = os.urandom(size)
+        assert cksum(buf) == cksum_loop(buf)
+        old = throughput(cksum_loop, buf, number // 64)  # too slow for full run
+        new = throughput(cksum, buf, number)
+        print(f"{size:>8} {old:>12.1f} {new:>12.1f} {new / old:>7.1f}x")
+        record('cksum', size=size, loop=old, cksum=new)
+
+
+def peak_alloc(fn, *args) -> int:
+    """ peak bytes allocated by a call, freed or not """
+    fn(*args)  # warm up caches
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - base
+
+
+def bench_codec(mss: int, number: int):
+    payload = os.urandom(mss)
+    obuf = bytearray(HEADER.size + mss)
+    segment = encode(payload, src_port=1, dst_port=2, seq_no=3)
+
+    def encode_one():
+        encode(payload, src_port=1, dst_port=2, seq_no=3, buf=obuf)
+
+    def decode_one():
+        decode(segment)
+
+    k = max(1, number // mss)
+    for name, fn in [('encode', encode_one), ('decode', decode_one)]:
+        t = timeit.timeit(fn, number=k) / k
+        alloc = peak_alloc(fn)
+        print(f"{name} of {mss}-byte payload: {t * 1e6:.2f} us/segment, "
+              f"{alloc} bytes allocated/segment")
+        record(name, mss=mss, us=t * 1e6, alloc=alloc)
+
+
+def reordered(number: int, mss: int, window_size: int, rate: float) -> list:
+    """ seq_nos of a stream, a fraction rate of them shuffled within a window """
+    seq_nos = list(range(0, number, mss))
+    k = max(1, window_size // mss)
+    for i in range(0, len(seq_nos), k):
+        block = seq_nos[i:i+k]
+        picks = [j for j in range(len(block)) if random.random() < rate]
+        moved = [block[j] for j in picks]
+        random.shuffle(moved)
+        for j, seq_no in zip(picks, moved):
+            block[j] = seq_no
+        seq_nos[i:i+k] = block
+    return seq_nos
+
+
+def bench_buffer(mss: int, window_size: int, rates: list, number: int):
+    payload = bytes(mss)
+    for rate in rates:
+        seq_nos = reordered(number, mss, window_size, rate)
+        buf = TCPReceiverBuffer(buffer_size=window_size)
+        recv_base = 0
+        t = time.perf_counter()
+        for seq_no in seq_nos:
+            if seq_no > recv_base:
+                buf.push(seq_no, payload)
+            elif seq_no == recv_base:
+                recv_base += len(payload)
+                recv_base += len(buf.pop(recv_base))
+        t = time.perf_counter() - t
+        assert recv_base >= number
+        print(f"reassembly of {mss}-byte segments at {rate:.0%} reorder: "
+              f"{t / len(seq_nos) * 1e6:.2f} us/segment")
+        record('buffer', mss=mss, reorder=rate, us=t / len(seq_nos) * 1e6)
+
+
+def bench_rtt(mss: int, window_size: int, number: int):
+    """ RTTSampler per segment, one in flight per segment of a window """
+    rtt = RTTSampler()
+    k = max(1, window_size // mss)
+    n = max(k, number // mss)
+    t = time.perf_counter()
+    for i in range(n):
+        rtt.update((i + 1) * mss, i)
+        if i >= k:  # ACK of the segment a window before
+            rtt.sample(rtt.pop((i - k + 1) * mss, i))
+    rtt.percentile(.99)
+    t = time.perf_counter() - t
+    print(f"RTT sampling of {mss}-byte segments, {k} in flight: "
+          f"{t / n * 1e6:.2f} us/segment")
+    record('rtt', mss=mss, inflight=k, us=t / n * 1e6)
+
+
+def transfer(tmp: str, clients: int, size: int, server_args: list = [],
+             client_args: list = [], proxy_args: list = None,
+             timeout: float = 60.) -> tuple:
+    """
+    seconds to send size bytes from each of clients to one server,
+    through proxy if proxy_args is given, and the last line of each client,
+    then of server
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    src = os.path.join(tmp, 'send.bin')
+    with open(src, 'wb') as f:
+        f.write(os.urandom(size))
+    procs = list()
+    port = '41194'
+    if proxy_args is not None:
+        procs.append(subprocess.Popen(
+            [sys.executable, os.path.join(here, 'proxy.py'),
+             '-p', '41192', '-s', port] + proxy_args))
+        port = '41192'
+    log = open(os.path.join(tmp, 'recv.log'), 'w+')
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(here, 'server.py'),
+         '-f', os.path.join(tmp, 'recv-{n}.bin'),
+         '-c', str(clients)] + server_args,
+        stdout=log)
+    time.sleep(.5)  # wait for server and proxy to bind
+    t = time.perf_counter()
+    logs = [open(os.path.join(tmp, 'send-{}.log'.format(41200 + i)), 'w+')
+            for i in range(clients)]
+    clients = [subprocess.Popen(
+                [sys.executable, os.path.join(here, 'client.py'),
+                 '-f', src, '-p', str(41200 + i), '-s', port] + client_args,
+                stdout=log)
+               for i, log in enumerate(logs)]
+    try:
+        for proc in clients + [server]:
+            proc.wait(timeout=timeout)
+        t = time.perf_counter() - t
+    except subprocess.TimeoutExpired:
+        t = float('inf')
+    for proc in procs + clients + [server]:
+        proc.kill()
+        proc.wait()
+    lines = list()
+    for log in logs + [log]:
+        log.seek(0)
+        lines.append(([''] + log.read().splitlines())[-2])
+        log.close()
+    if t < float('inf'):
+        for i in range(len(clients)):
+            dst = os.path.join(tmp, 'recv-{}.bin'.format(i))
+            with open(src, 'rb') as f, open(dst, 'rb') as g:
+                assert f.read() == g.read(), dst
+    return t, lines
+
+
+def bench_concurrency(clients: list, workers: list, size: int, mss: int,
+                      window_size: int):
+    client_args = ['-b', str(mss), '-w', str(window_size)]
+    for j in workers:
+        server_args = ['-B', str(MAX_HEADER_SIZE + mss), '-w', str(window_size),
+                       '-R', str(max(clients) * window_size), '-j', str(j)]
+        for k in clients:
+            with tempfile.TemporaryDirectory() as tmp:
+                t, _ = transfer(tmp, k, size, server_args, client_args)
+            print(f"{k} concurrent clients of {size} bytes, {j} workers: "
+                  f"{t:.2f} s, aggregate goodput {k * size / t / 1e6:.2f} MB/s")
+            record('concurrency', clients=k, workers=j, size=size,
+                   completion=t, goodput=k * size / t / 1e6)
+
+
+def bench_cc(ccs: list, losses: list, delay: float, size: int, mss: int,
+             window_size: int):
+    server_args = ['-B', str(MAX_HEADER_SIZE + mss), '-w', str(window_size)]
+    for loss in losses:
+        for cc in ccs:
+            client_args = ['-b', str(mss), '-w', str(window_size), '-c', cc]
+            proxy_args = ['-l', str(loss), '-d', str(delay)]
+            with tempfile.TemporaryDirectory() as tmp:
+                t, lines = transfer(tmp, 1, size, server_args, client_args,
+                                    proxy_args)
+            sent, resent = map(int, re.findall(r'\d+', lines[0])[:2] or [1, 0])
+            print(f"{cc:>5} at {loss:.0%} loss, {delay * 1e3:.0f} ms delay: "
+                  f"goodput {size / t / 1e6:.2f} MB/s, "
+                  f"{resent / sent:.1%} re-sent")
+            record('cc', cc=cc, loss=loss, delay=delay, size=size,
+                   completion=t, goodput=size / t / 1e6, sent=sent,
+                   retransmits=resent)
+
+
+def bench_mss(sizes: list, size: int, window_size: int):
+    """ segment sizes fixed by buffer sizes, against probing up from the least """
+    mss = [n - MAX_HEADER_SIZE for n in sizes if n > MAX_HEADER_SIZE]
+    server_args = ['-B', str(MAX_HEADER_SIZE + max(mss)), '-w', str(window_size)]
+    for low, high in [(m, 0) for m in mss] + [(min(mss), max(mss))]:
+        client_args = ['-b', str(low), '-P', str(high), '-w', str(window_size)]
+        with tempfile.TemporaryDirectory() as tmp:
+            t, lines = transfer(tmp, 1, size, server_args, client_args)
+        sent = int((re.findall(r'\d+', lines[0]) or [1])[0])
+        label = f"probing {low}-{high}" if high else f"fixed {low}"
+        print(f"mss {label:>17}: goodput {size / t / 1e6:.2f} MB/s, "
+              f"{sent} segments")
+        record('mss', low=low, high=high, size=size, completion=t,
+               goodput=size / t / 1e6, sent=sent)
+
+
+def bench_gso(mss: int, size: int, window_size: int):
+    """ segments per send and recv call, and CPU time of both ends per GB """
+    for gso in [False, True]:
+        client_args = ['-b', str(mss), '-P', '0', '-w', str(window_size),
+                       '--gso' if gso else '--no-gso']
+        server_args = ['-B', str(MAX_HEADER_SIZE + mss), '-w', str(window_size),
+                       '--gro' if gso else '--no-gro']
+        cpu = sum(resource.getrusage(resource.RUSAGE_CHILDREN)[:2])
+        with tempfile.TemporaryDirectory() as tmp:
+            t, lines = transfer(tmp, 1, size, server_args, client_args)
+        cpu = sum(resource.getrusage(resource.RUSAGE_CHILDREN)[:2]) - cpu
+        sent, _, _, sends = map(int, re.findall(r'\d+', lines[0])[:4] or [1, 0, 0, 1])
+        received, reads, _ = map(int, re.findall(r'\d+', lines[-1]) or [1, 1, 0])
+        print(f"GSO/GRO {'on' if gso else 'off':>3}: goodput {size / t / 1e6:.2f} MB/s, "
+              f"{sent / sends:.1f} segments per send, "
+              f"{received / reads:.1f} per recv, CPU {cpu * 1e9 / size:.1f} s/GB")
+        record('gso', gso=gso, size=size, completion=t, goodput=size / t / 1e6,
+               per_send=sent / sends, per_recv=received / reads,
+               cpu=cpu * 1e9 / size)
+
+
+def bench_stripes(stripes: list, delay: float, size: int, mss: int,
+                  window_size: int):
+    """ one file over stripes in parallel, each window bounded, over a delayed path """
+    proxy_args = ['-d', str(delay)]
+    for k in stripes:
+        client_args = ['-b', str(mss), '-w', str(window_size), '--stripes', str(k)]
+        with tempfile.TemporaryDirectory() as tmp:
+            server_args = ['-B', str(MAX_HEADER_SIZE + mss), '-w', str(window_size),
+                           '-f', os.path.join(tmp, 'recv-0.bin'), '-c', str(k)]
+            t, lines = transfer(tmp, 1, size, server_args, client_args,
+                                proxy_args)
+        sent, resent = map(int, re.findall(r'\d+', lines[0])[:2] or [1, 0])
+        print(f"{k} stripes of {size} bytes, {delay * 1e3:.0f} ms delay: "
+              f"goodput {size / t / 1e6:.2f} MB/s, {resent / sent:.1%} re-sent")
+        record('stripes', stripes=k, delay=delay, size=size, completion=t,
+               goodput=size / t / 1e6, sent=sent, retransmits=resent)
+
+
+def bench_ack(ack_delays: list, losses: list, delay: float, size: int,
+              mss: int, window_size: int):
+    client_args = ['-b', str(mss), '-w', str(window_size)]
+    for loss in losses:
+        for ack_delay in ack_delays:
+            server_args = ['-B', str(MAX_HEADER_SIZE + mss), '-w', str(window_size),
+                           '-D', str(ack_delay)]
+            proxy_args = ['-l', str(loss), '-d', str(delay)]
+            with tempfile.TemporaryDirectory() as tmp:
+                t, lines = transfer(tmp, 1, size, server_args, client_args,
+                                    proxy_args)
+            sent, resent, acks = map(int, re.findall(r'\d+', lines[0])[:3] or [1, 0, 0])
+            print(f"ACK delay {ack_delay * 1e3:>3.0f} ms at {loss:.0%} loss, "
+                  f"{delay * 1e3:.0f} ms delay: goodput {size / t / 1e6:.2f} MB/s, "
+                  f"{acks / sent:.2f} ACKs per segment, {resent / sent:.1%} re-sent")
+            record('ack', ack_delay=ack_delay, loss=loss, delay=delay,
+                   size=size, completion=t, goodput=size / t / 1e6,
+                   sent=sent, retransmits=resent, acks=acks)
+
+
+def bench_impair(sweeps: dict, delay: float, size: int, mss: int,
+                 window_size: int):
+    """
+    goodput, segments re-sent, timeouts and completion time through the
+    proxy, one impairment at a time over a delayed path
+    """
+    server_args = ['-B', str(MAX_HEADER_SIZE + mss), '-w', str(window_size)]
+    client_args = ['-b', str(mss), '-w', str(window_size)]
+    runs = [('none', 0.)] + [(name, value) for name, values in sweeps.items()
+                             for value in values]
+    for name, value in runs:
+        proxy_args = ['-d', str(delay)]
+        if name != 'none':
+            proxy_args += ['--' + name, str(value)]
+        with tempfile.TemporaryDirectory() as tmp:
+            t, lines = transfer(tmp, 1, size, server_args, client_args,
+                                proxy_args)
+        sent, resent, _, _, timeouts = map(int, re.findall(r'\d+', lines[0])[:5]
+                                           or [1, 0, 0, 0, 0])
+        print(f"{name:>9} {value:<6g} {delay * 1e3:.0f} ms delay: "
+              f"goodput {size / t / 1e6:.2f} MB/s in {t:.2f} s, "
+              f"{resent / sent:.1%} re-sent, {timeouts} timeouts")
+        record('impair', impairment=name, value=value, delay=delay, size=size,
+               completion=t, goodput=size / t / 1e6, sent=sent,
+               retransmits=resent, timeouts=timeouts)
+
+
+def engine_select(src: str, clients: int, mss: int, window_size: int) -> bool:
+    """ clients sending src at once, each by a thread of its own, as a select loop """
+    with tcup.TcupListener(('localhost', 0), window_size=window_size,
+                           ibuffer_size=MAX_HEADER_SIZE + mss,
+                           rcvbuf=clients * window_size) as listener:
+
+        def send():
+            with open(src, 'rb') as f, \
+                 tcup.connect(listener.address, mss=mss, window_size=window_size) as sock:
+                sock.sendfile(f)
+            results.append(sock.verified)
+
+        def recv():
+            sock, _ = listener.accept()
+            for _ in sock:
+                pass
+
+        results: list = list()
+        threads = [threading.Thread(target=fn) for fn in [send, recv] * clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return all(results)
+
+
+async def engine_asyncio(src: str, clients: int, mss: int, window_size: int) -> bool:
+    """ clients sending src at once, all driven by one asyncio loop """
+    async with await tcup.AsyncTcupListener.listen(
+            ('localhost', 0), window_size=window_size,
+            ibuffer_size=MAX_HEADER_SIZE + mss,
+            rcvbuf=clients * window_size) as listener:
+
+        async def recv():
+            sock, _ = await listener.accept()
+            async for _ in sock:
+                pass
+
+        async def send() -> bool:
+            with open(src, 'rb') as f:
+                return await tcup.transfer(listener.address, f, mss=mss,
+                                           window_size=window_size)
+
+        results = await asyncio.gather(*[send() for _ in range(clients)],
+                                       *[recv() for _ in range(clients)])
+    return all(results[:clients])
+
+
+def bench_engine(clients: list, size: int, mss: int, window_size: int,
+                 uvloop: bool = False):
+    """ concurrent transfers in one process, by threads and select, or by asyncio """
+    if uvloop:
+        import uvloop
+        uvloop.install()
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'send.bin')
+        with open(src, 'wb') as f:
+            f.write(os.urandom(size))
+        for k in clients:
+            for engine in ['select', 'asyncio']:
+                t = time.perf_counter()
+                if engine == 'select':
+                    verified = engine_select(src, k, mss, window_size)
+                else:
+                    verified = asyncio.run(engine_asyncio(src, k, mss, window_size))
+                t = time.perf_counter() - t
+                assert verified, engine
+                print(f"{engine:>7} engine, {k} concurrent clients of {size} bytes: "
+                      f"{t:.2f} s, aggregate goodput {k * size / t / 1e6:.2f} MB/s")
+                record('engine', engine=engine, clients=k, size=size,
+                       completion=t, goodput=k * size / t / 1e6)
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    if 'cksum' in args.bench:
+        bench_cksum(args.sizes, args.number)
+    if 'codec' in args.bench:
+        bench_codec(args.mss, args.number)
+    if 'rtt' in args.bench:
+        bench_rtt(args.mss, args.window_size, args.number)
+    if 'buffer' in args.bench:
+        bench_buffer(64, args.window_size, args.reorder, args.number // 16)
+        bench_buffer(args.mss, args.window_size, args.reorder, args.number)
+    if 'concurrency' in args.bench:
+        bench_concurrency(args.clients, args.workers, args.file_size,
+                          args.mss, args.window_size)
+    if 'cc' in args.bench:
+        bench_cc(args.cc, args.loss, args.delay, args.file_size, args.mss,
+                 args.window_size)
+    if 'mss' in args.bench:
+        bench_mss(args.sizes, args.file_size, args.window_size)
+    if 'gso' in args.bench:
+        bench_gso(args.mss, args.file_size, args.window_size)
+    if 'ack' in args.bench:
+        bench_ack(args.ack_delay, args.loss, args.delay, args.file_size,
+                  args.mss, args.window_size)
+    if 'stripes' in args.bench:
+        bench_stripes(args.stripes, args.delay, args.file_size, args.mss,
+                      args.window_size)
+    if 'engine' in args.bench:
+        bench_engine(args.clients, args.file_size, args.mss, args.window_size,
+                     args.uvloop)
+    if 'impair' in args.bench:
+        bench_impair({'loss': args.loss, 'corrupt': args.corrupt,
+                      'reorder': args.reorder_rate, 'duplicate': args.duplicate,
+                      'jitter': args.jitter, 'rate': args.rate},
+                     args.delay, args.file_size, args.mss, args.window_size)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.time(), 'args': vars(args),
+                       'results': results}, f, indent=1)
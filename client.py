@@ -1,9 +1,30 @@
 import argparse
-import select
+import errno
+import itertools
+import multiprocessing
+import os
+import selectors
+import signal
 import socket
 import sys
+import threading
 import time
-from utils import encode, decode, RTTSampler, TOICalculator
+from collections import deque
+from congestion import controls, Pacer
+from utils import encode, decode, decode_header, malformed, \
+                  encode_options, decode_options, decode_sack, \
+                  encode_mss, decode_mss, encode_wscale, decode_wscale, \
+                  encode_timestamp, decode_timestamp, timestamp, \
+                  encode_transfer, encode_resume, decode_resume, digest, \
+                  ResumeCheck, \
+                  MAX_HEADER_SIZE, DIGEST, MSS, RESUME, SACK, SACK_PERM, TIMESTAMP, WSCALE, \
+                  gso_count, send_gso, drain, \
+                  Metrics, RangeSet, RTTSampler, TimerWheel, TOICalculator, \
+                  TCPSenderBuffer, TCPSenderStream
+
+# not exported by socket module, see ip(7)
+IP_MTU_DISCOVER = 10
+IP_PMTUDISC_PROBE = 3
 
 
 #################
@@ -12,148 +33,888 @@ from utils import encode, decode, RTTSampler, TOICalculator
 
 parser = argparse.ArgumentParser(description='TCP client',
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('-f', '--file',         default='send.txt',     type=str, help='file to send')
+parser.add_argument('-f', '--file',         default='send.txt',     type=str, help='file to send, - for stdin')
 parser.add_argument('-a', '--host',         default='localhost',    type=str, help='client host')
-parser.add_argument('-i', '--recv-port',    default=41190,          type=int, help='client recv port')
-parser.add_argument('-o', '--send-port',    default=41191,          type=int, help='client send port')
+parser.add_argument('-p', '--port',         default=41190,          type=int, help='client port')
 parser.add_argument('-S', '--server-host',  default='localhost',    type=str, help='server host')
 parser.add_argument('-s', '--server-port',  default=41192,          type=int, help='server port')
-parser.add_argument('-b', '--obuffer-size', default=64,             type=int, help='send buffer size')
+parser.add_argument('-b', '--obuffer-size', default=1024,           type=int, help='segment size to start with, '
+                    'and to fall back on')
+parser.add_argument('-P', '--probe-size',   default=65507-MAX_HEADER_SIZE,
+                                                                    type=int, help='largest segment size to probe '
+                    'the path for, 0 for no probing')
+parser.add_argument('-C', '--coalesce',     action='store_true',    help='fill each segment to mss, '
+                    'waiting for more data from stdin')
+parser.add_argument('-T', '--timestamps',   default=True,           action=argparse.BooleanOptionalAction,
+                    help='sample RTT by timestamps, re-sent segments included')
 parser.add_argument('-B', '--ibuffer-size', default=2048,           type=int, help='recv buffer size')
-parser.add_argument('-w', '--window-size',  default=2048,           type=int, help='send window size')
+parser.add_argument('-w', '--window-size',  default=1 << 20,        type=int, help='send window size, '
+                    'bounded by recv window of server')
+parser.add_argument('-n', '--batch-size',   default=64,             type=int, help='segments sent per batch')
+parser.add_argument('-G', '--gso',          default=sys.platform == 'linux', action=argparse.BooleanOptionalAction,
+                    help='send a batch of equal-sized segments in one call by UDP GSO')
+parser.add_argument('-r', '--rate',         default=0.,             type=float, help='pacing rate in bytes per second, '
+                    '0 to spread congestion window over RTT if pacing')
+parser.add_argument('--pace',               action='store_true',    help='pace segments rather than send '
+                    'a window back to back, implied by --rate')
+parser.add_argument('-k', '--stripes',      default=1,              type=int, help='connections to send the file over '
+                    'in parallel, each a range of it, from client port then ephemeral ports')
+parser.add_argument('--resume',             action='store_true',    help='ask server to resume where '
+                    'a transfer of the file stopped, checking data it has rather than sending them again')
+parser.add_argument('--reconnects',         default=3,              type=int, help='times to connect again if resuming, '
+                    'once server resets the connection or is silent for long, e.g. as it restarted')
+parser.add_argument('-c', '--cc',           default='reno',         type=str, help='congestion control',
+                    choices=list(controls))
+parser.add_argument('--trace',              default=0,              type=int, help='latest events to keep, '
+                    'dumped to stderr on exit or SIGUSR1, 0 for no tracing')
+parser.add_argument('--stats',              default='none',         type=str, help='stats to write to stderr '
+                    'on exit or SIGUSR1', choices=['none', 'json', 'prometheus'])
 
 
-#############
-# main loop #
-#############
+##########
+# sender #
+##########
 
-if __name__ == '__main__':
+class Sender:
+    """
+    state machine of TCP sender, reading data from a send buffer
+    every segment in flight has a timer of its own, due at its RTO, or
+    sooner once a segment sent after it is delivered, to mark it lost
+    if it is not delivered within a reordering window (RACK, RFC 8985)
+    """
 
-    args = parser.parse_args()
+    max_ack_delay = .04     # of server, before probing a tail loss
+    min_rto = .2            # RTO never below, as ACKs may be delayed
+    pmtu_timeout = 600.     # before searching for a larger mss again
+    probe_step = 32         # search done once narrower, in bytes
+    fin_retries = 8         # FINs sent before giving up on a FIN-ACK
+    max_silence = 30.       # of server, while re-sending, before giving up
+    keepalive = 5.          # while checking data to resume, so server keeps waiting
+    resume_step = 1 << 26   # bytes checked per batch, so ACKs and timers are handled
 
-    with open(args.file, 'rb') as f, \
-         socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as so, \
-         socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as si:
-        # set sockets
-        so.setblocking(False)
-        si.setblocking(False)
-        so.bind((args.host, args.send_port))
-        si.bind((args.host, args.recv_port))
-        # set top level states for looping and polling
-        TERM = False    # if true, terminate main loop
-        DONE = False    # whether all data have been sent or not
-                        # if true, do not poll on sending socket
-        DUP_ACK_CT = 0  # counter for duplicate ack
-                        # if >= 2, fast retransmit
+    def __init__(self, sbuf, src_port: int, dst_port: int,
+                 mss: int = 1024, window_size: int = 2048, batch_size: int = 64,
+                 cc: str = 'reno', max_mss: int = 0, timestamps: bool = True,
+                 pacer: Pacer = None, start: int = 0, transfer: tuple = None,
+                 resume: bool = False, metrics: Metrics = None):
+        self.sbuf = sbuf
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.mss = mss
+        self.window_size = window_size
+        # set path MTU probing (RFC 4821), searching segment size in
+        # [probe_lo, probe_hi] by sending new data in a segment of probe size
+        self.base_mss = mss     # carried by any path, fallen back on
+        self.max_mss = max(mss, max_mss)    # asked by SYN, bounded by server
+        self._probe_lo = mss    # largest segment size delivered
+        self._probe_hi = self.max_mss   # smallest one lost, less one
+        self._mtu_probe = None  # (seq_no, end) of probe in flight
+        self._timeouts = 0      # successive timeouts, 2 for a black hole
+        # set timestamps (RFC 7323), if agreed by SYN
+        self.timestamps = timestamps
+        self.ts_recent = 0      # timestamp of server to echo
+        # set stripe, sending data from start, as part of a transfer
+        # (id, size) shared by stripes of one file
+        self.start = start
+        self.transfer = transfer
+        # set resume, skipping data server has from a transfer before,
+        # once they check out against the data in sbuf
+        self.resume = resume
+        self.resumed = None     # offset resumed at, if any
+        self._resuming = None   # ResumeCheck of data offered, until it is done
+        self._kept_alive = 0.   # when a keepalive was last sent
         # set pointers for windowing
-        # [         0, send_base)                 sent and acknowledged
+        # [     start, send_base)                 sent and acknowledged
         # [ send_base, send_next)                 sent but not yet acknowledged
-        # [ send_next, send_base + window_size)   can be sent if available
-        # [         0, recv_base)                 received
-        send_base = 0
-        send_next = 0
-        recv_base = 0
+        # [ send_next, send_base + window)        can be sent if available
+        self.send_base = start
+        self.send_next = start
+        self.recover = start    # send_next at last loss, one loss per window
+        self.rwnd = 0           # recv window advertised by server
+        self.shift = 0          # window scale of server, as agreed by SYN
+        # set scoreboard for selective acks
+        self.scoreboard = RangeSet()    # ranges SACKed above send_base
+        self._resent = RangeSet()       # ranges re-sent in this recovery
+        self._holes: deque = deque()    # (start, end, cause) to be re-sent
+        # set timers, one per segment in flight keyed by seq_no, and 'syn',
+        # 'persist', 'tlp', 'fin' for SYN, window probe, tail loss probe, FIN
+        self.timers = TimerWheel()
+        self.inflight: dict = dict()    # {seq_no: [end, send_time, re-sent]}
+        self._order: deque = deque()    # seq_nos of new data, in sent order
+        # set RACK, by the latest sent segment delivered
+        self.rack_xmit = 0.     # its send time
+        self.rack_rtt = 0.      # its RTT
+        self._rack_high = start     # holes below it are timed for RACK
+        self.acked_at = 0.      # when send_base last moved, restarting RTOs
+        self.tlp = False        # whether a tail loss probe is out
+        # set congestion control, and pacing if any
+        self.cc = controls[cc](mss)
+        self.pacer = pacer
+        # set counters, and trace of events if any
+        self.metrics = metrics if metrics is not None else Metrics()
+        # set states
+        self.established = False    # if true, SYN-ACK has been received
+        self.syn = True         # whether to send SYN
+        self.probe = False      # whether to probe a closed recv window
+        self.done = False       # whether all data have been sent or not
+        self.closed = False     # if true, FIN has been sent
+        self.finished = False   # if true, FIN-ACK has arrived, or never will
+        self.aborted = False    # if true, server is silent or reset, given up on
+        self.heard_at = time.monotonic()    # when server last sent anything
+        self.fins = 0           # FINs sent
+        # set digest of data ACKed, matched against the one of server
+        self.digest = digest()
+        self.verified = None    # whether digests match, None if unknown
+        self.dup_ack_ct = 0     # counter for duplicate ack
+                                # if >= 2, fast retransmit
         # set rtt and toi
-        rtt = RTTSampler()
-        toi = TOICalculator()
-        MIN_RTT = 10.
-        # enter main loop
-        while not TERM:
-            # poll on sockets
-            # ... data to be fast retransmitted
-            if DUP_ACK_CT >= 2:
-                il, ol, xl = select.select([], [so], [si, so], toi.toi)
-            # ... data within the window to be sent
-            elif not DONE and send_next + args.obuffer_size <= send_base + args.window_size:
-                il, ol, xl = select.select([si], [so], [si, so], toi.toi)
-            # ... NO data to be sent or fast retransmitted
+        self.rtt = RTTSampler()
+        self.toi = TOICalculator()
+        # set reusable buffer for a batch of segments
+        self._batch_size = batch_size
+        self._obuf = bytearray(batch_size * (MAX_HEADER_SIZE + self.max_mss))
+
+    def __repr__(self):
+        return 'Sender(send_base={}, send_next={}, {}, {})'.format(
+                self.send_base, self.send_next, self.cc, self.toi)
+
+    @property
+    def room(self) -> int:
+        """
+        bytes that may be sent now, those SACKed count against
+        recv window but not against congestion window (RFC 6675)
+        """
+        unacked = self.send_next - self.send_base
+        sacked = sum(end - start for start, end in self.scoreboard)
+        return int(min(self.cc.cwnd - unacked + sacked,
+                       min(self.rwnd, self.window_size) - unacked))
+
+    @property
+    def rto(self) -> float:
+        """ time to wait before a segment is lost for sure """
+        return max(self.toi.toi, self.min_rto)
+
+    @property
+    def min_rtt(self) -> float:
+        """ least RTT of the last samples """
+        return self.rtt.min
+
+    @property
+    def reo_wnd(self) -> float:
+        """ time allowed for a segment to be reordered rather than lost """
+        return min(self.min_rtt / 4, self.toi.estRTT)
+
+    @property
+    def pto(self) -> float:
+        """ time to wait before probing a tail loss, within RTO """
+        pto = 2 * self.toi.estRTT
+        # less than 2 full segments, or a probe larger than those before,
+        # ACK may be delayed
+        if self.send_next - self.send_base < 2 * self.mss or self._mtu_probe:
+            pto += self.max_ack_delay
+        return min(pto, self.rto)
+
+    def _lost(self, timeout: bool = False):
+        """ signal congestion control, once per window of data """
+        if timeout:
+            self.cc.on_timeout(self.send_next - self.send_base)
+        elif self.send_base >= self.recover:
+            self.cc.on_loss(self.send_next - self.send_base)
+        self.recover = self.send_next
+
+    def _retransmit(self, cause: str = 'fast'):
+        """
+        queue every hole below the highest SACKed byte for re-sending,
+        or the oldest segment if none is SACKed, each once per recovery
+        """
+        high = max(self.scoreboard.end,
+                   min(self.send_base + self.mss, self.send_next))
+        for hole in self.scoreboard.gaps(self.send_base, high):
+            for start, end in self._resent.gaps(*hole):
+                self._holes.append((start, end, cause))
+                self._resent.add(start, end)
+
+    def _sent(self, seq_no: int, end: int, now: float, resent: bool = False):
+        """ record a segment sent, timed to its RTO """
+        self.inflight[seq_no] = [end, now, resent]
+        if not resent:
+            self._order.append(seq_no)
+        elif seq_no < self._rack_high:  # time it for RACK again
+            self._rack_high = seq_no
+        self.timers.schedule(seq_no, now + self.rto)
+
+    def _acked(self, ack_no: int, now: float) -> float:
+        """ forget segments ACKed, return the latest send time of them """
+        latest = 0.
+        while self._order and self._order[0] < ack_no:
+            seq_no = self._order.popleft()
+            self.timers.cancel(seq_no)
+            record = self.inflight.pop(seq_no, None)
+            if record is None:
+                continue    # SACKed before
+            end, send_time, resent = record
+            if end > ack_no:    # partially ACKed, the rest is still in flight
+                self.inflight[ack_no] = record
+                self._order.appendleft(ack_no)
+                self.timers.schedule(ack_no, send_time + self.rto)
+                break
+            if not resent or now - send_time >= self.min_rtt:
+                latest = max(latest, send_time)
+        return latest
+
+    def _sacked(self, start: int, end: int, now: float) -> float:
+        """ forget segments in [start, end) newly SACKed, as _acked """
+        latest = 0.
+        while start < end:
+            record = self.inflight.pop(start, None)
+            if record is None:
+                break       # not a segment boundary, left to its timer
+            self.timers.cancel(start)
+            start, send_time, resent = record
+            if not resent or now - send_time >= self.min_rtt:
+                latest = max(latest, send_time)
+        return latest
+
+    def _time_holes(self):
+        """ time holes sent before the latest segment delivered for RACK """
+        high = self.scoreboard.end
+        for start, end in self.scoreboard.gaps(
+                max(self.send_base, self._rack_high), high):
+            while start < end and start in self.inflight:
+                next_start, send_time, _ = self.inflight[start]
+                if send_time < self.rack_xmit:
+                    self.timers.schedule(start, min(
+                        send_time + self.rack_rtt + self.reo_wnd,
+                        send_time + self.rto))
+                start = next_start
+        self._rack_high = max(self._rack_high, high)
+
+    def _check(self, seq_no: int, now: float):
+        """ timer of a segment in flight is due, find whether it is lost """
+        record = self.inflight.get(seq_no)
+        if record is None:
+            return
+        end, send_time, _ = record
+        sacked = self.scoreboard.find(seq_no)
+        if end <= self.send_base or sacked and sacked[1] >= end:
+            del self.inflight[seq_no]
+            return
+        # RTO restarts as long as ACKs move send_base (RFC 6298)
+        rto = max(send_time, self.acked_at) + self.rto
+        rack = send_time + self.rack_rtt + self.reo_wnd
+        if now < rto and (send_time >= self.rack_xmit or now < rack):
+            # not lost yet
+            deadline = rto
+            if send_time < self.rack_xmit:
+                deadline = min(deadline, rack)
+            self.timers.schedule(seq_no, deadline)
+            return
+        if self._mtu_probe and self._mtu_probe[0] == seq_no:
+            # too big for the path rather than congestion
+            self._probe_failed()
+            cause = 'probe'
+        elif now >= rto and seq_no <= self.send_base:
+            if not self._silent(now):
+                self.timeout()
+            return
+        else:
+            if self.metrics.tracing:
+                self.metrics.trace('lost', seq_no)
+            self._lost()
+            cause = 'rack'
+        self._resent.add(seq_no, end)
+        self._holes.append((seq_no, end, cause))
+        # in case it is not re-sent, e.g. holes are cleared by a timeout
+        self.timers.schedule(seq_no, now + self.rto)
+
+    def _probe_tail(self):
+        """ re-send the last segment, so its SACK reveals losses before it """
+        if (self.tlp or not self._order or self.send_base < self.recover
+                or self.send_base == self.send_next):
+            return
+        seq_no = self._order[-1]
+        if seq_no in self.inflight:
+            if self.metrics.tracing:
+                self.metrics.trace('tlp', seq_no)
+            self._holes.append((seq_no, self.inflight[seq_no][0], 'tlp'))
+            self.tlp = True
+
+    def _probe_size(self) -> int:
+        """ segment size to probe the path with next, 0 if not now """
+        if (self._mtu_probe or self.send_base < self.recover
+                or self._probe_hi - self._probe_lo < self.probe_step):
+            return 0
+        return (self._probe_lo + self._probe_hi + 1) // 2
+
+    def _set_mss(self, mss: int):
+        self.mss = mss
+        self.cc.mss = mss
+
+    def _probe_acked(self):
+        """ probe is delivered, segments of its size fit the path """
+        start, end = self._mtu_probe
+        self._mtu_probe = None
+        self._probe_lo = max(self._probe_lo, end - start)
+        self._set_mss(self._probe_lo)
+        if self.metrics.tracing:
+            self.metrics.trace('mss', self.mss)
+        if self._probe_size() == 0:     # search done, try again later
+            self.timers.schedule('pmtu', time.monotonic() + self.pmtu_timeout)
+
+    def _probe_failed(self):
+        """ probe is lost, segments of its size do not fit the path """
+        start, end = self._mtu_probe
+        self._mtu_probe = None
+        self._probe_hi = min(self._probe_hi, end - start - 1)
+        if self.metrics.tracing:
+            self.metrics.trace('probe lost', end - start)
+        if self._probe_size() == 0:
+            self.timers.schedule('pmtu', time.monotonic() + self.pmtu_timeout)
+
+    def too_big(self, seq_no: int):
+        """ segment at seq_no is refused as too big for the interface """
+        record = self.inflight.get(seq_no)
+        if record is None:
+            return
+        end = record[0]
+        if self._mtu_probe and self._mtu_probe[0] == seq_no:
+            self._probe_failed()
+        else:   # path shrank, fall back and search again
+            self._probe_hi = min(self._probe_hi, end - seq_no - 1)
+            self._probe_lo = self.base_mss
+            self._set_mss(self.base_mss)
+            if self.metrics.tracing:
+                self.metrics.trace('mss', self.mss)
+        self._resent.add(seq_no, end)
+        self._holes.append((seq_no, end, 'too_big'))
+
+    def expire(self, now: float):
+        """ handle timers due by now """
+        for key in self.timers.expire(now):
+            if key == 'syn':
+                self.toi.backoff(1.1)
+                self.syn = not self._silent(now)
+            elif key == 'persist':
+                self.toi.backoff(1.1)
+                self.probe = not self._silent(now)
+            elif key == 'tlp':
+                self._probe_tail()
+            elif key == 'pmtu':     # path may carry larger segments now
+                self._probe_hi = self.max_mss
+            elif key in ('pace', 'resume'):     # tokens, or data to check
+                pass
+            elif key == 'fin':      # FIN or FIN-ACK lost
+                self.toi.backoff(1.1)
+                self.closed = False
+                self.finished = self.fins >= self.fin_retries
             else:
-                il, ol, xl = select.select([si], [], [si, so], toi.toi)
-            # receive ack
-            for s in il:
-                if s is si:
-                    ack, _ = si.recvfrom(args.ibuffer_size)
-                    _, header_s, _ = decode(ack, verbose=True)
-                    # move send_base on cumulative ack
-                    if send_base < header_s['ack_no']:
-                        send_base = header_s['ack_no']
-                        DUP_ACK_CT = 0
-                    else:
-                        DUP_ACK_CT += 1
-                    # terminate if all data are sent and acked
-                    if DONE and send_base == send_next:
-                        segment = encode(
-                            b'',
-                            src_port=args.send_port,
-                            dst_port=args.server_port,
-                            seq_no=send_next,
-                            FIN=True
-                        )
-                        so.sendto(segment, (args.server_host, args.server_port))
-                        TERM = True  # set terminate flag
+                self._check(key, now)
+
+    def _paced(self, size: int, now: float) -> bool:
+        """ whether size bytes may be sent now, else wake up when they may """
+        if self.pacer is None:
+            return True
+        wait = self.pacer.take(size, now)
+        if wait:
+            self.timers.schedule('pace', now + wait)
+        return not wait
+
+    def _encode(self, i: int, payload: bytes, seq_no: int,
+                SYN: bool = False, FIN: bool = False,
+                options: list = None) -> memoryview:
+        """ encode i-th segment of the batch, with a timestamp if agreed """
+        options = list(options or [])
+        if self.resumed is not None and self.send_base == self.resumed and not SYN:
+            options.append(encode_resume(self.resumed))
+        if self.timestamps:
+            options.append(encode_timestamp(timestamp(), 0 if SYN else self.ts_recent))
+        options = encode_options(options) if options else b''
+        return encode(
+            payload,
+            src_port=self.src_port,
+            dst_port=self.dst_port,
+            seq_no=seq_no,
+            SYN=SYN,
+            FIN=FIN,
+            options=options,
+            buf=self._obuf,
+            offset=i * (MAX_HEADER_SIZE + self.max_mss)
+        )
+
+    def recv(self, segment: bytes):
+        """ handle an ACK """
+        metrics = self.metrics
+        if malformed(segment):
+            metrics.counts['checksum_failures'] += 1
+            return  # discard datagrams too short to decode
+        checksum, header, payload = decode(segment, verbose=True)
+        if checksum:
+            metrics.counts['checksum_failures'] += 1
+            return  # discard corrupted ACKs
+        metrics.counts['segments_received'] += 1
+        metrics.counts['bytes_received'] += len(segment)
+        now = self.heard_at = time.monotonic()
+        # reset by server, as it lost the connection, e.g. by a restart
+        if header.RST:
+            if not self.finished and self.send_base <= header.ack_no <= self.send_next:
+                if metrics.tracing:
+                    metrics.trace('reset', header.ack_no)
+                self.aborted = self.finished = True
+            return
+        # connection established, window field of SYN-ACK is never scaled
+        options = decode_options(header.options) if header.options else {}
+        if header.FIN:
+            # FIN-ACK, with digest of data received by server if any
+            if self.closed and not self.finished:
+                self.finished = True
+                self.timers.cancel('fin')
+                if DIGEST in options:
+                    self.verified = options[DIGEST] == self.digest.digest()
+            return
+        if header.SYN:
+            if not self.established:
+                self.shift = decode_wscale(options.get(WSCALE, b''))
+                if MSS in options:
+                    self.max_mss = min(self.max_mss, decode_mss(options[MSS]))
+                    self._probe_hi = min(self._probe_hi, self.max_mss)
+                    if self.mss > self.max_mss:
+                        self.base_mss = self._probe_lo = self.max_mss
+                        self._set_mss(self.max_mss)
+                self.timestamps = self.timestamps and TIMESTAMP in options
+                if self.timestamps:
+                    self.ts_recent = decode_timestamp(options[TIMESTAMP])[0]
+                if self.resume and RESUME in options:
+                    offset, group = decode_resume(options[RESUME])
+                    if offset is not None and group and not self.send_base:
+                        self._resuming = ResumeCheck(self.sbuf.peek, offset, group,
+                                                     bytes(payload))
+                self.rwnd = header.window
+                self.established = True
+                self.timers.cancel('syn')
+            return
+        if self._resuming is not None:
+            return  # ACKs of keepalives, nothing is sent yet
+        self.rwnd = header.window << self.shift
+        # record ranges selectively acked above send_base
+        delivered = 0.  # latest send time of segments delivered
+        if SACK in options:
+            for left, right in decode_sack(options[SACK]):
+                if self.send_base < left < right <= self.send_next:
+                    for start, end in self.scoreboard.gaps(left, right):
+                        delivered = max(delivered, self._sacked(start, end, now))
+                    self.scoreboard.add(left, right)
+        if self.send_base < header.ack_no:
+            delivered = max(delivered, self._acked(header.ack_no, now))
+        # sample rtt on cumulative ack, by timestamp echoed if any,
+        # else by send time of segment acked unless re-sent (Karn)
+        sample_rtt = None
+        if self.send_base < header.ack_no:
+            sample_rtt = self.rtt.pop(header.ack_no, now)
+            if TIMESTAMP in options:
+                tsval, tsecr = decode_timestamp(options[TIMESTAMP])
+                self.ts_recent = tsval
+                if tsecr:
+                    sample_rtt = ((timestamp() - tsecr) & 0xffffffff) / 1e6
+        if sample_rtt is not None:
+            self.toi.update(self.rtt.sample(sample_rtt))
+            metrics.rtt.add(sample_rtt)
+            metrics.toi.add(self.toi.toi)
+        # path MTU probe delivered
+        if self._mtu_probe:
+            start, end = self._mtu_probe
+            sacked = self.scoreboard.find(start)
+            if header.ack_no >= end or sacked and sacked[1] >= end:
+                self._probe_acked()
+        # move send_base on cumulative ack
+        if self.send_base < header.ack_no:
+            self.cc.on_ack(header.ack_no - self.send_base, sample_rtt)
+            self.digest.update(self.sbuf.peek(
+                self.send_base, header.ack_no - self.send_base))
+            self.send_base = header.ack_no
+            self.sbuf.release(self.send_base)
+            self.scoreboard.trim(self.send_base)
+            self._resent.trim(self.send_base)
+            self.dup_ack_ct = 0
+            self._timeouts = 0
+            self.acked_at = now
+            # probe a tail loss if no ACK comes in time
+            self.tlp = False
+            if self.send_base < self.send_next:
+                self.timers.schedule('tlp', now + self.pto)
+            else:
+                self.timers.cancel('tlp')
+        else:
+            self.dup_ack_ct += 1
+            metrics.counts['dup_acks'] += 1
+        # time holes before the latest segment delivered
+        if delivered > self.rack_xmit:
+            self.rack_xmit = delivered
+            self.rack_rtt = now - delivered
+            self._time_holes()
+        # in recovery, re-send holes newly found or left by a partial ack
+        if self.send_base < self.recover:
+            self._retransmit()
+        elif self.dup_ack_ct >= 2:
+            if metrics.tracing:
+                metrics.trace('fast retransmit', self.send_base)
+            if self._mtu_probe and self._mtu_probe[0] == self.send_base:
+                self._probe_failed()    # too big for the path, not congestion
+                self.recover = self.send_next
+            else:
+                self._lost()
+            self._resent.clear()
+            self._retransmit()
+            self.dup_ack_ct = 0
+
+    def _resume(self, resumed: int):
+        """
+        start sending at resumed, where data below the offset offered stop
+        matching the ones server has, telling server so until ACKed
+        """
+        if self.metrics.tracing:
+            self.metrics.trace('resume', self._resuming.offset, resumed)
+        self._resuming = None
+        self.send_base = self.send_next = resumed
+        self.recover = self._rack_high = resumed
+        self.sbuf.release(resumed)
+        self.resumed = resumed
+
+    def _silent(self, now: float) -> bool:
+        """ whether server has not been heard from for too long, giving up if so """
+        if now - self.heard_at < self.max_silence:
+            return False
+        if self.metrics.tracing:
+            self.metrics.trace('abort', self.send_base)
+        self.aborted = self.finished = True
+        return True
+
+    def timeout(self):
+        """ handle a timeout of the oldest segment """
+        self.toi.backoff(1.1)  # exponential backoff
+        self.metrics.counts['timeouts'] += 1
+        if self.metrics.tracing:
+            self.metrics.trace('timeout', self.send_base, self.toi)
+        self._lost(timeout=True)
+        # successive timeouts, larger segments may be black holed
+        self._timeouts += 1
+        if self._timeouts >= 2 and self.mss > self.base_mss:
+            self._probe_hi = self.mss - 1
+            self._probe_lo = self.base_mss
+            self._set_mss(self.base_mss)
+            if self.metrics.tracing:
+                self.metrics.trace('mss', self.mss)
+        # re-send oldest segment, the rest on acks in recovery
+        end = self.inflight.get(self.send_base, [self.send_base + self.mss])[0]
+        self._resent.clear()
+        self._holes.clear()
+        self._resent.add(self.send_base, end)
+        self._holes.append((self.send_base, end, 'timeout'))
+
+    def segments(self) -> list:
+        """ encode a batch of segments that may be sent now """
+        batch: list = list()
+        now = time.monotonic()
+        # open connection, asking for mss, window scale, SACK and timestamps
+        # SYN takes no sequence number, seq_no stays the offset in file
+        # ... a stripe starts at its offset, and tells server the transfer
+        if not self.established:
+            if self.syn:
+                options = [encode_mss(self.max_mss), encode_wscale(0), (SACK_PERM, b'')]
+                if self.transfer is not None:
+                    options.append(encode_transfer(*self.transfer))
+                if self.resume:
+                    options.append(encode_resume())
+                batch.append(self._encode(0, b'', self.send_base, SYN=True,
+                                          options=options))
+                self.timers.schedule('syn', now + self.rto)
+                self.syn = False
+            return batch
+        # check data server offers to resume after, a step per batch,
+        # keeping connection alive meanwhile
+        if self._resuming is not None:
+            resumed = self._resuming.step(self.resume_step)
+            if resumed is None:
+                if now - self._kept_alive >= self.keepalive:
+                    batch.append(self._encode(0, b'', self.send_base))
+                    self._kept_alive = now
+                self.timers.schedule('resume', now)
+                return batch
+            self._resume(resumed)
+        # spread segments over srtt, once it is sampled
+        if self.pacer is not None and self.min_rtt < float('inf'):
+            self.pacer.pace(self.cc.cwnd, self.toi.estRTT,
+                            slow_start=self.cc.cwnd < self.cc.ssthresh)
+        # re-send holes, oldest first
+        metrics = self.metrics
+        while self._holes and len(batch) < self._batch_size:
+            start, end, cause = self._holes.popleft()
+            start = max(start, self.send_base)
+            payload = self.sbuf.peek(start, min(self.mss, end - start))
+            if start >= end or not payload:
+                continue
+            if not self._paced(len(payload), now):
+                self._holes.appendleft((start, end, cause))
+                break
+            # probe re-sent, its ACK no longer tells if it fits the path
+            if self._mtu_probe and self._mtu_probe[0] <= start < self._mtu_probe[1]:
+                self._probe_failed()
+            batch.append(self._encode(len(batch), payload, start))
+            self._sent(start, start + len(payload), now, resent=True)
+            if start + len(payload) < end:
+                self._holes.appendleft((start + len(payload), end, cause))
+            self.rtt.resent(start + len(payload))   # its ACK is ambiguous
+            metrics.retransmits[cause] += 1
+            if metrics.tracing:
+                metrics.trace('resend', start, cause)
+        # probe closed window with one byte, so server ACKs its window
+        if self.probe and self.send_base == self.send_next and not self.done:
+            payload = self.sbuf.peek(self.send_next, 1)
+            if payload:
+                batch.append(self._encode(len(batch), payload, self.send_next))
+                self._sent(self.send_next, self.send_next + len(payload), now)
+                self.send_next += len(payload)
+        self.probe = False
+        # send data within the window
+        while len(batch) < self._batch_size and not self.done:
+            size = min(self.mss, self.room)
+            # avoid silly window, send less than mss only if none in flight
+            if size <= 0 or size < self.mss and self.send_next > self.send_base:
+                break
+            # probe path with a larger segment, if window allows
+            probe = self._probe_size()
+            if probe and probe <= self.room:
+                size = probe
+            payload = self.sbuf.peek(self.send_next, size)
+            if not payload:     # end of file, or of data written so far
+                self.done = self.sbuf.eof(self.send_next)
+                break
+            if not self._paced(len(payload), now):
+                break
+            if probe and len(payload) == probe:
+                if metrics.tracing:
+                    metrics.trace('probe', probe)
+                self._mtu_probe = (self.send_next, self.send_next + probe)
+            if metrics.tracing:
+                metrics.trace('send', self.send_next, len(payload))
+            batch.append(self._encode(len(batch), payload, self.send_next))
+            self._sent(self.send_next, self.send_next + len(payload), now)
+            self.send_next += len(payload)                  # advance send_next
+            self.rtt.update(self.send_next, now)            # update rtt records
+            if not self.tlp:
+                self.timers.schedule('tlp', now + self.pto)
+        # terminate if all data are sent and acked, with digest of them,
+        # re-sending FIN until FIN-ACK arrives
+        if self.done and self.send_base == self.send_next and not batch \
+                and not self.closed and not self.finished:
+            batch.append(self._encode(0, b'', self.send_next, FIN=True,
+                                      options=[(DIGEST, self.digest.digest())]))
+            self.timers.schedule('fin', now + self.rto)
+            self.closed = True
+            self.fins += 1
+        # nothing in flight, window too small to send, probe it in time
+        if (not batch and not self.done and self.send_base == self.send_next
+                and self.room < self.mss and 'persist' not in self.timers):
+            self.timers.schedule('persist', now + self.rto)
+        metrics.counts['segments_sent'] += len(batch)
+        metrics.counts['bytes_sent'] += sum(map(len, batch))
+        return batch
+
+
+#############
+# main loop #
+#############
+
+def run(sock: socket.socket, sender: Sender, addr: tuple, ibuffer_size: int,
+        gso: bool = False, wakeup: socket.socket = None, verbose: bool = False) -> int:
+    """
+    drive sender by socket events until FIN is ACKed, or given up on,
+    or by wakeup too, readable once more data are written to send buffer,
+    print GSO falling back if verbose, return number of send calls
+    """
+    ibuf = bytearray(ibuffer_size)
+    view = memoryview(ibuf)
+    queue: deque = deque()  # segments encoded but not yet sent
+    calls = 0
+    with selectors.DefaultSelector() as sel:
+        sel.register(sock, selectors.EVENT_READ)
+        if wakeup is not None:
+            sel.register(wakeup, selectors.EVENT_READ)
+        events = selectors.EVENT_READ
+        while True:
+            # send segments, batch after batch, until none may be sent
+            while True:
+                if not queue:
+                    if sender.finished:
                         break
-                    # update toi with sample rtt
-                    if header_s['ack_no'] in rtt:
-                        skip_ct, send_time = rtt.pop(header_s['ack_no'])
-                        sample_rtt = time.time() - send_time
-                        MIN_RTT = min(MIN_RTT, sample_rtt)
-                        sample_rtts = [sample_rtt] + [MIN_RTT] * skip_ct
-                        for sample_rtt in sample_rtts:
-                            toi.update(sample_rtt)
-            # send data
-            for s in ol:
-                if s is so:
-                    # ... fast retransmit
-                    if DUP_ACK_CT >= 2:
-                        print(f"fast retransmit {send_base}")
-                        f.seek(send_base)
-                        payload = f.read(args.obuffer_size)
-                        segment = encode(
-                            payload,
-                            src_port=args.send_port,
-                            dst_port=args.server_port,
-                            seq_no=send_base
-                        )
-                        so.sendto(segment, (args.server_host, args.server_port))
-                        DUP_ACK_CT = 0
-                    # ... normal transmit
+                    queue.extend(sender.segments())
+                    if not queue:
+                        break
+                # segments of equal size in one call if GSO, else one by one
+                n = gso_count(queue) if gso else 1
+                try:
+                    if n > 1:
+                        send_gso(sock, list(itertools.islice(queue, n)), addr)
                     else:
-                        print(f"sending packet {send_next}")
-                        f.seek(send_next)
-                        payload = f.read(args.obuffer_size)
-                        if not payload:     # end of file
-                            DONE = True     # all data have been sent
-                        else:               # some data to be sent
-                            segment = encode(
-                                payload,
-                                src_port=args.send_port,
-                                dst_port=args.server_port,
-                                seq_no=send_next
-                            )
-                            so.sendto(segment, (args.server_host, args.server_port))
-                        send_next += len(payload)               # advance send_next
-                        rtt.update({send_next: time.time()})    # update rtt records
-            # timeout, retransmit
-            if not (il + ol + xl):
-                toi.backoff(1.1) # exponential backoff
-                # re-sending ...
-                print(
-                    f"timeout packet {send_base}. "
-                    f"{toi}. "
-                    "re-sending..."
-                )
-                f.seek(send_base)
-                payload = f.read(args.obuffer_size)
-                # assemble data packet
-                segment = encode(
-                    payload,
-                    src_port=args.send_port,
-                    dst_port=args.server_port,
-                    seq_no=send_base
-                )
-                so.sendto(segment, (args.server_host, args.server_port))
-                # update rtt record, avoid measuring retransmitted packets
-                if send_base+len(payload) in rtt:
-                    rtt.pop(send_base+len(payload))
+                        sock.sendto(queue[0], addr)
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    if n > 1:   # not supported by kernel or device, fall back
+                        if verbose:
+                            print(f"GSO off, {e}")
+                        gso = False
+                        continue
+                    if e.errno != errno.EMSGSIZE:
+                        raise
+                    # larger than the interface carries
+                    sender.too_big(decode_header(queue[0]).seq_no)
+                calls += 1
+                for _ in range(n):
+                    queue.popleft()
+            if sender.finished and not queue:
+                break
+            # poll on socket
+            # ... writable only if last batch was not sent in full
+            want = selectors.EVENT_READ
+            if queue:
+                want |= selectors.EVENT_WRITE
+            if events != want:
+                sel.modify(sock, want)
+                events = want
+            # wait until the next timer is due
+            timeout = sender.timers.deadline - time.monotonic()
+            ready = sel.select(max(timeout, 0) if timeout < float('inf') else None)
+            # receive acks, until none is pending
+            for key, mask in ready:
+                if key.fileobj is wakeup:
+                    drain(wakeup)
+                    continue
+                while mask & selectors.EVENT_READ:
+                    try:
+                        n, _ = sock.recvfrom_into(ibuf)
+                    except BlockingIOError:
+                        break
+                    sender.recv(view[:n])
+            # timers due, whether any ack arrived or not
+            sender.expire(time.monotonic())
+    return calls
+
+
+def dump(metrics: Metrics, args, stripe: int = 0):
+    """ write trace of events if any, then stats if asked, to stderr """
+    label = '' if args.stripes == 1 else f'stripe {stripe} '
+    if metrics.tracing:
+        metrics.dump(sys.stderr, label)
+    if args.stats != 'none':
+        print(metrics.export(args.stats, port=args.port, stripe=stripe),
+              file=sys.stderr)
+
+
+def send(args, stripe: int = 0) -> dict:
+    """
+    send the file, or its stripe-th range of args.stripes if striped,
+    return stats of sender
+    """
+    metrics = Metrics(args.trace)
+    if hasattr(signal, 'SIGUSR1'):  # on demand
+        signal.signal(signal.SIGUSR1, lambda *_: dump(metrics, args, stripe))
+    with open(sys.stdin.fileno() if args.file == '-' else args.file, 'rb',
+              closefd=args.file != '-') as f, \
+         socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        # set socket
+        sock.setblocking(False)
+        # ... later stripes on ports of their own, as ports around are taken
+        sock.bind((args.host, args.port if stripe == 0 else 0))
+        port = sock.getsockname()[1]
+        # set DF, so datagrams too big for the path are dropped rather than
+        # fragmented, probing the path by loss, as PMTU of kernel is ignored
+        if args.probe_size and sys.platform == 'linux':
+            sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+        # set range of file to send, [start, end) if striped
+        start, end, transfer = 0, None, None
+        if args.stripes > 1:
+            size = os.fstat(f.fileno()).st_size
+            start = size * stripe // args.stripes
+            end = size * (stripe + 1) // args.stripes
+            transfer = (args.port, size)
+        # set send buffer, map file into memory or read ahead if unseekable
+        # ... by a thread, waking up sender once data are read, as reads
+        # from a pipe block, and would hold up ACKs and timers
+        wakeup = waker = None
+        try:
+            sbuf = TCPSenderBuffer(f, end)
+        except (ValueError, OSError):
+            sbuf = TCPSenderStream(args.window_size
+                                   + max(args.obuffer_size, args.probe_size),
+                                   coalesce=args.coalesce)
+            wakeup, waker = socket.socketpair()
+            wakeup.setblocking(False)
+            waker.setblocking(False)
+
+            def wake():
+                try:
+                    waker.send(b'\x00')
+                except OSError:
+                    pass    # sender is already woken up, or gone
+
+            threading.Thread(target=sbuf.read_from, args=(f, wake),
+                             name='reader', daemon=True).start()
+        # connect again once given up on, resuming where server left off
+        calls = 0
+        for attempt in range(args.reconnects + 1):
+            if attempt:
+                print(f"connection given up on, reconnecting to resume at "
+                      f"{sender.send_base}")
+            sender = Sender(sbuf, src_port=port, dst_port=args.server_port,
+                            mss=args.obuffer_size, window_size=args.window_size,
+                            batch_size=args.batch_size, cc=args.cc,
+                            max_mss=args.probe_size, timestamps=args.timestamps,
+                            pacer=Pacer(args.rate) if args.pace or args.rate else None,
+                            start=start, transfer=transfer, metrics=metrics,
+                            resume=args.resume and isinstance(sbuf, TCPSenderBuffer))
+            calls += run(sock, sender, (args.server_host, args.server_port),
+                         args.ibuffer_size, args.gso, wakeup, verbose=True)
+            if not (sender.aborted and sender.resume):
+                break
+        sbuf.close()
+        if wakeup is not None:
+            wakeup.close()
+            waker.close()
+        verdict = {True: 'verified', False: 'mismatched', None: 'unverified'}
+        verdict = 'aborted' if sender.aborted else verdict[sender.verified]
+        print(f"{'' if args.stripes == 1 else f'stripe {stripe}, '}"
+              f"[{start}, {sender.send_base}) {verdict}, "
+              f"{'' if sender.resumed is None else f'resumed at {sender.resumed}, '}"
+              f"mss {sender.mss}, RTT min {sender.rtt.min * 1e3:.3f} ms, "
+              f"median {sender.rtt.percentile(.5) * 1e3:.3f} ms, "
+              f"p99 {sender.rtt.percentile(.99) * 1e3:.3f} ms.")
+    dump(metrics, args, stripe)
+    counts = metrics.counts
+    return {'sent': counts['segments_sent'],
+            'retransmits': sum(metrics.retransmits.values()),
+            'acks': counts['segments_received'], 'calls': calls,
+            'timeouts': counts['timeouts'],
+            'mismatched': sender.verified is False, 'aborted': sender.aborted}
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    if args.stripes > 1 and args.file == '-':
+        parser.error('stripes need a seekable file')
+    if args.resume and (args.stripes > 1 or args.file == '-'):
+        parser.error('resume needs a seekable file in one stripe')
+
+    if args.stripes > 1:    # one process per stripe, as one connection is CPU bound
+        with multiprocessing.Pool(args.stripes) as pool:
+            results = pool.starmap(send, [(args, i) for i in range(args.stripes)])
+    else:
+        results = [send(args)]
+    stats = {key: sum(r[key] for r in results) for key in results[0]}
+    print(f"sent {stats['sent']} segments, {stats['retransmits']} re-sent, "
+          f"{stats['acks']} ACKs received, in {stats['calls']} send calls, "
+          f"{stats['timeouts']} timeouts.")
 
     print("client shutdown.")
+    if stats['mismatched'] or stats['aborted']:
+        sys.exit(1)
@@ -0,0 +1,210 @@
+import time
+
+
+class CongestionControl:
+    """
+    interface of congestion control, driven by ACK, loss and timeout events
+    cwnd in bytes, never below one mss
+    """
+
+    def __init__(self, mss: int):
+        self.mss = mss
+        self.cwnd = float('inf')
+        self.ssthresh = float('inf')
+
+    def __repr__(self):
+        return '{}(cwnd={:.0f}, ssthresh={:.0f})'.format(
+                type(self).__name__, self.cwnd, self.ssthresh)
+
+    def on_ack(self, acked: int, rtt: float = None):
+        """ acked bytes newly ACKed, with an RTT sample if valid """
+        pass
+
+    def on_loss(self, flight: int):
+        """ segment lost, found by duplicate ACKs, flight bytes unACKed """
+        pass
+
+    def on_timeout(self, flight: int):
+        """ segment lost, found by timeout, flight bytes unACKed """
+        pass
+
+
+class Reno(CongestionControl):
+    """ slow start, additive increase, multiplicative decrease (RFC 5681) """
+
+    def __init__(self, mss: int):
+        super().__init__(mss)
+        # initial window
+        self.cwnd = min(4 * mss, max(2 * mss, 4380))
+
+    def on_ack(self, acked: int, rtt: float = None):
+        # count bytes, not ACKs, so delayed ACKs grow it as fast (RFC 3465)
+        if self.cwnd < self.ssthresh:   # slow start
+            self.cwnd += acked
+        else:                           # congestion avoidance
+            self.cwnd += self.mss * acked / self.cwnd
+
+    def on_loss(self, flight: int):
+        self.ssthresh = max(flight / 2, 2 * self.mss)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, flight: int):
+        self.ssthresh = max(flight / 2, 2 * self.mss)
+        self.cwnd = self.mss
+
+
+class Cubic(Reno):
+    """ window grows as a cubic function of time since last loss (RFC 8312) """
+
+    C = .4
+    beta = .7
+
+    def __init__(self, mss: int):
+        super().__init__(mss)
+        self.w_max = 0.         # window before last reduction, in segments
+        self.epoch = None       # start of current congestion avoidance
+        self.k = 0.             # time to grow back to w_max
+        self.w_est = 0.         # window of Reno in the same time, in segments
+
+    def on_ack(self, acked: int, rtt: float = None):
+        if self.cwnd < self.ssthresh:   # slow start
+            self.cwnd += acked
+            return
+        cwnd = self.cwnd / self.mss
+        now = time.monotonic()
+        if self.epoch is None:
+            self.epoch = now
+            self.w_max = max(self.w_max, cwnd)
+            self.k = ((self.w_max - cwnd) / self.C) ** (1 / 3)
+            self.w_est = cwnd
+        # target a round trip ahead, grow at least as fast as Reno would
+        t = now - self.epoch + (rtt or 0.)
+        target = self.C * (t - self.k) ** 3 + self.w_max
+        self.w_est += 3 * (1 - self.beta) / (1 + self.beta) * acked / self.mss / cwnd
+        target = max(target, self.w_est)
+        if target > cwnd:
+            self.cwnd += self.mss * (target - cwnd) / cwnd * acked / self.mss
+
+    def _reduce(self):
+        cwnd = self.cwnd / self.mss
+        # fast convergence, release bandwidth to new flows
+        if cwnd < self.w_max:
+            self.w_max = cwnd * (1 + self.beta) / 2
+        else:
+            self.w_max = cwnd
+        self.epoch = None
+        self.ssthresh = max(self.cwnd * self.beta, 2 * self.mss)
+
+    def on_loss(self, flight: int):
+        self._reduce()
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, flight: int):
+        self._reduce()
+        self.cwnd = self.mss
+
+
+class Vegas(Reno):
+    """
+    delay based, keeps between alpha and beta segments queued in the path,
+    estimated by how far RTT rises above the lowest RTT seen
+    """
+
+    alpha = 2
+    beta = 4
+    gamma = 1
+
+    def __init__(self, mss: int):
+        super().__init__(mss)
+        self.base_rtt = float('inf')
+
+    def on_ack(self, acked: int, rtt: float = None):
+        if rtt is None:
+            return super().on_ack(acked, rtt)
+        self.base_rtt = min(self.base_rtt, rtt)
+        # segments queued = (expected - actual rate) * base_rtt
+        queued = self.cwnd / self.mss * (1 - self.base_rtt / rtt)
+        if self.cwnd < self.ssthresh:   # slow start, until a queue builds
+            if queued > self.gamma:
+                self.ssthresh = self.cwnd
+            else:
+                self.cwnd += acked
+        elif queued < self.alpha:       # path underused, one more per RTT
+            self.cwnd += self.mss * acked / self.cwnd
+        elif queued > self.beta:        # queue building, one less per RTT
+            self.cwnd = max(self.cwnd - self.mss * acked / self.cwnd,
+                            2 * self.mss)
+
+
+class Pacer:
+    """
+    token bucket spreading segments over RTT rather than sending a window
+    back to back, at a rate set explicitly or by cwnd / srtt, in bursts
+    of at most quantum seconds worth of bytes, or 2 segments
+    """
+
+    gain_ss = 2.            # of rate in slow start, so cwnd may double
+    gain_ca = 1.25          # of rate in congestion avoidance
+
+    def __init__(self, rate: float = 0., quantum: float = .001):
+        self.fixed = rate       # bytes per second, 0 to follow cwnd
+        self.rate = rate or float('inf')
+        self.quantum = quantum
+        self.tokens = 0.        # bytes that may be sent now
+        self.stamp = 0.         # when tokens were last counted
+
+    def __repr__(self):
+        return 'Pacer(rate={:.0f}, tokens={:.0f})'.format(self.rate, self.tokens)
+
+    def pace(self, cwnd: float, srtt: float, slow_start: bool = False):
+        """ follow congestion window, unless rate is fixed """
+        if not self.fixed:
+            gain = self.gain_ss if slow_start else self.gain_ca
+            self.rate = gain * cwnd / srtt
+
+    def take(self, size: int, now: float) -> float:
+        """
+        spend tokens for size bytes and return 0 if there are enough,
+        else return seconds until there will be
+        """
+        if self.rate == float('inf'):
+            return 0.
+        burst = max(self.rate * self.quantum, 2 * size)
+        self.tokens = min(self.tokens + (now - self.stamp) * self.rate, burst)
+        self.stamp = now
+        if self.tokens >= size:
+            self.tokens -= size
+            return 0.
+        return (size - self.tokens) / self.rate
+
+
+# congestion controls by name
+controls = {
+    'none' : CongestionControl,
+    'reno' : Reno,
+    'cubic': Cubic,
+    'vegas': Vegas,
+}
+
+
+if __name__ == '__main__':
+
+    # unit tests
+    for name, control in controls.items():
+        cc = control(mss=1000)
+        for _ in range(20):
+            cc.on_ack(1000, .1)
+        print(cc)
+        cc.on_loss(flight=20000)
+        print(cc)
+        for _ in range(20):
+            cc.on_ack(1000, .1)
+        cc.on_timeout(flight=20000)
+        print(cc)
+
+    pacer = Pacer()
+    pacer.pace(cwnd=10000, srtt=.1)
+    print(pacer)
+    print([pacer.take(1000, now=1.) for _ in range(3)])
+    pacer.pace(cwnd=10000, srtt=.1, slow_start=True)
+    print(pacer.take(1000, now=1.004), pacer)
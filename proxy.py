@@ -0,0 +1,186 @@
+import argparse
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import time
+
+
+#################
+# configuration #
+#################
+
+parser = argparse.ArgumentParser(description='UDP proxy impairing packets between client and server',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-a', '--host',         default='localhost',    type=str, help='proxy host')
+parser.add_argument('-p', '--port',         default=41192,          type=int, help='proxy port')
+parser.add_argument('-S', '--server-host',  default='localhost',    type=str, help='server host')
+parser.add_argument('-s', '--server-port',  default=41194,          type=int, help='server port')
+parser.add_argument('-B', '--buffer-size',  default=65536,          type=int, help='datagram buffer size')
+parser.add_argument('-l', '--loss',         default=0.,             type=float, help='loss rate')
+parser.add_argument('-c', '--corrupt',      default=0.,             type=float, help='rate of datagrams '
+                    'with a bit flipped')
+parser.add_argument('-o', '--reorder',      default=0.,             type=float, help='rate of datagrams '
+                    'held back behind those after them')
+parser.add_argument('-O', '--reorder-delay', default=.005,          type=float, help='extra delay of '
+                    'datagrams held back, in seconds')
+parser.add_argument('-u', '--duplicate',    default=0.,             type=float, help='rate of datagrams '
+                    'delivered twice')
+parser.add_argument('-d', '--delay',        default=0.,             type=float, help='one-way delay in seconds')
+parser.add_argument('-j', '--jitter',       default=0.,             type=float, help='delay varying up to '
+                    'this many seconds more, reordering datagrams too')
+parser.add_argument('-R', '--rate',         default=0.,             type=float, help='bandwidth in bytes '
+                    'per second each way, 0 for no cap')
+parser.add_argument('-q', '--queue-size',   default=0,              type=int, help='bytes queued for '
+                    'bandwidth before tail drop, 0 for no limit')
+parser.add_argument('-r', '--seed',         default=None,           type=int, help='random seed')
+
+
+########
+# link #
+########
+
+class Link:
+    """
+    one direction of the path, dropping, corrupting, reordering,
+    duplicating and delaying datagrams, at most rate bytes per second
+    through a queue of queue_size bytes, dropping the tail once full
+    """
+
+    def __init__(self, loss: float = 0., delay: float = 0.,
+                 corrupt: float = 0., reorder: float = 0.,
+                 reorder_delay: float = .005, duplicate: float = 0.,
+                 jitter: float = 0., rate: float = 0., queue_size: int = 0):
+        self.loss = loss
+        self.delay = delay
+        self.corrupt = corrupt
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.duplicate = duplicate
+        self.jitter = jitter
+        self.rate = rate
+        self.queue_size = queue_size
+        self._queue: list = list()  # heap of (due, n, datagram, sock, addr)
+        self._count = itertools.count()
+        self._idle = 0.         # when the last datagram is through at rate
+        self.stats = {'datagrams': 0, 'lost': 0, 'corrupted': 0,
+                      'reordered': 0, 'duplicated': 0, 'overflowed': 0}
+
+    def __repr__(self):
+        return 'Link(loss={}, delay={}, queued={})'.format(
+                self.loss, self.delay, len(self._queue))
+
+    def put(self, datagram: bytes, sock: socket.socket, addr: tuple,
+            now: float):
+        """ accept a datagram to be sent from sock to addr """
+        self.stats['datagrams'] += 1
+        if random.random() < self.loss:
+            self.stats['lost'] += 1
+            return
+        # wait behind datagrams queued for bandwidth, if any
+        start = now
+        if self.rate:
+            start = max(now, self._idle)
+            if self.queue_size and (start - now) * self.rate + len(datagram) > self.queue_size:
+                self.stats['overflowed'] += 1
+                return
+            self._idle = start + len(datagram) / self.rate
+            start = self._idle
+        datagram = bytearray(datagram)
+        if datagram and random.random() < self.corrupt:
+            self.stats['corrupted'] += 1
+            i = random.randrange(len(datagram) * 8)
+            datagram[i // 8] ^= 1 << i % 8
+        copies = 1
+        if random.random() < self.duplicate:
+            self.stats['duplicated'] += 1
+            copies = 2
+        for _ in range(copies):
+            due = start + self.delay + random.uniform(0, self.jitter)
+            if random.random() < self.reorder:
+                self.stats['reordered'] += 1
+                due += self.reorder_delay
+            heapq.heappush(self._queue, (due, next(self._count),
+                                         bytes(datagram), sock, addr))
+
+    @property
+    def deadline(self) -> float:
+        """ when the next datagram is due, inf if none """
+        return self._queue[0][0] if self._queue else float('inf')
+
+    def due(self, now: float) -> list:
+        """ pop datagrams due by now, as (datagram, sock, addr) """
+        datagrams = list()
+        while self._queue and self._queue[0][0] <= now:
+            _, _, datagram, sock, addr = heapq.heappop(self._queue)
+            datagrams.append((datagram, sock, addr))
+        return datagrams
+
+
+#############
+# main loop #
+#############
+
+def relay(args, forward: Link, reverse: Link):
+    """
+    relay datagrams from clients to server over forward link,
+    and back over reverse link, one upstream socket per client
+    """
+    server = (args.server_host, args.server_port)
+    buf = bytearray(args.buffer_size)
+    view = memoryview(buf)
+    upstreams: dict = dict()  # {client addr: upstream socket}
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as down, \
+         selectors.DefaultSelector() as sel:
+        down.setblocking(False)
+        down.bind((args.host, args.port))
+        sel.register(down, selectors.EVENT_READ, None)
+        try:
+            while True:
+                now = time.monotonic()
+                timeout = min(forward.deadline, reverse.deadline) - now
+                ready = sel.select(None if timeout == float('inf')
+                                   else max(timeout, 0))
+                now = time.monotonic()
+                for key, _ in ready:
+                    while True:
+                        try:
+                            n, addr = key.fileobj.recvfrom_into(buf)
+                        except BlockingIOError:
+                            break
+                        if key.fileobj is down:     # client -> server
+                            up = upstreams.get(addr)
+                            if up is None:
+                                up = upstreams[addr] = socket.socket(
+                                        socket.AF_INET, socket.SOCK_DGRAM)
+                                up.setblocking(False)
+                                up.bind((args.host, 0))
+                                sel.register(up, selectors.EVENT_READ, addr)
+                            forward.put(view[:n], up, server, now)
+                        else:                       # server -> client
+                            reverse.put(view[:n], down, key.data, now)
+                for datagram, sock, addr in forward.due(now) + reverse.due(now):
+                    try:
+                        sock.sendto(datagram, addr)
+                    except BlockingIOError:
+                        pass  # dropped, as a full router queue would
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for up in upstreams.values():
+                up.close()
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    random.seed(args.seed)
+    links = [Link(args.loss, args.delay, corrupt=args.corrupt,
+                  reorder=args.reorder, reorder_delay=args.reorder_delay,
+                  duplicate=args.duplicate, jitter=args.jitter,
+                  rate=args.rate, queue_size=args.queue_size)
+             for _ in range(2)]
+    relay(args, *links)
+    for name, link in zip(['forward', 'reverse'], links):
+        print(f"{name}: " + ", ".join(f"{v} {k}" for k, v in link.stats.items()))
@@ -1,6 +1,20 @@
 import argparse
+import multiprocessing
+import multiprocessing.connection
+import os
+import selectors
+import signal
 import socket
-from utils import encode, decode, TCPReceiverBuffer
+import sys
+import threading
+import time
+from utils import encode, decode, malformed, encode_options, decode_options, \
+                  encode_mss, encode_sack, encode_wscale, wscale, \
+                  encode_timestamp, decode_timestamp, timestamp, decode_transfer, \
+                  split_gro, drain, SOL_UDP, UDP_GRO, MAX_DATAGRAM_SIZE, \
+                  encode_resume, decode_resume, DIGEST, RESUME, SACK_PERM, TIMESTAMP, TRANSFER, WSCALE, \
+                  MAX_HEADER_SIZE, MAX_SACK_BLOCKS, MAX_WINDOW, \
+                  Checkpoint, Metrics, TCPReceiverSink
 
 
 #################
@@ -9,65 +23,669 @@ from utils import encode, decode, TCPReceiverBuffer
 
 parser = argparse.ArgumentParser(description='TCP server',
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('-f', '--file',         default='recv.txt',     type=str, help='file to receive')
+parser.add_argument('-f', '--file',         default='recv.txt',     type=str, help='file to receive, '
+                    'formatted with {host}, {port} of client and {n} of connection, '
+                    'both {port} and {n} of the first stripe if striped')
 parser.add_argument('-a', '--host',         default='localhost',    type=str, help='server host')
-parser.add_argument('-i', '--recv-port',    default=41194,          type=int, help='server recv port')
-parser.add_argument('-o', '--send-port',    default=41195,          type=int, help='server send port')
-parser.add_argument('-S', '--client-host',  default='localhost',    type=str, help='client host')
-parser.add_argument('-s', '--client-port',  default=41190,          type=int, help='client port')
+parser.add_argument('-p', '--port',         default=41194,          type=int, help='server port')
 parser.add_argument('-b', '--obuffer-size', default=2048,           type=int, help='send buffer size')
-parser.add_argument('-B', '--ibuffer-size', default=2048,           type=int, help='recv buffer size')
+parser.add_argument('-B', '--ibuffer-size', default=65535,          type=int, help='recv buffer size, '
+                    'bounding mss of clients')
+parser.add_argument('-R', '--rcvbuf',       default=0,              type=int, help='socket recv buffer size, '
+                    '0 for system default')
 parser.add_argument('-w', '--window-size',  default=65535,          type=int, help='recv window size')
+parser.add_argument('-W', '--batch-size',   default=1 << 20,        type=int, help='write batch size')
+parser.add_argument('-F', '--fsync',        default='never',        type=str, help='fsync policy',
+                    choices=['never', 'flush', 'close'])
+parser.add_argument('-D', '--ack-delay',    default=.04,            type=float, help='delay of ACKs for in-order data, '
+                    '0 to ACK every segment')
+parser.add_argument('-G', '--gro',          default=sys.platform == 'linux', action=argparse.BooleanOptionalAction,
+                    help='receive datagrams of a client coalesced in one call by UDP GRO')
+parser.add_argument('-t', '--timeout',      default=60.,            type=float, help='idle timeout')
+parser.add_argument('-c', '--connections',  default=1,              type=int, help='connections to serve '
+                    'before shutdown, 0 for no limit')
+parser.add_argument('-j', '--workers',      default=1,              type=int, help='receiver processes '
+                    'sharing server port')
+parser.add_argument('--resume',             action='store_true',    help='keep a checkpoint of each file '
+                    'in {file}.ckpt until it is complete, to resume its transfer after a crash or timeout')
+parser.add_argument('-K', '--checkpoint',   default=1 << 24,        type=int, help='bytes received between '
+                    'checkpoints')
+parser.add_argument('--trace',              default=0,              type=int, help='latest events to keep '
+                    'per connection, dumped to stderr on close or SIGUSR1, 0 for no tracing')
+parser.add_argument('--stats',              default='none',         type=str, help='stats of each connection '
+                    'to write to stderr on close or SIGUSR1', choices=['none', 'json', 'prometheus'])
+parser.add_argument('-v', '--verbose',      default=True,           action=argparse.BooleanOptionalAction,
+                    help='print connections as they open and close, and digests that mismatch')
+parser.set_defaults(worker=0)
+
+
+##############
+# connection #
+##############
+
+class Connection:
+    """ state of TCP receiver for one client """
+
+    def __init__(self, addr: tuple, f, window_size: int = 65535,
+                 batch_size: int = 1 << 20, fsync: str = 'never',
+                 ack_delay: float = .04, mss: int = 536,
+                 start: int = 0, size: int = 0, transfer: tuple = None,
+                 sink=None, metrics: Metrics = None, checkpoint: Checkpoint = None):
+        self.addr = addr
+        self.file = f
+        self._sink_options = dict(buffer_size=window_size,
+                                  batch_size=batch_size, fsync=fsync)
+        # set sink, write data at their offset as they arrive
+        # ... a stripe from its offset, into a file of its size
+        # ... or hand them to a reader, if a sink is given without file
+        self.sink = sink if sink is not None else \
+                    TCPReceiverSink(f, start=start, size=size, **self._sink_options)
+        self.start = start
+        self.transfer = transfer    # id of transfer, if a stripe of one
+        self.digest = None          # of data received, once FIN arrives
+        self.verified = None        # whether it matches the one of client, None if unknown
+        self.end = None             # seq_no of FIN
+        # set checkpoint, if file is kept to resume its transfer,
+        # from start if data below it were received before
+        self.checkpoint = checkpoint
+        self.send_base = 0
+        self.last_seq = start   # seq_no of the latest segment
+        # set options, as negotiated by SYN
+        self.shift = 0          # window scale of ACKs
+        self.mss = mss          # largest payload accepted
+        self.sack = False       # whether SACK is permitted
+        self.ts = False         # whether timestamps are on
+        self.ts_recent = 0      # timestamp of client to echo (RFC 7323)
+        self.options = b''      # options of SYN-ACK
+        self.offer = b''        # payload of SYN-ACK, digests of data kept if any
+        # set delayed ack
+        self.ack_delay = ack_delay
+        self.acked = start      # recv_base last ACKed
+        self.advertised = self.sink.window  # window last ACKed, unscaled
+        self.ack_due = float('inf')     # when to ACK data since acked
+        self.rcv_mss = 1        # largest payload seen
+        self.last_active = time.monotonic()
+        # set counters, and trace of events if any
+        self.metrics = metrics if metrics is not None else Metrics()
+
+    def __repr__(self):
+        return 'Connection(addr={}, recv_base={})'.format(
+                self.addr, self.recv_base)
+
+    @property
+    def recv_base(self) -> int:
+        return self.sink.recv_base
+
+    @property
+    def window(self) -> int:
+        """ window field of ACKs, free space scaled down """
+        return min(self.sink.window >> self.shift, MAX_WINDOW)
+
+    @property
+    def reopened(self) -> bool:
+        """
+        whether the window last ACKed was less than a segment, and is
+        no longer, as a reader freed space, so client waits for an update
+        """
+        return self.advertised < self.rcv_mss <= self.sink.window
+
+    def open(self, header):
+        """ handle a SYN, agree on options for SYN-ACK """
+        self.last_active = time.monotonic()
+        options = decode_options(header.options)
+        agreed = [encode_mss(self.mss)]
+        if WSCALE in options:
+            self.shift = wscale(self.sink.max_size)
+            agreed.append(encode_wscale(self.shift))
+        if SACK_PERM in options:
+            self.sack = True
+            agreed.append((SACK_PERM, b''))
+        if TIMESTAMP in options:
+            self.ts = True
+            self.ts_recent = decode_timestamp(options[TIMESTAMP])[0]
+            agreed.append(encode_timestamp(timestamp(), self.ts_recent))
+        # offer data kept, by digests of groups of chunks, for client
+        # to resume where they stop agreeing with its own
+        if RESUME in options and self.checkpoint is not None and self.start:
+            group, self.offer = self.checkpoint.offer()
+            agreed.append(encode_resume(self.start, group))
+        self.options = encode_options(agreed)
+
+    def later(self, header) -> bool:
+        """
+        whether a segment was sent after the latest one received,
+        by timestamps, None if either has none
+        """
+        options = decode_options(header.options)
+        if not self.ts or TIMESTAMP not in options:
+            return None
+        tsval = decode_timestamp(options[TIMESTAMP])[0]
+        return 0 < (tsval - self.ts_recent) & 0xffffffff < 1 << 31
+
+    def restarted(self, header) -> bool:
+        """
+        whether a SYN is from a client started again on the same address,
+        rather than one re-sent, as it is later than data received
+        """
+        if self.recv_base == self.start and not self.sink.pending:
+            return False
+        return self.later(header) is True
+
+    def rewind(self, seq_no: int):
+        """ receive from seq_no after all, as client found data from there differ """
+        self.file.truncate(seq_no)
+        self.sink = TCPReceiverSink(self.file, start=seq_no, **self._sink_options)
+        self.start = self.acked = self.last_seq = seq_no
+        self.checkpoint.truncate(seq_no)
+
+    def recv(self, header, payload: bytes) -> bool:
+        """
+        handle an intact packet, return whether to ACK it at once,
+        else set when to ACK it (RFC 5681)
+        """
+        now = self.last_active = time.monotonic()
+        metrics = self.metrics
+        metrics.counts['segments_received'] += 1
+        metrics.counts['bytes_received'] += len(payload)
+        if metrics.tracing:
+            metrics.trace('recv', header.seq_no, len(payload))
+        # client resumes below start, where data stop agreeing,
+        # telling so in segments until one is ACKed
+        if self.checkpoint is not None and self.recv_base == self.start and header.options:
+            resume = decode_options(header.options).get(RESUME)
+            seq_no = decode_resume(resume)[0] if resume else None
+            if seq_no is not None and seq_no < self.start:
+                if metrics.tracing:
+                    metrics.trace('rewind', self.start, seq_no)
+                self.rewind(seq_no)
+        # out-of-order, duplicate or filling a gap, ACK at once
+        immediate = header.seq_no != self.recv_base or self.sink.pending
+        if header.seq_no > self.recv_base:
+            metrics.ooo_high = max(metrics.ooo_high,
+                                   header.seq_no + len(payload) - self.recv_base)
+        # sink discards duplicates, and copies what it keeps
+        # out of the receive buffer, which is reused for the next packet
+        self.sink.push(header.seq_no, payload)
+        self.last_seq = header.seq_no
+        if self.checkpoint is not None:
+            self.checkpoint.update(self.sink)
+        self.rcv_mss = max(self.rcv_mss, len(payload))
+        # echo timestamp of the earliest segment since last ACK,
+        # so delays and losses count in RTT of client
+        if self.ts and header.seq_no <= self.acked and header.options:
+            options = decode_options(header.options)
+            if TIMESTAMP in options:
+                self.ts_recent = decode_timestamp(options[TIMESTAMP])[0]
+        if immediate or not self.ack_delay:
+            return True
+        # in order, ACK every second full segment once the batch is drained,
+        # or half a window if smaller, or a lone one after delay
+        if self.recv_base - self.acked >= min(2 * self.rcv_mss,
+                                              self.sink.max_size // 2):
+            self.ack_due = 0.
+        else:
+            self.ack_due = min(self.ack_due, now + self.ack_delay)
+        return False
+
+    def ack_sent(self, size: int):
+        """ an ACK of recv_base of size bytes is sent, nothing is due """
+        self.metrics.counts['segments_sent'] += 1
+        self.metrics.counts['bytes_sent'] += size
+        if self.metrics.tracing:
+            self.metrics.trace('ack', self.recv_base)
+        self.acked = self.recv_base
+        self.advertised = self.sink.window
+        self.ack_due = float('inf')
+
+    def sack_blocks(self) -> list:
+        """
+        out-of-order ranges to report in SACK option, the one holding
+        the latest segment first, then the lowest ones (RFC 2018)
+        """
+        ranges = self.sink.ranges
+        latest = [r for r in ranges if r[0] <= self.last_seq < r[1]]
+        others = [r for r in ranges if r not in latest]
+        return (latest + others)[:MAX_SACK_BLOCKS]
+
+    def ack_options(self) -> bytes:
+        """ options of ACKs, timestamp and out-of-order ranges if any """
+        options = list()
+        if self.ts:
+            options.append(encode_timestamp(timestamp(), self.ts_recent))
+        blocks = self.sack_blocks() if self.sack else None
+        if blocks:  # 3 blocks fit along with a timestamp
+            options.append(encode_sack(blocks, 3 if self.ts else MAX_SACK_BLOCKS))
+        elif self.digest is not None:
+            options.append((DIGEST, self.digest))
+        return encode_options(options)
+
+    def finish(self, header):
+        """ handle a FIN, digest data received to match the one of client """
+        self.last_active = time.monotonic()
+        self.digest = self.sink.digest(self.start, header.seq_no)
+        self.end = header.seq_no
+        expected = decode_options(header.options).get(DIGEST)
+        if expected is not None and self.digest is not None:
+            self.verified = expected == self.digest
+
+    def close(self):
+        """ close file, and save checkpoint if FIN has not arrived """
+        if self.checkpoint is not None and self.end is None:
+            self.checkpoint.update(self.sink, force=True)
+        self.sink.close()
+        if self.checkpoint is not None and self.end is not None:
+            # trim space preallocated by a transfer resumed
+            self.file.truncate(self.end)
+            self.checkpoint.remove()
+        if self.file is not None:
+            self.file.close()
+
+
+##########
+# server #
+##########
+
+class Server:
+    """
+    state of TCP receiver for all clients, demultiplexing datagrams by
+    address into connections, and ACKing them in batches by sendto
+    """
+
+    def __init__(self, args, sendto, report=None, sink=None):
+        self.args = args
+        self.sendto = sendto    # sendto(segment, addr), may raise BlockingIOError
+        self.report = report    # report(event, addr), of open and close
+        self.sink = sink        # sink(addr, start), to receive into, not files
+        self.connections: dict = dict()     # {addr: Connection}
+        self.finished: dict = dict()        # {addr: Connection}, closed by FIN, if it is re-sent
+        self.stats = {'opened': 0, 'closed': 0, 'segments': 0, 'bytes': 0,
+                      'acks': 0, 'reads': 0, 'failures': 0, 'resets': 0}
+        # set reusable buffer for encoding
+        self._obuf = bytearray(args.obuffer_size // MAX_HEADER_SIZE * MAX_HEADER_SIZE)
+        self._acks: list = list()   # acks encoded into obuf but not yet sent
+
+    def __repr__(self):
+        return 'Server(port={}, connections={})'.format(
+                self.args.port, len(self.connections))
+
+    @property
+    def deadline(self) -> float:
+        """ when an ACK is due or a connection idles out """
+        return min([min(c.ack_due, c.last_active + self.args.timeout)
+                    for c in self.connections.values()], default=float('inf'))
+
+    def ack(self, addr: tuple, conn: Connection, SYN: bool = False, FIN: bool = False):
+        """ encode an ACK of conn into obuf, send them all if it is full """
+        payload = b''
+        if SYN:     # window field of SYN-ACK is never scaled
+            window = min(conn.sink.window, MAX_WINDOW)
+            options = conn.options
+            payload = conn.offer
+        else:
+            window = conn.window
+            options = conn.ack_options()
+        segment = encode(
+            payload=payload,
+            src_port=self.args.port,
+            dst_port=addr[1],
+            seq_no=conn.send_base,
+            ack_no=conn.recv_base,
+            window=window,
+            ACK=True,
+            SYN=SYN,
+            FIN=FIN,
+            options=options,
+            buf=None if payload else self._obuf,
+            offset=0 if payload else len(self._acks) * MAX_HEADER_SIZE,
+            verbose=True
+        )
+        self._acks.append((segment, addr))
+        conn.ack_sent(len(segment))
+        if len(self._acks) * MAX_HEADER_SIZE == len(self._obuf):
+            self.flush()
+
+    def reset(self, addr: tuple, header, size: int):
+        """ answer a segment of no connection by RST, at once """
+        segment = encode(
+            payload=b'',
+            src_port=self.args.port,
+            dst_port=addr[1],
+            seq_no=header.ack_no,
+            ack_no=header.seq_no + size,
+            ACK=True,
+            RST=True
+        )
+        try:
+            self.sendto(segment, addr)
+        except BlockingIOError:
+            return
+        self.stats['resets'] += 1
+
+    def flush(self):
+        """ send acks in a batch """
+        # acks are cumulative, drop the rest if the socket is full
+        for segment, addr in self._acks:
+            try:
+                self.sendto(segment, addr)
+            except BlockingIOError:
+                break
+            self.stats['acks'] += 1
+        self._acks.clear()
+
+    def accept(self, addr: tuple, header) -> Connection:
+        """ open a connection, into a file of its own, or shared by stripes """
+        args = self.args
+        checkpoint = None
+        transfer = decode_options(header.options).get(TRANSFER) if header.SYN else None
+        if self.sink is not None:
+            # stream to a reader in memory, from the offset of SYN
+            path, f, start, size = 'stream', None, header.seq_no, 0
+            if transfer is not None:
+                transfer = decode_transfer(transfer)[0]
+        elif transfer is None:
+            # number connections apart across workers
+            n = self.stats['opened'] * args.workers + args.worker
+            path = args.file.format(host=addr[0], port=addr[1], n=n)
+            f, start, size = None, 0, 0
+            # keep data received before if client asks to resume,
+            # and there is a checkpoint of them
+            if args.resume:
+                checkpoint = Checkpoint(path + '.ckpt', interval=args.checkpoint)
+                if header.SYN and RESUME in decode_options(header.options) \
+                        and checkpoint.load() and os.path.exists(path) \
+                        and os.path.getsize(path) >= checkpoint.recv_base:
+                    f, start = open(path, 'r+b'), checkpoint.recv_base
+                else:
+                    checkpoint.truncate(0)
+            if f is None:
+                f = open(path, 'w+b')     # read back to digest
+        else:
+            # stripes write their own range of one file, never truncating it
+            transfer, size = decode_transfer(transfer)
+            path = args.file.format(host=addr[0], port=transfer, n=transfer)
+            f = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+            start = header.seq_no
+        if args.verbose:
+            print(f"connection from {addr} to {path}"
+                  + (f" at {start}" if transfer is not None or start else ""))
+        conn = Connection(addr, f, window_size=args.window_size,
+                          batch_size=args.batch_size, fsync=args.fsync,
+                          ack_delay=args.ack_delay,
+                          mss=args.ibuffer_size - MAX_HEADER_SIZE,
+                          start=start, size=size, transfer=transfer,
+                          sink=self.sink(addr, start) if self.sink is not None else None,
+                          metrics=Metrics(args.trace), checkpoint=checkpoint)
+        self.stats['opened'] += 1
+        if self.report is not None:
+            self.report('open', addr)
+        return conn
+
+    def close(self, addr: tuple, event: str):
+        conn = self.connections.pop(addr)
+        if self.args.verbose:
+            print(f"connection from {addr} {event} at {conn.recv_base}")
+        self.dump(addr, conn)
+        conn.close()
+        self.stats['closed'] += 1
+        if self.report is not None:
+            self.report('close', addr)
+
+    def recv(self, datagram: bytes, addr: tuple):
+        """ handle a datagram from addr """
+        # drop datagrams too short to decode, e.g. stray ones sent to the port
+        if malformed(datagram):
+            self.stats['failures'] += 1
+            return
+        checksum, header, payload = decode(datagram, verbose=True)
+        if checksum:
+            conn = self.connections.get(addr)
+            if conn is not None:
+                conn.metrics.counts['checksum_failures'] += 1
+                if conn.metrics.tracing:
+                    conn.metrics.trace('corrupt', header.seq_no)
+            return  # discard corrupted packets
+        self.stats['segments'] += 1
+        self.stats['bytes'] += len(payload)
+        conn = self.connections.get(addr)
+        if conn is not None and header.SYN and conn.restarted(header):
+            self.close(addr, 'restarted')
+            conn = None
+        if conn is None:
+            finished = self.finished.get(addr)
+            if header.FIN:
+                # FIN re-sent after close, as FIN-ACK was lost
+                if finished is not None:
+                    self.ack(addr, finished, FIN=True)
+                return
+            # only SYN opens a connection, as opening its file truncates it,
+            # so stray segments of one closed, or of one before the server
+            # restarted, are reset, for client to give up or connect again,
+            # and a SYN re-sent before close is dropped
+            if not header.SYN:
+                self.reset(addr, header, len(payload))
+                return
+            if finished is not None and finished.later(header) is False:
+                return
+            conn = self.connections[addr] = self.accept(addr, header)
+        if header.SYN:
+            # answer SYN, or a SYN re-sent if SYN-ACK was lost
+            conn.open(header)
+            self.ack(addr, conn, SYN=True)
+            return
+        immediate = conn.recv(header, payload)
+        if header.FIN:
+            # verify data, answer by FIN-ACK with digest of server
+            conn.finish(header)
+            if conn.verified is False and self.args.verbose:
+                print(f"digest mismatch from {addr} in [{conn.start}, {conn.end})")
+            self.ack(addr, conn, FIN=True)
+            self.close(addr, 'closed')
+            self.finished[addr] = conn
+            if len(self.finished) > 1024:
+                del self.finished[next(iter(self.finished))]
+        elif immediate:
+            self.ack(addr, conn)
+
+    def expire(self, now: float):
+        """
+        ACK in-order data due, coalesced to the latest recv_base,
+        or a window reopened, close idle connections, in case FIN gets
+        lost or corrupted
+        """
+        for addr, conn in list(self.connections.items()):
+            if conn.ack_due <= now or conn.reopened:
+                self.ack(addr, conn)
+            elif conn.last_active + self.args.timeout <= now:
+                self.close(addr, 'timeout')
+
+    def dump(self, addr: tuple, conn: Connection):
+        """ write trace of events of conn if any, then stats if asked, to stderr """
+        label = f'{addr[0]}:{addr[1]} '
+        if conn.metrics.tracing:
+            conn.metrics.dump(sys.stderr, label)
+        if self.args.stats != 'none':
+            print(conn.metrics.export(self.args.stats, host=addr[0], port=addr[1]),
+                  file=sys.stderr)
+
+    def dump_all(self):
+        """ dump every open connection, on demand """
+        for addr, conn in list(self.connections.items()):
+            self.dump(addr, conn)
+
+    def shutdown(self):
+        """ close connections left """
+        for addr in list(self.connections):
+            self.close(addr, 'aborted')
 
 
 #############
 # main loop #
 #############
 
+def serve(sock: socket.socket, args, control=None, sink=None,
+          wakeup: socket.socket = None) -> dict:
+    """
+    receive files from clients until enough connections are closed,
+    or if a control pipe is given, until told to stop over it,
+    or if sink is given, receive into sink(addr, start) rather than files,
+    woken by wakeup once a reader of sink frees space, to update windows
+    """
+    server = Server(args, sock.sendto, sink=sink,
+                    report=(lambda event, addr: control.send((event, addr)))
+                    if control is not None else None)
+    stats = server.stats
+    if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, lambda *_: server.dump_all())
+    # set reusable buffer for decoding
+    # ... large enough for datagrams coalesced by GRO
+    ibuf = bytearray(max(args.ibuffer_size, MAX_DATAGRAM_SIZE) if args.gro
+                     else args.ibuffer_size)
+    view = memoryview(ibuf)
+    ancbufsize = socket.CMSG_SPACE(4)   # size of datagrams coalesced
+
+    with selectors.DefaultSelector() as sel:
+        sel.register(sock, selectors.EVENT_READ)
+        if control is not None:
+            sel.register(control, selectors.EVENT_READ)
+        if wakeup is not None:
+            sel.register(wakeup, selectors.EVENT_READ)
+        while not args.connections or stats['closed'] < args.connections:
+            # wait until an ACK is due or a connection idles out
+            timeout = min(server.deadline - time.monotonic(), args.timeout)
+            ready = sel.select(max(timeout, 0))
+            if not ready and not server.connections and args.connections:
+                if args.verbose:
+                    print("timeout.")
+                break
+            if any(key.fileobj is control for key, _ in ready):
+                control.recv()
+                break  # told to stop
+            if any(key.fileobj is wakeup for key, _ in ready):
+                drain(wakeup)   # windows reopened are ACKed by expire
+            # receive packets, until none is pending
+            while True:
+                try:
+                    if args.gro:
+                        n, ancdata, _, addr = sock.recvmsg_into([ibuf], ancbufsize)
+                    else:
+                        n, addr = sock.recvfrom_into(ibuf)
+                        ancdata = []
+                except BlockingIOError:
+                    break
+                stats['reads'] += 1
+                for datagram in split_gro(view[:n], ancdata):
+                    server.recv(datagram, addr)
+            server.expire(time.monotonic())
+            server.flush()
+        server.shutdown()
+    return stats
+
+
+def bind(args) -> socket.socket:
+    """ bind a socket to server port, shared by workers if any """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    if args.workers > 1:  # kernel hashes each client to one worker
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if args.rcvbuf:  # absorb bursts from concurrent clients
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, args.rcvbuf)
+    if args.gro:  # datagrams are read one by one if kernel does not support it
+        try:
+            sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+        except OSError:
+            pass
+    sock.bind((args.host, args.port))
+    return sock
+
+
+###########
+# workers #
+###########
+
+def work(args, control):
+    """ receiver process, serving until told to stop """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # parent stops workers
+    with bind(args) as sock:
+        stats = serve(sock, args, control)
+    control.send(('stats', stats))
+
+
+def supervise(args) -> list:
+    """
+    fork workers sharing server port, count connections across them
+    until enough are closed, then stop them and collect their stats
+    """
+    controls, procs = list(), list()
+    for i in range(args.workers):
+        control, child = multiprocessing.Pipe()
+        worker_args = argparse.Namespace(**{**vars(args),
+                                            'connections': 0, 'worker': i})
+        proc = multiprocessing.Process(target=work, args=(worker_args, child))
+        proc.start()
+        child.close()
+        controls.append(control)
+        procs.append(proc)
+    stats: list = [None] * args.workers
+    opened = closed = 0
+
+    def handle(i: int, message: tuple):
+        nonlocal opened, closed
+        event, value = message
+        if event == 'open':
+            opened += 1
+        elif event == 'close':
+            closed += 1
+        elif event == 'stats':
+            stats[i] = value
+
+    alive = set(range(args.workers))
+    try:
+        while alive and not (args.connections and closed >= args.connections):
+            waitables = [controls[i] for i in alive] + \
+                        [procs[i].sentinel for i in alive]
+            ready = multiprocessing.connection.wait(waitables, args.timeout)
+            if not ready and opened == closed and args.connections:
+                print("timeout.")
+                break
+            for i in list(alive):
+                if controls[i] in ready:
+                    try:
+                        handle(i, controls[i].recv())
+                    except EOFError:
+                        pass
+                if procs[i].sentinel in ready:
+                    procs[i].join()
+                    print(f"worker {i} exited with {procs[i].exitcode}")
+                    alive.discard(i)
+    except KeyboardInterrupt:
+        pass
+    # stop workers, and drain their events until their stats arrive
+    for i in alive:
+        controls[i].send('stop')
+    for i in alive:
+        try:
+            while stats[i] is None:
+                handle(i, controls[i].recv())
+        except EOFError:
+            pass
+        procs[i].join()
+    return stats
+
+
 if __name__ == '__main__':
 
     args = parser.parse_args()
-    buf = TCPReceiverBuffer(buffer_size=args.window_size)
-
-    with open(args.file, 'wb') as f, \
-         socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as si, \
-         socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as so:
-        # set sockets
-        si.settimeout(60)  # in case FIN gets lost or corrupted
-        si.bind((args.host, args.recv_port))
-        so.bind((args.host, args.send_port))
-        recv_base = 0
-        send_base = 0
-        while True:
-            print(f"waiting for {recv_base}")
-            segment, _ = si.recvfrom(args.ibuffer_size)
-            checksum, header_s, payload = decode(segment, verbose=True)
-            if checksum:
-                print(f"error detected at {header_s['seq_no']}")
-                pass  # discard corrupted packets
-            elif header_s['seq_no'] < recv_base:
-                pass  # discard duplicate packets
-            elif header_s['seq_no'] > recv_base:
-                # push out-of-order packets to buffer
-                buf.push(header_s['seq_no'], payload)
-            else: # accept intact, in-order packets
-                # pop from buffer, and append to payload
-                payload += buf.pop(recv_base+len(payload))
-                f.write(payload)
-                f.flush()
-                recv_base += len(payload)
-            if header_s['FIN']:
-                break
-            # assemble ack packet
-            ack = encode(
-                payload=b'',
-                src_port=args.send_port,
-                dst_port=args.client_port,
-                seq_no=send_base,
-                ack_no=recv_base,
-                ACK=True,
-                verbose=True
-            )
-            so.sendto(ack, (args.client_host, args.client_port))
+
+    if args.workers > 1:
+        stats = supervise(args)
+        print(f"{'worker':>6} {'connections':>11} {'segments':>10} {'reads':>10} {'bytes':>12} {'acks':>10}")
+        for i, s in enumerate(stats):
+            if s is not None:
+                print(f"{i:>6} {s['opened']:>11} {s['segments']:>10} {s['reads']:>10} {s['bytes']:>12} {s['acks']:>10}")
+    else:
+        with bind(args) as sock:
+            s = serve(sock, args)
+        print(f"received {s['segments']} segments in {s['reads']} reads, "
+              f"sent {s['acks']} acks.")
 
     print("server shutdown.")
@@ -0,0 +1,707 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+import client
+import server
+from congestion import Pacer
+from utils import TCPSenderBuffer, TCPSenderStream, TCPReceiverStream
+
+
+log = logging.getLogger(__name__)  # of errors, as the embedding program configures it
+
+
+##########
+# socket #
+##########
+
+def check_end(sock, sending: bool):
+    """ raise OSError unless sock is open and the sending end, or receiving """
+    if sock.sending != sending:
+        raise OSError('not the {} end'.format('sending' if sending
+                                              else 'receiving'))
+    if sock._closed:
+        raise OSError('socket closed')
+
+
+def file_chunks(f, offset: int = 0, count: int = None, chunk_size: int = 1 << 16):
+    """
+    read count bytes of file from offset, all if None, chunk by chunk,
+    into one buffer, each chunk is overwritten by the next one
+    """
+    f.seek(offset)
+    view = memoryview(bytearray(chunk_size))
+    read = 0
+    while count is None or read < count:
+        n = f.readinto(view[:chunk_size if count is None
+                            else min(chunk_size, count - read)])
+        if not n:
+            break
+        yield view[:n]
+        read += n
+
+
+class TcupSocket:
+    """
+    one end of a connection, streaming data in memory rather than files,
+    sending if made by connect, receiving if made by TcupListener.accept
+    its engine runs on a thread of its own, writers block while the send
+    buffer is full, readers while nothing is received
+    """
+
+    stall_timeout = 30.     # close gives up once nothing is ACKed for as long
+
+    def __init__(self, stream, engine: threading.Thread = None,
+                 wakeup: socket.socket = None, sender: client.Sender = None):
+        self._stream = stream   # TCPSenderStream or TCPReceiverStream
+        self._engine = engine   # thread driving sender, if sending
+        self._wakeup = wakeup   # written to once data are written
+        self._sender = sender
+        self._closed = False
+
+    def __repr__(self):
+        return 'TcupSocket({})'.format(self._sender or self._stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def sending(self) -> bool:
+        return self._sender is not None
+
+    @property
+    def verified(self) -> bool:
+        """ whether digests of both ends match, None if unknown """
+        return self._sender.verified if self.sending else None
+
+    # send #
+
+    def send(self, data, timeout: float = None) -> int:
+        """
+        write as much of data as the send buffer holds, waiting until
+        any of it fits, return bytes written
+        """
+        check_end(self, sending=True)
+        if not self._engine.is_alive():
+            raise ConnectionError('connection given up on')
+        n = self._stream.write(data, timeout)
+        self._wake()
+        return n
+
+    def sendall(self, data, timeout: float = None):
+        """ write all of data, waiting as long as the window is full """
+        view = memoryview(data).cast('B')
+        while view:
+            view = view[self.send(view, timeout):]
+
+    def sendfile(self, f, offset: int = 0, count: int = None,
+                 chunk_size: int = 1 << 16) -> int:
+        """ write count bytes of file from offset, all if None, return bytes sent """
+        sent = 0
+        for chunk in file_chunks(f, offset, count, chunk_size):
+            self.sendall(chunk)
+            sent += len(chunk)
+        return sent
+
+    # receive #
+
+    def recv_into(self, buffer, nbytes: int = 0, timeout: float = None) -> int:
+        """ read up to nbytes into buffer, return bytes read, 0 at end """
+        check_end(self, sending=False)
+        view = memoryview(buffer).cast('B')
+        return self._stream.read_into(view[:nbytes or len(view)], timeout)
+
+    def recv(self, bufsize: int, timeout: float = None) -> bytes:
+        buf = bytearray(bufsize)
+        return bytes(buf[:self.recv_into(buf, timeout=timeout)])
+
+    def chunks(self, chunk_size: int = 1 << 16):
+        """ iterate over data received, chunk by chunk, until end """
+        buf = bytearray(chunk_size)
+        while n := self.recv_into(buf):
+            yield bytes(buf[:n])
+
+    def __iter__(self):
+        return self.chunks()
+
+    # close #
+
+    def close(self, timeout: float = None):
+        """
+        if sending, send FIN once data written are all sent, and wait for
+        FIN-ACK up to timeout, as long as data keep being ACKed, raise
+        TimeoutError if they stall, if receiving, stop reading
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self.sending:
+            self._stream.write_eof()
+            self._wake()
+            now = time.monotonic()
+            deadline = now + timeout if timeout is not None else float('inf')
+            acked, since = self._sender.send_base, now
+            while self._engine.is_alive() and now < deadline:
+                self._engine.join(min(deadline - now, 1.))
+                now = time.monotonic()
+                if self._sender.send_base != acked:
+                    acked, since = self._sender.send_base, now
+                elif now - since >= self.stall_timeout and not self._stream.drained(0):
+                    # nobody reads, or peer is gone, give up on the engine
+                    self._sender.finished = True
+                    self._wake()
+                    self._engine.join(1.)
+                    self._wakeup.close()
+                    raise TimeoutError('nothing ACKed for {} s'.format(self.stall_timeout))
+            self._wakeup.close()
+
+    def _wake(self):
+        try:
+            self._wakeup.send(b'\x00')
+        except BlockingIOError:
+            pass    # engine is already woken up
+
+
+def open_sender(sbuf, address: tuple, host: str = 'localhost', port: int = 0,
+                mss: int = 1024, window_size: int = 1 << 20, batch_size: int = 64,
+                cc: str = 'reno', max_mss: int = 0, timestamps: bool = True,
+                rate: float = 0., pace: bool = False) -> tuple:
+    """ bind a non-blocking socket, return it and a sender of sbuf over it """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    sock.bind((host, port))
+    sender = client.Sender(sbuf, src_port=sock.getsockname()[1],
+                           dst_port=address[1], mss=mss,
+                           window_size=window_size, batch_size=batch_size,
+                           cc=cc, max_mss=max_mss, timestamps=timestamps,
+                           pacer=Pacer(rate) if pace or rate else None)
+    return sock, sender
+
+
+def connect(address: tuple, buffer_size: int = 0,
+            gso: bool = sys.platform == 'linux', ibuffer_size: int = 2048,
+            **options) -> TcupSocket:
+    """
+    open a connection to server at address, sending data written to it,
+    buffer_size bounds data written but not yet ACKed, window plus mss if 0,
+    options as of open_sender
+    """
+    stream = TCPSenderStream(buffer_size or options.get('window_size', 1 << 20)
+                             + options.get('mss', 1024))
+    sock, sender = open_sender(stream, address, **options)
+    wakeup, waker = socket.socketpair()
+    wakeup.setblocking(False)
+    waker.setblocking(False)
+
+    def drive():
+        with sock, wakeup:
+            client.run(sock, sender, address, ibuffer_size, gso, wakeup)
+        stream.close()
+
+    engine = threading.Thread(target=drive, name='tcup-sender', daemon=True)
+    engine.start()
+    return TcupSocket(stream, engine, waker, sender)
+
+
+############
+# listener #
+############
+
+def bind_listener(address: tuple, window_size: int = 65535,
+                  ibuffer_size: int = 65535, ack_delay: float = .04,
+                  timeout: float = 60., rcvbuf: int = 0,
+                  gro: bool = False) -> tuple:
+    """
+    bind server port at address, return it and arguments of server for it,
+    as parsed from the command line, serving any number of connections,
+    printing none
+    """
+    args = argparse.Namespace(**{
+        **vars(server.parser.parse_args([])),
+        'host': address[0], 'port': address[1],
+        'window_size': window_size, 'ibuffer_size': ibuffer_size,
+        'ack_delay': ack_delay, 'timeout': timeout, 'rcvbuf': rcvbuf,
+        'gro': gro, 'connections': 0, 'verbose': False})
+    sock = server.bind(args)
+    args.port = sock.getsockname()[1]  # if ephemeral
+    return sock, args
+
+
+class TcupListener:
+    """
+    server port handing each connection to a reader, as a TcupSocket
+    connections queue up as in a listen backlog until they are accepted
+    """
+
+    def __init__(self, address: tuple, window_size: int = 65535,
+                 ibuffer_size: int = 65535, ack_delay: float = .04,
+                 timeout: float = 60., rcvbuf: int = 0,
+                 gro: bool = sys.platform == 'linux'):
+        self._sock, self._args = bind_listener(address, window_size, ibuffer_size,
+                                               ack_delay, timeout, rcvbuf, gro)
+        self.address = (self._args.host, self._args.port)
+        self._streams: dict = dict()    # {addr: TCPReceiverStream}, not yet accepted
+        self._control, control = multiprocessing.Pipe()
+        self._lock = threading.Lock()   # one acceptor reads control at a time
+        # readers freeing space wake the engine up, to update the window
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+        self.stats = None
+        self._engine = threading.Thread(target=self._serve, args=(control,),
+                                        name='tcup-listener', daemon=True)
+        self._engine.start()
+
+    def __repr__(self):
+        return 'TcupListener({})'.format(self.address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _sink(self, addr: tuple, start: int) -> TCPReceiverStream:
+        stream = self._streams[addr] = TCPReceiverStream(
+                self._args.window_size, start, wake=self._wake)
+        return stream
+
+    def _wake(self):
+        try:
+            self._waker.send(b'\x00')
+        except OSError:
+            pass    # engine is already woken up, or gone
+
+    def _serve(self, control):
+        with self._sock, self._wakeup:
+            self.stats = server.serve(self._sock, self._args, control,
+                                      sink=self._sink, wakeup=self._wakeup)
+        control.close()
+
+    def accept(self, timeout: float = None) -> tuple:
+        """
+        wait for a connection, return (TcupSocket, address of client),
+        raise TimeoutError if none in time
+        """
+        with self._lock:
+            while True:
+                if not self._control.poll(timeout):
+                    raise TimeoutError('no connection')
+                try:
+                    event, addr = self._control.recv()
+                except EOFError:
+                    raise OSError('listener closed') from None
+                if event == 'open':
+                    return TcupSocket(self._streams.pop(addr)), addr
+
+    def close(self):
+        """ stop serving, readers of connections left get what has arrived """
+        if self._engine.is_alive():
+            try:
+                self._control.send('stop')
+            except OSError:
+                pass
+            self._engine.join()
+        self._control.close()
+        self._waker.close()
+
+
+###########
+# asyncio #
+###########
+
+class SenderProtocol(asyncio.DatagramProtocol):
+    """
+    drive a sender by datagrams and timers of an asyncio loop, rather
+    than by a select loop, until FIN is ACKed, or given up on
+    """
+
+    def __init__(self, sender: client.Sender, addr: tuple):
+        self.sender = sender
+        self.addr = addr
+        self.transport = None
+        self.calls = 0          # segments handed to transport
+        self.finished = asyncio.get_running_loop().create_future()
+        self.writable = None    # future of a writer waiting for space
+        self._timer = None      # handle of the next timer due
+        self._pending = False   # whether a pump is scheduled
+        self._paused = False    # whether transport buffer is full
+
+    def __repr__(self):
+        return 'SenderProtocol({})'.format(self.sender)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.pump()
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        self.sender.recv(data)
+        self.wake()
+
+    def error_received(self, exc: Exception):
+        log.warning('error from %s, %s', self.addr, exc)
+
+    def connection_lost(self, exc: Exception):
+        if self._timer is not None:
+            self._timer.cancel()
+        if not self.finished.done():
+            self.finished.set_result(self.sender.verified)
+        if self.writable is not None and not self.writable.done():
+            self.writable.set_result(None)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self.wake()
+
+    def wake(self):
+        """ pump once datagrams ready are all received """
+        if not self._pending:
+            self._pending = True
+            asyncio.get_running_loop().call_soon(self.pump)
+
+    def pump(self):
+        """ handle timers due, send segments until none may be sent """
+        self._pending = False
+        if self.transport is None or self.transport.is_closing():
+            return
+        sender = self.sender
+        sender.expire(time.monotonic())
+        while not self._paused and not sender.finished:
+            batch = sender.segments()
+            if not batch:
+                break
+            for segment in batch:   # copied by transport if it buffers
+                self.transport.sendto(segment, self.addr)
+            self.calls += len(batch)
+        # ACKs release send buffer, writers may go on
+        if self.writable is not None and not self.writable.done():
+            self.writable.set_result(None)
+        if sender.finished:
+            self.transport.close()
+            return
+        # wait until the next timer is due, on the clock of loop
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        deadline = sender.timers.deadline
+        if deadline < float('inf'):
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_at(loop.time() + deadline - time.monotonic(),
+                                       self.pump)
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    """
+    drive a server by datagrams and timers of an asyncio loop, ACKing
+    datagrams ready in one batch
+    """
+
+    def __init__(self, args, sink=None, report=None):
+        self.args = args
+        self.sink = sink
+        self.report = report
+        self.server = None
+        self.readable: dict = dict()    # {addr: future of a reader waiting}
+        self._received: set = set()     # addrs of datagrams since last tick
+        self._timer = None
+        self._pending = False
+
+    def __repr__(self):
+        return 'ServerProtocol({})'.format(self.server)
+
+    def connection_made(self, transport):
+        self.server = server.Server(self.args, transport.sendto,
+                                    report=self.report, sink=self.sink)
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        self.server.stats['reads'] += 1
+        self.server.recv(data, addr)
+        self._received.add(addr)
+        self.wake()
+
+    def error_received(self, exc: Exception):
+        log.warning('error received, %s', exc)
+
+    def connection_lost(self, exc: Exception):
+        if self._timer is not None:
+            self._timer.cancel()
+        self.server.shutdown()
+        self._wake()
+
+    def _wake(self, addrs=None):
+        """ readers of addrs check their stream again, all if None """
+        for addr in list(self.readable) if addrs is None else addrs:
+            future = self.readable.pop(addr, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    def wake(self):
+        """ tick once datagrams ready are all received, or a reader freed space """
+        if not self._pending:
+            self._pending = True
+            asyncio.get_running_loop().call_soon(self.tick)
+
+    def tick(self):
+        """ send ACKs due or of windows reopened, close idle connections, wake readers """
+        self._pending = False
+        self.server.expire(time.monotonic())
+        self.server.flush()
+        # on data, or once closed by FIN or timeout
+        closed = [a for a in self.readable if a not in self.server.connections]
+        self._wake(self._received.union(closed))
+        self._received.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        deadline = self.server.deadline
+        if deadline < float('inf'):
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_at(loop.time() + deadline - time.monotonic(),
+                                       self.tick)
+
+
+class AsyncTcupSocket:
+    """
+    TcupSocket for asyncio, driven by the loop rather than a thread,
+    awaiting where it would block
+    """
+
+    stall_timeout = TcupSocket.stall_timeout
+
+    def __init__(self, stream, protocol, addr: tuple = None):
+        self._stream = stream   # TCPSenderStream or TCPReceiverStream
+        self._protocol = protocol   # SenderProtocol, or ServerProtocol if receiving
+        self._addr = addr       # of client, if receiving
+        self._closed = False
+
+    def __repr__(self):
+        return 'AsyncTcupSocket({})'.format(self._protocol)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @property
+    def sending(self) -> bool:
+        return isinstance(self._protocol, SenderProtocol)
+
+    @property
+    def finished(self) -> asyncio.Future:
+        """ resolved once FIN is ACKed, or given up on, to verified """
+        return self._protocol.finished
+
+    @property
+    def verified(self) -> bool:
+        """ whether digests of both ends match, None if unknown """
+        return self._protocol.sender.verified if self.sending else None
+
+    @classmethod
+    async def connect(cls, address: tuple, buffer_size: int = 0,
+                      **options) -> 'AsyncTcupSocket':
+        """ open a connection to server at address, options as of open_sender """
+        stream = TCPSenderStream(buffer_size or options.get('window_size', 1 << 20)
+                                 + options.get('mss', 1024))
+        _, protocol = await start(stream, address, **options)
+        return cls(stream, protocol)
+
+    # send #
+
+    async def send(self, data) -> int:
+        """ write as much of data as the send buffer holds, once any fits """
+        check_end(self, sending=True)
+        while True:
+            if self.finished.done():
+                raise ConnectionError('connection given up on')
+            try:
+                n = self._stream.write(data, 0)
+            except TimeoutError:    # full, until ACKs release some
+                self._protocol.writable = asyncio.get_running_loop().create_future()
+                await self._protocol.writable
+                continue
+            self._protocol.wake()
+            return n
+
+    async def sendall(self, data):
+        view = memoryview(data).cast('B')
+        while view:
+            view = view[await self.send(view):]
+
+    async def sendfile(self, f, offset: int = 0, count: int = None,
+                       chunk_size: int = 1 << 16) -> int:
+        """ write count bytes of file from offset, all if None, return bytes sent """
+        sent = 0
+        for chunk in file_chunks(f, offset, count, chunk_size):
+            await self.sendall(chunk)
+            sent += len(chunk)
+        return sent
+
+    # receive #
+
+    async def recv_into(self, buffer, nbytes: int = 0) -> int:
+        """ read up to nbytes into buffer, once any arrive, 0 at end """
+        check_end(self, sending=False)
+        view = memoryview(buffer).cast('B')[:nbytes or None]
+        while True:
+            try:
+                return self._stream.read_into(view, 0)
+            except TimeoutError:    # nothing yet
+                readable = self._protocol.readable
+                if self._addr not in readable:
+                    readable[self._addr] = asyncio.get_running_loop().create_future()
+                await readable[self._addr]
+
+    async def recv(self, bufsize: int) -> bytes:
+        buf = bytearray(bufsize)
+        return bytes(buf[:await self.recv_into(buf)])
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        chunk = await self.recv(1 << 16)
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    # close #
+
+    async def close(self):
+        """
+        if sending, send FIN once data written are all sent, and wait for
+        FIN-ACK as long as data keep being ACKed, raise TimeoutError if
+        they stall, if receiving, stop reading
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self.sending:
+            self._stream.write_eof()
+            self._protocol.wake()
+            sender = self._protocol.sender
+            acked, since = sender.send_base, time.monotonic()
+            while not self.finished.done():
+                await asyncio.wait([self.finished], timeout=1.)
+                now = time.monotonic()
+                if sender.send_base != acked:
+                    acked, since = sender.send_base, now
+                elif now - since >= self.stall_timeout and not self._stream.drained(0):
+                    # nobody reads, or peer is gone, give up on the transport
+                    self._protocol.transport.close()
+                    raise TimeoutError('nothing ACKed for {} s'.format(self.stall_timeout))
+
+
+async def start(sbuf, address: tuple, **options) -> tuple:
+    """
+    start sending sbuf to server at address on the running loop,
+    options as of open_sender, return transport and SenderProtocol
+    """
+    sock, sender = open_sender(sbuf, address, **options)
+    loop = asyncio.get_running_loop()
+    return await loop.create_datagram_endpoint(
+            lambda: SenderProtocol(sender, address), sock=sock)
+
+
+async def transfer(address: tuple, f, **options) -> bool:
+    """
+    send a file to server at address, mapped into memory or read ahead
+    if unseekable, by a thread as reads would block the loop,
+    return whether digests of both ends match
+    """
+    try:
+        sbuf = TCPSenderBuffer(f)
+    except (ValueError, OSError):
+        sbuf = TCPSenderStream(options.get('window_size', 1 << 20)
+                               + options.get('mss', 1024))
+    _, protocol = await start(sbuf, address, **options)
+    if isinstance(sbuf, TCPSenderStream):
+        loop = asyncio.get_running_loop()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(protocol.wake)
+            except RuntimeError:
+                pass    # loop is closed, transfer given up on
+
+        threading.Thread(target=sbuf.read_from, args=(f, wake),
+                         name='tcup-reader', daemon=True).start()
+    try:
+        return await protocol.finished
+    finally:
+        sbuf.close()
+
+
+class AsyncTcupListener:
+    """
+    TcupListener for asyncio, serving on the running loop, accepting
+    AsyncTcupSockets
+    """
+
+    def __init__(self, transport, protocol: ServerProtocol, accepted: asyncio.Queue):
+        self._transport = transport
+        self._protocol = protocol
+        self._accepted = accepted   # of (stream, addr)
+        host, port = transport.get_extra_info('sockname')[:2]
+        self.address = (host, port)
+
+    def __repr__(self):
+        return 'AsyncTcupListener({})'.format(self.address)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @property
+    def stats(self) -> dict:
+        return self._protocol.server.stats
+
+    @classmethod
+    async def listen(cls, address: tuple, window_size: int = 65535,
+                     ibuffer_size: int = 65535, ack_delay: float = .04,
+                     timeout: float = 60., rcvbuf: int = 0) -> 'AsyncTcupListener':
+        """
+        bind server port at address, serving connections as they come,
+        datagrams one by one, as transports do not coalesce them by GRO
+        """
+        sock, args = bind_listener(address, window_size, ibuffer_size,
+                                   ack_delay, timeout, rcvbuf, gro=False)
+        streams: dict = dict()  # {addr: TCPReceiverStream}, not yet accepted
+        accepted: asyncio.Queue = asyncio.Queue()
+
+        def sink(addr: tuple, start: int) -> TCPReceiverStream:
+            # readers freeing space tick the protocol, to update the window
+            stream = streams[addr] = TCPReceiverStream(window_size, start,
+                                                       wake=lambda: protocol.wake())
+            return stream
+
+        def report(event: str, addr: tuple):
+            if event == 'open':
+                accepted.put_nowait((streams.pop(addr), addr))
+
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+                lambda: ServerProtocol(args, sink, report), sock=sock)
+        return cls(transport, protocol, accepted)
+
+    async def accept(self) -> tuple:
+        """ wait for a connection, return (AsyncTcupSocket, address of client) """
+        stream, addr = await self._accepted.get()
+        return AsyncTcupSocket(stream, self._protocol, addr), addr
+
+    async def close(self):
+        """ stop serving, readers of connections left get what has arrived """
+        self._transport.close()
+        await asyncio.sleep(0)  # connection_lost is called soon
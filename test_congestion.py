@@ -0,0 +1,85 @@
+from congestion import CongestionControl, Reno, Cubic, Vegas, Pacer, controls
+
+
+def grow(cc, n: int = 20, rtt: float = .1):
+    for _ in range(n):
+        cc.on_ack(1000, rtt)
+
+
+def test_none():
+    cc = controls['none'](mss=1000)
+    grow(cc)
+    cc.on_loss(flight=20000)
+    cc.on_timeout(flight=20000)
+    assert cc.cwnd == cc.ssthresh == float('inf')
+
+
+def test_reno():
+    cc = Reno(mss=1000)
+    assert cc.cwnd == 4000
+    grow(cc)                    # slow start, a segment per segment ACKed
+    assert (cc.cwnd, cc.ssthresh) == (24000, float('inf'))
+    cc.on_loss(flight=20000)    # halved
+    assert cc.cwnd == cc.ssthresh == 10000
+    grow(cc, n=10)              # about a segment per window
+    assert 10900 < cc.cwnd < 11000
+    cc.on_timeout(flight=20000)
+    assert (cc.cwnd, cc.ssthresh) == (1000, 10000)
+    cc.on_loss(flight=1000)     # never below 2 segments
+    assert cc.cwnd == cc.ssthresh == 2000
+
+
+def test_cubic():
+    cc = Cubic(mss=1000)
+    grow(cc)
+    assert cc.cwnd == 24000
+    cc.on_loss(flight=20000)    # by beta, not half
+    assert cc.cwnd == cc.ssthresh == 16800 and cc.w_max == 24
+    grow(cc)                    # back towards w_max, at least as Reno
+    assert 16800 < cc.cwnd <= 24000 and cc.epoch is not None
+    cwnd = cc.cwnd
+    cc.on_timeout(flight=20000)     # fast convergence, below w_max before
+    assert cc.cwnd == 1000 and cc.ssthresh == cwnd * cc.beta
+    assert cc.w_max == cwnd / 1000 * (1 + cc.beta) / 2 and cc.epoch is None
+
+
+def test_vegas():
+    cc = Vegas(mss=1000)
+    grow(cc)                    # no queue, slow start
+    assert cc.cwnd == 24000 and cc.base_rtt == .1
+    grow(cc, n=1, rtt=.2)       # RTT doubled, queue built, slow start ends
+    assert cc.ssthresh == cc.cwnd == 24000
+    cwnd = cc.cwnd
+    grow(cc, n=4, rtt=.2)       # 12 segments queued, one less per RTT
+    assert cc.cwnd < cwnd
+    cwnd = cc.cwnd
+    grow(cc, n=4, rtt=.1)       # queue drained, one more per RTT
+    assert cc.cwnd > cwnd
+    cc.on_loss(flight=20000)
+    assert cc.cwnd == 10000
+    grow(cc, n=4, rtt=None)     # no RTT sample, as Reno
+    assert 10300 < cc.cwnd < 10400
+
+
+def test_pacer():
+    pacer = Pacer()
+    assert pacer.take(1000, now=1.) == 0.   # not paced until told a rate
+    pacer.pace(cwnd=10000, srtt=.1)
+    assert pacer.rate == 125000
+    # burst of 2 segments, then one every size / rate
+    assert [pacer.take(1000, now=1.) for _ in range(3)] == [0., 0., .008]
+    pacer.pace(cwnd=10000, srtt=.1, slow_start=True)
+    assert pacer.rate == 200000
+    assert abs(pacer.take(1000, now=1.004) - .001) < 1e-9
+    assert round(pacer.tokens) == 800
+    # fixed rate, cwnd ignored
+    pacer = Pacer(rate=1000000)
+    pacer.pace(cwnd=10000, srtt=.1)
+    assert pacer.rate == 1000000
+    assert [pacer.take(1000, now=1.) for _ in range(3)] == [0., 0., .001]
+
+
+def test_interface():
+    assert set(controls) == {'none', 'reno', 'cubic', 'vegas'}
+    for control in controls.values():
+        assert issubclass(control, CongestionControl)
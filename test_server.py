@@ -0,0 +1,237 @@
+import os
+import time
+import server
+from client import Sender
+from utils import encode, decode, encode_options, decode_options, encode_sack, \
+                  encode_timestamp, digest, TCPSenderBuffer, TCPSenderStream, DIGEST, \
+                  RESUME_CHUNK, SACK_PERM
+
+
+CLIENT = ('127.0.0.1', 41190)
+
+
+def segment(seq_no: int, payload: bytes = b'', tsval: int = 1, options: list = (),
+            **flags) -> bytes:
+    """ a segment of client, with a timestamp """
+    return bytes(encode(payload, src_port=CLIENT[1], dst_port=41194, seq_no=seq_no,
+                        options=encode_options([*options, encode_timestamp(tsval)]),
+                        **flags))
+
+
+def open_server(path: str, *argv):
+    """ server receiving into path, and the segments it sends """
+    sent = list()
+    args = server.parser.parse_args(['-f', path, '-c', '0', '-D', '0', *argv])
+    return server.Server(args, lambda seg, addr: sent.append(bytes(seg))), sent
+
+
+def transfer(srv, data: bytes, tsval: int = 1):
+    """ SYN, data in one segment, and FIN with digest """
+    h = digest()
+    h.update(data)
+    srv.recv(segment(0, tsval=tsval, SYN=True), CLIENT)
+    srv.recv(segment(0, data, tsval=tsval + 1), CLIENT)
+    srv.recv(segment(len(data), tsval=tsval + 2, FIN=True,
+                     options=[(DIGEST, h.digest())]), CLIENT)
+    srv.flush()
+
+
+def test_stray_segment_after_close(tmp_path):
+    path = str(tmp_path / 'recv.bin')
+    data = os.urandom(1000)
+    srv, sent = open_server(path)
+    transfer(srv, data)
+    assert not srv.connections and srv.stats['opened'] == 1
+    # data re-sent late, after FIN-ACK
+    srv.recv(segment(0, data[:500], tsval=2), CLIENT)
+    assert not srv.connections and srv.stats['opened'] == 1
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_fin_resent_after_close(tmp_path):
+    path = str(tmp_path / 'recv.bin')
+    srv, sent = open_server(path)
+    transfer(srv, b'abc')
+    sent.clear()
+    srv.recv(segment(3, tsval=3, FIN=True), CLIENT)
+    srv.flush()
+    headers = [decode(seg)[1] for seg in sent]
+    assert [(h.FIN, h.ack_no, DIGEST in decode_options(h.options)) for h in headers] \
+        == [(True, 3, True)]
+
+
+def test_quiet(tmp_path, capsys):
+    # as embedded by tcup, nothing printed of connections
+    srv, sent = open_server(str(tmp_path / 'recv.bin'), '--no-verbose')
+    transfer(srv, b'abc')
+    assert srv.stats['closed'] == 1 and capsys.readouterr().out == ''
+
+
+def test_segment_without_syn(tmp_path):
+    # as if server restarted while client re-sends
+    path = str(tmp_path / 'recv.bin')
+    srv, sent = open_server(path)
+    srv.recv(segment(1000, b'x' * 100), CLIENT)
+    srv.flush()
+    assert not srv.connections and not os.path.exists(path)
+    # reset, for client to give up rather than re-send
+    assert [(h.RST, h.ack_no) for h in (decode(seg)[1] for seg in sent)] == [(True, 1100)]
+
+
+def test_malformed_datagram(tmp_path):
+    # too short for a header, or for the options it claims, dropped and counted
+    path = str(tmp_path / 'recv.bin')
+    srv, sent = open_server(path)
+    srv.recv(segment(0, tsval=1, SYN=True), CLIENT)
+    syn = segment(0, tsval=1, SYN=True)
+    for datagram in [b'\x01\x02\x03', syn[:19], syn[:12] + b'\xf0' + syn[13:],
+                     syn[:12] + b'\x30' + syn[13:]]:
+        srv.recv(datagram, CLIENT)
+    assert srv.stats['failures'] == 4 and CLIENT in srv.connections
+    transfer(srv, b'abc')
+    with open(path, 'rb') as f:
+        assert f.read() == b'abc'
+
+
+def test_syn_after_close(tmp_path):
+    path = str(tmp_path / 'recv.bin')
+    srv, sent = open_server(path)
+    transfer(srv, b'abc', tsval=10)
+    # SYN re-sent before close is dropped, a client started again is not
+    srv.recv(segment(0, tsval=10, SYN=True), CLIENT)
+    assert not srv.connections
+    srv.recv(segment(0, tsval=20, SYN=True), CLIENT)
+    assert CLIENT in srv.connections
+
+
+def loopback(sender, srv, sent: list, limit: int = None) -> list:
+    """
+    deliver segments of sender to srv and its ACKs back, none lost,
+    until FIN is ACKed or limit bytes are sent, return (seq_no, size) sent
+    """
+    data = list()
+    while not sender.finished and (limit is None or sum(n for _, n in data) < limit):
+        for seg in sender.segments():
+            _, header, payload = decode(seg)
+            if payload:
+                data.append((header.seq_no, len(payload)))
+            srv.recv(bytes(seg), CLIENT)
+        srv.expire(time.monotonic())
+        srv.flush()
+        for seg in sent:
+            sender.recv(memoryview(seg))
+        sent.clear()
+        sender.expire(time.monotonic())
+    return data
+
+
+def test_resume_from_chunk_differing(tmp_path):
+    path = str(tmp_path / 'recv.bin')
+    src = str(tmp_path / 'send.bin')
+    data = bytearray(os.urandom(5 * RESUME_CHUNK + 1000))
+    with open(src, 'wb') as f:
+        f.write(data)
+    # transfer cut short past 3 chunks
+    srv, sent = open_server(path, '--resume')
+    with open(src, 'rb') as f:
+        sender = Sender(TCPSenderBuffer(f), CLIENT[1], 41194, mss=16384,
+                        window_size=1 << 18, resume=True)
+        loopback(sender, srv, sent, limit=3 * RESUME_CHUNK + 5000)
+        sender.sbuf.close()
+    srv.shutdown()
+    # client's data changed in the middle of chunk 1
+    data[RESUME_CHUNK + 1234] ^= 0xff
+    with open(src, 'wb') as f:
+        f.write(data)
+    srv, sent = open_server(path, '--resume')
+    with open(src, 'rb') as f:
+        sender = Sender(TCPSenderBuffer(f), CLIENT[1], 41194, mss=16384,
+                        window_size=1 << 18, resume=True)
+        sender.resume_step = RESUME_CHUNK // 4     # checked over batches
+        resent = loopback(sender, srv, sent)
+        sender.sbuf.close()
+    assert sender.resumed == RESUME_CHUNK and sender.verified
+    assert min(seq_no for seq_no, _ in resent) == RESUME_CHUNK
+    assert sum(n for _, n in resent) == len(data) - RESUME_CHUNK
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_resume_after_server_restart(tmp_path):
+    path = str(tmp_path / 'recv.bin')
+    src = str(tmp_path / 'send.bin')
+    data = os.urandom(3 * RESUME_CHUNK)
+    with open(src, 'wb') as f:
+        f.write(data)
+    srv, sent = open_server(path, '--resume')
+    with open(src, 'rb') as f:
+        sbuf = TCPSenderBuffer(f)
+        sender = Sender(sbuf, CLIENT[1], 41194, mss=16384, window_size=1 << 18,
+                        resume=True)
+        loopback(sender, srv, sent, limit=2 * RESUME_CHUNK)
+        # server restarts, resets data of a connection it does not know
+        srv.shutdown()
+        srv, sent = open_server(path, '--resume')
+        loopback(sender, srv, sent)
+        assert sender.aborted and sender.verified is None
+        # client connects again, resuming
+        sender = Sender(sbuf, CLIENT[1], 41194, mss=16384, window_size=1 << 18,
+                        resume=True)
+        loopback(sender, srv, sent)
+        sbuf.close()
+    assert sender.resumed >= RESUME_CHUNK and sender.verified
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_silent_server():
+    sender = Sender(TCPSenderStream(), CLIENT[1], 41194)
+    assert sender.segments()
+    sender.expire(time.monotonic() + 1.)
+    assert not sender.aborted and sender.segments()
+    sender.expire(time.monotonic() + sender.max_silence + 1.)
+    assert sender.aborted and sender.finished and not sender.segments()
+
+
+def ack(ack_no: int, sack: list = (), **flags) -> bytes:
+    """ an ACK of server, with SACK blocks if any """
+    options = encode_options([encode_sack(list(sack))]) if sack else b''
+    return bytes(encode(b'', src_port=41194, dst_port=CLIENT[1], ack_no=ack_no,
+                        window=65535, ACK=True, options=options, **flags))
+
+
+def test_sack_scoreboard():
+    sbuf = TCPSenderStream()
+    sbuf.write(bytes(20000))
+    sbuf.write_eof()
+    sender = Sender(sbuf, CLIENT[1], 41194, mss=1000, window_size=1 << 16,
+                    timestamps=False)
+    sender.segments()
+    sender.recv(encode(b'', src_port=41194, dst_port=CLIENT[1], window=65535,
+                       ACK=True, SYN=True, options=encode_options([(SACK_PERM, b'')])))
+    sent = lambda: [(decode(seg)[1].seq_no, len(decode(seg)[2]))
+                    for seg in sender.segments()]
+    assert sent() == [(0, 1000), (1000, 1000), (2000, 1000), (3000, 1000)]
+    # beyond send_next, ignored
+    sender.recv(ack(0, [(3000, 5000)]))
+    assert not len(sender.scoreboard) and sorted(sender.inflight) == [0, 1000, 2000, 3000]
+    # a segment SACKed, holes below it re-sent on the second duplicate ACK
+    sender.recv(ack(0, [(2000, 3000)]))
+    assert list(sender.scoreboard) == [(2000, 3000)]
+    assert sorted(sender.inflight) == [0, 1000, 3000]
+    assert list(sender._holes) == [(0, 2000, 'fast')]
+    # not on a segment boundary, merged but the segment is left in flight
+    sender.recv(ack(0, [(1500, 2000)]))
+    assert list(sender.scoreboard) == [(1500, 3000)]
+    assert sorted(sender.inflight) == [0, 1000, 3000]
+    # holes re-sent once, SACKed bytes not
+    assert sent() == [(0, 1000), (1000, 1000)] and not sender._holes
+    sender.recv(ack(0, [(1500, 3000)]))
+    assert sent() == []
+    # cumulative ACK into a SACKed range trims it
+    sender.recv(ack(2500))
+    assert list(sender.scoreboard) == [(2500, 3000)] and sorted(sender.inflight) == [3000]
+    sender.recv(ack(4000))
+    assert not len(sender.scoreboard) and not sender.inflight
+    assert sender.send_base == sender.send_next == 4000
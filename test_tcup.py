@@ -0,0 +1,114 @@
+import asyncio
+import os
+import threading
+import pytest
+import tcup
+
+
+ADDRESS = ('127.0.0.1', 0)  # ephemeral port
+
+
+def read_all(listener, received: list):
+    """ accept a connection, read it until end into received """
+    conn, addr = listener.accept(timeout=10.)
+    received.append(b''.join(conn))
+
+
+def test_round_trip():
+    data = os.urandom(300000)
+    with tcup.TcupListener(ADDRESS) as listener:
+        received: list = list()
+        reader = threading.Thread(target=read_all, args=(listener, received))
+        reader.start()
+        with tcup.connect(listener.address) as sock:
+            sock.sendall(data)
+        reader.join()
+    assert received == [data] and sock.verified
+    assert listener.stats['opened'] == 1
+
+
+def test_sendfile(tmp_path):
+    path = tmp_path / 'send.bin'
+    data = os.urandom(200000)
+    path.write_bytes(data)
+    with tcup.TcupListener(ADDRESS) as listener:
+        received: list = list()
+        reader = threading.Thread(target=read_all, args=(listener, received))
+        reader.start()
+        with tcup.connect(listener.address) as sock, open(path, 'rb') as f:
+            assert sock.sendfile(f, offset=1000, count=150000, chunk_size=4096) == 150000
+        reader.join()
+    assert received == [data[1000:151000]] and sock.verified
+
+
+def test_ends():
+    with tcup.TcupListener(ADDRESS) as listener:
+        with pytest.raises(TimeoutError):
+            listener.accept(timeout=.1)
+        sock = tcup.connect(listener.address)
+        with pytest.raises(OSError):
+            sock.recv(10)
+        sock.sendall(b'abc')
+        conn, _ = listener.accept(timeout=10.)
+        assert not conn.sending and conn.verified is None
+        with pytest.raises(OSError):
+            conn.send(b'abc')
+        sock.close()
+        assert conn.recv(10) == b'abc' and conn.recv(10) == b''
+        with pytest.raises(OSError):
+            sock.send(b'abc')
+
+
+def test_async_round_trip():
+    data = os.urandom(300000)
+
+    async def main():
+        async with await tcup.AsyncTcupListener.listen(ADDRESS) as listener:
+
+            async def read():
+                conn, addr = await listener.accept()
+                return b''.join([chunk async for chunk in conn])
+
+            reader = asyncio.create_task(read())
+            async with await tcup.AsyncTcupSocket.connect(listener.address) as sock:
+                await sock.sendall(data[:100000])
+                await sock.sendall(data[100000:])
+            assert await sock.finished and sock.verified
+            assert await reader == data
+
+    asyncio.run(main())
+
+
+def test_async_transfer(tmp_path):
+    path = tmp_path / 'send.bin'
+    data = os.urandom(200000)
+    path.write_bytes(data)
+
+    async def main():
+        async with await tcup.AsyncTcupListener.listen(ADDRESS) as listener:
+
+            async def read():
+                conn, addr = await listener.accept()
+                received = bytearray()
+                while n := await conn.recv_into(buf := bytearray(4096)):
+                    received += buf[:n]
+                return bytes(received)
+
+            reader = asyncio.create_task(read())
+            with open(path, 'rb') as f:
+                assert await tcup.transfer(listener.address, f)
+            assert await reader == data
+            # a file not mapped, read ahead by a thread
+            reader = asyncio.create_task(read())
+            r, w = os.pipe()
+
+            def write():
+                with open(w, 'wb') as f:
+                    f.write(data)
+
+            threading.Thread(target=write).start()
+            with open(r, 'rb') as f:
+                assert await tcup.transfer(listener.address, f)
+            assert await reader == data
+
+    asyncio.run(main())
@@ -0,0 +1,263 @@
+import os
+import random
+import sys
+import timeit
+from utils import sum16, cksum, cksum_update, pack_dataofst, unpack_dataofst, \
+                  pack_control, unpack_control, encode, decode, encode_options, \
+                  decode_options, encode_sack, decode_sack, encode_wscale, \
+                  decode_wscale, wscale, encode_mss, decode_mss, encode_timestamp, \
+                  decode_timestamp, encode_transfer, decode_transfer, \
+                  encode_resume, decode_resume, digest, digest_chunks, \
+                  digest_groups, gso_count, split_gro, RangeSet, ResumeCheck, \
+                  TCPReceiverBuffer, TCPReceiverStream, TimerWheel, TOICalculator, \
+                  RTTSampler, Metrics, MSS, SACK, SACK_PERM, TIMESTAMP, TRANSFER, \
+                  DIGEST, WSCALE, SOL_UDP, UDP_GRO
+
+
+def sum16_loop(buf: bytes) -> int:
+    """ 1s complement sum of all the 16-bit words, one word at a time """
+    buf = bytes(buf) + bytes(len(buf) % 2)
+    s = 0
+    for i in range(0, len(buf), 2):
+        s += buf[i] << 8 | buf[i+1]
+    while s >> 16:
+        s = (s >> 16) + (s & 0xffff)
+    return s
+
+
+def test_sum16():
+    for size in [*range(40), 1452, 1472, 65507]:
+        buf = os.urandom(size)
+        assert sum16(buf) == sum16_loop(buf)
+        assert sum16(memoryview(bytearray(b'\x00' + buf))[1:]) == sum16_loop(buf)
+    assert sum16(b'\xff' * 6) == 0xffff and sum16(bytes(6)) == 0
+
+
+def test_cksum_update():
+    buf = bytearray(os.urandom(1472))
+    checksum = cksum(buf)
+    old, buf[100:108] = bytes(buf[100:108]), os.urandom(8)
+    assert cksum_update(checksum, old, buf[100:108]) == cksum(buf)
+
+
+def test_sum16_runs_in_c():
+    # as fast as reducing one big integer, within 2x, not a sum in Python
+    for size in [1472, 65507]:
+        buf = memoryview(os.urandom(size))
+        floor = min(timeit.repeat(lambda: int.from_bytes(buf, 'big') % 0xffff,
+                                  number=200, repeat=5))
+        t = min(timeit.repeat(lambda: sum16(buf), number=200, repeat=5))
+        assert t < 2 * floor, (size, t, floor)
+
+
+def test_pending():
+    buf = TCPReceiverBuffer(1 << 16)
+    stream = TCPReceiverStream(1 << 16)
+    for seq_no in [100, 300, 0, 200]:
+        buf.push(seq_no, bytes(100))
+        stream.push(seq_no, bytes(100))
+        assert buf.pending == bool(buf.ranges)
+        assert stream.pending == bool(stream.ranges)
+    assert not stream.pending and stream.recv_base == 400
+    assert buf.pop(0) == bytes(400) and not buf.pending
+
+
+def test_buffer_reassembly():
+    # against a byte map, with overlaps, duplicates and holes at the head
+    random.seed(3)
+    buf = TCPReceiverBuffer(1 << 20)
+    data = os.urandom(1 << 16)
+    recv_base, received = 0, bytearray()
+    for _ in range(5000):
+        seq_no = max(0, recv_base + random.randrange(-100, 3000))
+        size = random.randrange(1, 300)
+        payload = data[seq_no:seq_no+size]
+        if seq_no <= recv_base < seq_no + len(payload):
+            received += payload[recv_base-seq_no:]
+            recv_base = seq_no + len(payload)
+            payload = buf.pop(recv_base)
+            received += payload
+            recv_base += len(payload)
+        elif seq_no > recv_base:
+            buf.push(seq_no, payload)
+        assert buf.size == sum(len(p) for p in buf.payloads)
+        assert all(data[s:s+len(p)] == p for s, p in buf.buffer)
+        assert buf.seq_nos == sorted(buf.seq_nos)
+    assert received == data[:recv_base] and recv_base == len(data)
+    assert buf.pop(recv_base) == b'' and buf._head <= len(buf._seq_nos)
+    # popped from the head one at a time, compacted past half
+    for i in range(1, 201):
+        buf.push(recv_base + i * 200, bytes(100))
+    for i in range(1, 151):
+        assert buf.pop(recv_base + i * 200) == bytes(100)
+    assert len(buf._seq_nos) < 150 and buf.size == 5000
+    assert buf.seq_nos == [recv_base + i * 200 for i in range(151, 201)]
+
+
+def test_codec():
+    assert unpack_dataofst(pack_dataofst(dataofst=5)) == 5
+    assert unpack_control(pack_control(False, False, True, False, False, True)) \
+        == (0, 0, 1, 0, 0, 1)
+    assert cksum(encode(payload=b'', src_port=1, dst_port=2)) == 0
+    # seq_no rewritten in place, checksum updated rather than recomputed
+    segment = bytearray(encode(payload=b'abc', src_port=1, dst_port=2, seq_no=7))
+    checksum = cksum_update(int.from_bytes(segment[16:18], 'big'),
+                            segment[4:8], (9).to_bytes(4, 'big'))
+    segment[4:8] = (9).to_bytes(4, 'big')
+    segment[16:18] = checksum.to_bytes(2, 'big')
+    assert cksum(segment) == 0 and decode(segment)[1].seq_no == 9
+
+
+def test_options():
+    segment = encode(b'abc', src_port=1, dst_port=2, ACK=True,
+                     options=encode_options([encode_sack([(8, 12), (20, 24)])]))
+    _, header, payload = decode(segment)
+    assert (header.dataofst, bytes(payload)) == (10, b'abc')
+    assert decode_sack(decode_options(header.options)[SACK]) == [(8, 12), (20, 24)]
+    options = encode_options([encode_wscale(wscale(1 << 24)), (SACK_PERM, b'')])
+    assert options == b'\x03\x03\t\x04\x02\x00\x00\x00'
+    assert decode_wscale(decode_options(options)[WSCALE]) == 9
+    options = decode_options(encode_options([encode_mss(1452), encode_timestamp(3, 7)]))
+    assert decode_mss(options[MSS]) == 1452
+    assert decode_timestamp(options[TIMESTAMP]) == (3, 7)
+    options = encode_options([encode_transfer(41190, 1 << 40), (DIGEST, digest().digest())])
+    options = decode_options(options)
+    assert decode_transfer(options[TRANSFER]) == (41190, 1 << 40)
+    assert len(options[DIGEST]) == 16
+    assert decode_resume(encode_resume(5000, 2000)[1]) == (5000, 2000)
+    # at most 4 blocks fit in 40 bytes, with nothing else
+    blocks = [(i * 10, i * 10 + 5) for i in range(6)]
+    assert decode_sack(encode_sack(blocks)[1]) == blocks[:4]
+
+
+def test_buffer():
+    buf = TCPReceiverBuffer()
+    for seq_no in [4, 8, 12, 20]:
+        buf.push(seq_no, bytes(4))
+    assert buf.seq_nos == [4, 8, 12, 20]
+    assert len(buf.pop(4)) == 12 and buf.seq_nos == [20]
+    buf.push(16, bytes(6))  # overlaps [20, 24)
+    buf.push(14, bytes(2))
+    assert buf.seq_nos == [14, 16, 20] and buf.size == 10
+    assert len(buf.pop(15)) == 9 and buf.size == 0  # [14, 15) already received
+    # duplicates, and one covering those buffered
+    buf.push(30, bytes(4))
+    buf.push(30, bytes(2))
+    buf.push(28, bytes(10))
+    assert buf.ranges == [(28, 38)] and buf.size == 10
+    # beyond the buffer size
+    buf = TCPReceiverBuffer(buffer_size=8)
+    buf.push(4, bytes(4))
+    buf.push(12, bytes(8))
+    assert buf.seq_nos == [4] and buf.size == 4
+
+
+def test_rangeset():
+    ranges = RangeSet()
+    ranges.add(8, 12)
+    ranges.add(20, 24)
+    ranges.add(12, 16)  # adjacent, merged
+    assert list(ranges) == [(8, 16), (20, 24)] and ranges.end == 24
+    assert ranges.gaps(4, 28) == [(4, 8), (16, 20), (24, 28)]
+    assert ranges.gaps(8, 16) == [] and ranges.gaps(10, 22) == [(16, 20)]
+    assert ranges.find(13) == (8, 16) and ranges.find(16) is None
+    ranges.trim(10)
+    assert list(ranges) == [(10, 16), (20, 24)]
+    assert ranges.advance(10) == 16 and list(ranges) == [(20, 24)]
+    assert ranges.advance(10) == 10 and len(ranges) == 1
+    ranges.add(4, 30)   # covering all
+    ranges.add(5, 5)
+    assert list(ranges) == [(4, 30)]
+    ranges.trim(30)
+    assert not len(ranges) and ranges.end == 0
+
+
+def test_timer_wheel():
+    timers = TimerWheel(tick=.01, slots=8, now=0.)
+    timers.schedule('a', .05)
+    timers.schedule('b', .25)   # a turn later, same slot
+    timers.schedule('c', .03)
+    timers.cancel('c')
+    assert len(timers) == 2 and 'c' not in timers and timers.deadline == .05
+    assert timers.expire(.06) == ['a']
+    assert timers.expire(.2) == [] and timers.deadline == .25
+    assert timers.expire(1.) == ['b'] and len(timers) == 0
+    assert timers.deadline == float('inf')
+
+
+def test_timer_wheel_order():
+    # keys come out by slot, over a turn or more passed at once
+    timers = TimerWheel(tick=.01, slots=8, now=0.)
+    for key, deadline in [('d', .075), ('b', .025), ('a', .005), ('c', .045)]:
+        timers.schedule(key, deadline)
+    timers.schedule('a', .055)  # rescheduled, later
+    assert timers.expire(.05) == ['b', 'c']
+    assert timers.expire(.5) == ['a', 'd']
+    # a deadline passed fires at once, not a turn later
+    timers.schedule('e', .1)
+    assert timers.deadline == .1 and timers.expire(.5) == ['e']
+
+
+def test_toi():
+    toi = TOICalculator()
+    assert (toi.estRTT, toi.devRTT, toi.toi) == (1., 0., 1.)
+    toi.update(.08)     # first sample, RTT and half of it as deviation
+    assert (toi.estRTT, toi.devRTT) == (.08, .04) and abs(toi.toi - .24) < 1e-9
+    toi.update(10.)
+    assert abs(toi.estRTT - 1.32) < 1e-9 and abs(toi.devRTT - 2.2) < 1e-9
+    assert toi.toi == toi.threshold == 10
+
+
+def test_rtt_sampler():
+    rtt = RTTSampler()
+    for ack_no, send_time in [(5, .3), (6, .4), (7, .6), (8, .8), (9, 1.)]:
+        rtt.update(ack_no, send_time)
+    rtt.resent(8)
+    assert rtt.sample(rtt.pop(5, now=1.)) == .7
+    # cumulative ACK forgets segments before it
+    assert rtt.sample(rtt.pop(7, now=1.2)) == .6 and 6 not in rtt
+    # re-sent, no sample (Karn)
+    assert rtt.pop(8, now=1.4) is None and len(rtt) == 1
+    assert abs(rtt.sample(rtt.pop(9, now=1.3)) - .3) < 1e-9 and len(rtt) == 0
+    assert abs(rtt.min - .3) < 1e-9 and rtt.percentile(.5) == .6
+    assert rtt.pop(10, now=2.) is None
+    assert RTTSampler().min == float('inf')
+
+
+def test_metrics(capsys):
+    metrics = Metrics(trace=2)
+    for seconds in [.0004, .003, .003, .1]:
+        metrics.rtt.add(seconds)
+    for seq_no in [1, 2, 3]:
+        if metrics.tracing:
+            metrics.trace('send', seq_no)
+    assert metrics.json()['rtt']['count'] == 4
+    assert metrics.rtt.percentile(.5) == .004096 and metrics.rtt.percentile(.99) == .131072
+    metrics.dump(sys.stdout)
+    assert capsys.readouterr().out.count(' send ') == 2
+
+
+def test_resume_check():
+    data = bytearray(5 * 1000)
+    digests = digest_chunks(lambda seq_no, n: data[seq_no:seq_no+n], 0, len(data), 1000)
+    offered = digest_groups(digests, 2)
+    peek = lambda seq_no, n: data[seq_no:seq_no+n]
+    check = ResumeCheck(peek, 5000, 2000, offered, 1000)
+    assert check.step(1000) is None and check.step(10000) == 5000
+    data[2500] = 1     # in group [2000, 4000)
+    check = ResumeCheck(peek, 5000, 2000, offered, 1000)
+    assert check.step(1000) is None and check.step(10000) == 2000
+    # offered past the data of sender, which has less
+    check = ResumeCheck(lambda seq_no, n: data[seq_no:min(seq_no+n, 1500)],
+                        5000, 2000, offered, 1000)
+    assert check.step(10000) == 0
+
+
+def test_gso():
+    segments = [bytes(1000)] * 3 + [bytes(300), bytes(1000)]
+    assert gso_count(segments) == 4 and gso_count(segments[3:]) == 1
+    buf = bytearray(b'a' * 1000 + b'b' * 1000 + b'c' * 300)
+    ancdata = [(SOL_UDP, UDP_GRO, (1000).to_bytes(4, sys.byteorder))]
+    assert [bytes(d[:1]) + bytes([len(set(d))]) for d in split_gro(memoryview(buf), ancdata)] \
+        == [b'a\x01', b'b\x01', b'c\x01']
+    assert [len(d) for d in split_gro(memoryview(buf), [])] == [2300]
@@ -1,28 +1,53 @@
 import array
+import bisect
+import hashlib
+import itertools
+import json
+import mmap
+import os
 import struct
+import sys
+import threading
+import time
+from collections import deque, namedtuple
 
 
-b0 = (0).to_bytes(1, 'big')  # byte 0
-
-
-def cksum(buf: bytes) -> int:
-    """ 1s complement of the sum of all the 16-bit words """
+def sum16(buf: bytes) -> int:
+    """ 1s complement sum of all the 16-bit words """
+    # the 16-bit words are the digits of one big-endian integer in base 2**16,
+    # and 2**16 == 1 (mod 0xffff), so adding up the words with end-around carry
+    # is the same as reducing that integer mod 0xffff, which runs in C
+    # ... a copy into that integer is 2-4x faster than summing words of a
+    # view in Python, however buf is held, so keep it (see test_utils.py)
+    s = int.from_bytes(buf, 'big')
     # pad to even length
     if len(buf) % 2:
-        buf += b0
-    # pair adjacent octets to form 16-bit integers
-    # and sum these 16-bit integers
-    s = 0
-    for i in range(0, len(buf), 2):
-        s += (ord(buf[i:i+1]) << 8) + ord(buf[i+1:i+2])
-    # carry
+        s <<= 8
+    r = s % 0xffff
+    # a non-zero sum folds to 0xffff, never to 0
+    return 0xffff if s and not r else r
+
+
+def fold16(s: int) -> int:
+    """ fold carries of a sum of 16-bit words back into 16 bits """
     s = (s >> 16) + (s & 0xffff)
     s += s >> 16
-    # complement
-    s = ~s
     return s & 0xffff
 
 
+def cksum(buf: bytes, s: int = 0) -> int:
+    """ 1s complement of the sum of all the 16-bit words """
+    # s: partial sum of preceding words, e.g. a header (must be even length)
+    return ~fold16(s + sum16(buf)) & 0xffff
+
+
+def cksum_update(checksum: int, old: bytes, new: bytes) -> int:
+    """ update checksum after replacing words old with new (RFC 1624) """
+    # HC' = ~(~HC + ~m + m')
+    s = (~checksum & 0xffff) + (~sum16(old) & 0xffff) + sum16(new)
+    return ~fold16(s) & 0xffff
+
+
 def pack_dataofst(dataofst: int = 5) -> int:
     """ right pad with 0's from reserved """
     return dataofst << 4
@@ -62,6 +87,11 @@ def unpack_control(control_i: int) -> tuple:
 # window  : int
 # checksum: int
 # urgt_ptr: int
+# options : bytes
+Header = namedtuple('Header', ['src_port', 'dst_port', 'seq_no', 'ack_no',
+                               'dataofst', 'URG', 'ACK', 'PSH', 'RST', 'SYN',
+                               'FIN', 'window', 'checksum', 'urgt_ptr',
+                               'options'], defaults=[b''])
 
 # TCP header default
 dataofst = 5  # 20 bytes = 5 * 32-bit words
@@ -73,73 +103,236 @@ SYN      = False
 checksum = 0
 urgt_ptr = 0
 
+# byte layout
+# ! network (big-endian)
+# I 4 bytes
+# H 2 bytes
+# B 1 bytes
+HEADER = struct.Struct('!HHIIBBHHH')
+CHECKSUM = struct.Struct('!H')
+CHECKSUM_OFFSET = 16
+MAX_HEADER_SIZE = 60  # dataofst 15 * 32-bit words
+
+
+# TCP option kinds
+EOL  = 0  # end of option list
+NOP  = 1  # no operation, for padding
+MSS  = 2  # maximum segment size, payload bytes a peer can take, in SYN only
+WSCALE = 3  # window scale, shift count of window field, in SYN only
+SACK_PERM = 4  # SACK permitted, in SYN only
+SACK = 5  # selective acknowledgment, blocks of [left, right)
+TIMESTAMP = 8  # timestamp of sender, and the one last received echoed
+TRANSFER = 253  # experimental (RFC 4727), id and file size of a striped transfer, in SYN only
+DIGEST = 254  # experimental, digest of data sent or received, in FIN and FIN-ACK
+RESUME = 252  # unassigned, asked by SYN, offset of data kept and size of groups digested in
+              # SYN-ACK, offset resumed at in segments until it is ACKed
+SACK_BLOCK = struct.Struct('!II')
+MAX_SACK_BLOCKS = 4  # 2 + 4 * 8 bytes fit in 40 bytes of options
+MSS_VALUE = struct.Struct('!H')
+TIMESTAMP_VALUE = struct.Struct('!II')
+TRANSFER_VALUE = struct.Struct('!IQ')
+RESUME_VALUE = struct.Struct('!QQ')
+RESUME_OFFSET = struct.Struct('!Q')
+RESUME_CHUNK = 1 << 20  # data below offset is digested chunk by chunk
+RESUME_GROUPS = 128     # digests of groups of chunks in payload of SYN-ACK, 8 bytes each
+DIGEST_SIZE = 16
+MAX_WINDOW = 0xffff
+MAX_WSCALE = 14  # RFC 7323
+
+
+def encode_options(options: list) -> bytes:
+    """ encode (kind, value) pairs, padded to 32-bit words """
+    buf = bytearray()
+    for kind, value in options:
+        buf += bytes((kind, 2 + len(value)))
+        buf += value
+    buf += bytes(-len(buf) % 4)  # EOL padding
+    return bytes(buf)
+
+
+def decode_options(buf: bytes) -> dict:
+    """ decode options into {kind: value}, tolerating truncated ones """
+    options = dict()
+    i = 0
+    while i < len(buf):
+        kind = buf[i]
+        if kind == EOL:
+            break
+        if kind == NOP:
+            i += 1
+            continue
+        if i + 1 >= len(buf) or buf[i+1] < 2:
+            break
+        options[kind] = bytes(buf[i+2:i+buf[i+1]])
+        i += buf[i+1]
+    return options
+
+
+def wscale(window_size: int) -> int:
+    """ smallest shift count for window_size to fit in window field """
+    shift = 0
+    while window_size >> shift > MAX_WINDOW and shift < MAX_WSCALE:
+        shift += 1
+    return shift
+
+
+def encode_wscale(shift: int) -> tuple:
+    """ window scale option """
+    return WSCALE, bytes((shift,))
+
+
+def decode_wscale(value: bytes) -> int:
+    """ shift count from option value, capped per RFC 7323 """
+    return min(value[0], MAX_WSCALE) if value else 0
+
+
+def encode_mss(mss: int) -> tuple:
+    """ maximum segment size option """
+    return MSS, MSS_VALUE.pack(min(mss, 0xffff))
+
+
+def decode_mss(value: bytes) -> int:
+    """ maximum segment size from option value """
+    return MSS_VALUE.unpack(value)[0]
+
+
+def timestamp() -> int:
+    """ value of timestamp clock, in microseconds, wrapping at 32 bits """
+    return int(time.monotonic() * 1e6) & 0xffffffff
+
+
+def encode_timestamp(tsval: int, tsecr: int = 0) -> tuple:
+    """ timestamp option, of now and the one to echo """
+    return TIMESTAMP, TIMESTAMP_VALUE.pack(tsval, tsecr)
+
+
+def decode_timestamp(value: bytes) -> tuple:
+    """ (tsval, tsecr) from option value """
+    return TIMESTAMP_VALUE.unpack(value)
+
+
+def encode_transfer(transfer: int, size: int) -> tuple:
+    """ transfer option, of id shared by its stripes and size of file """
+    return TRANSFER, TRANSFER_VALUE.pack(transfer, size)
+
+
+def decode_transfer(value: bytes) -> tuple:
+    """ (transfer, size) from option value """
+    return TRANSFER_VALUE.unpack(value)
 
-def encode_header(header_s: dict) -> bytes:
+
+def encode_resume(offset: int = None, group: int = 0) -> tuple:
+    """
+    resume option, empty to ask for it, of offset of data kept and
+    size of groups digested to offer it, or of offset resumed at
+    """
+    if offset is None:
+        return RESUME, b''
+    if group:
+        return RESUME, RESUME_VALUE.pack(offset, group)
+    return RESUME, RESUME_OFFSET.pack(offset)
+
+
+def decode_resume(value: bytes) -> tuple:
+    """ (offset, group) from option value, (None, 0) if asked for, group 0 if resumed at """
+    if not value:
+        return None, 0
+    if len(value) == RESUME_OFFSET.size:
+        return RESUME_OFFSET.unpack(value)[0], 0
+    return RESUME_VALUE.unpack(value)
+
+
+def digest():
+    """ hash of data, to verify a transfer end to end """
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def digest_chunks(peek, start: int, end: int, chunk_size: int = RESUME_CHUNK) -> list:
+    """ digests of data [start, end) by chunk, the last one maybe shorter """
+    digests = list()
+    for seq_no in range(start, end, chunk_size):
+        h = digest()
+        h.update(peek(seq_no, min(chunk_size, end - seq_no)))
+        digests.append(h.digest())
+    return digests
+
+
+def digest_groups(digests: list, k: int) -> bytes:
+    """ 8-byte digests of digests of chunks, k by k, concatenated """
+    return b''.join(hashlib.blake2b(b''.join(digests[i:i+k]), digest_size=8).digest()
+                    for i in range(0, len(digests), k))
+
+
+def encode_sack(blocks: list, n: int = MAX_SACK_BLOCKS) -> tuple:
+    """ SACK option from the first n blocks [(left, right)] """
+    blocks = blocks[:n]
+    value = bytearray(SACK_BLOCK.size * len(blocks))
+    for i, block in enumerate(blocks):
+        SACK_BLOCK.pack_into(value, i * SACK_BLOCK.size, *block)
+    return SACK, bytes(value)
+
+
+def decode_sack(value: bytes) -> list:
+    """ SACK blocks [(left, right)] from option value """
+    return [block for block in SACK_BLOCK.iter_unpack(
+            value[:len(value) - len(value) % SACK_BLOCK.size])]
+
+
+def encode_header(header: Header) -> bytes:
     """ encode a TCP header """
-    # byte layout
-    fmt = '!HHIIBBHHH'
-    # ! network (big-endian)
-    # I 4 bytes
-    # H 2 bytes
-    # B 1 bytes
     # group / pad -> int
-    dataofst_i = pack_dataofst(header_s['dataofst'])
-    control_i = pack_control(header_s['URG'], header_s['ACK'], header_s['PSH'],
-                             header_s['RST'], header_s['SYN'], header_s['FIN'])
+    dataofst_i = pack_dataofst(header.dataofst)
+    control_i = pack_control(header.URG, header.ACK, header.PSH,
+                             header.RST, header.SYN, header.FIN)
     # int -> byte
-    header = struct.pack(
-                fmt,
-                header_s['src_port'],  # source port
-                header_s['dst_port'],  # destination port
-                header_s['seq_no'],    # sequence number
-                header_s['ack_no'],    # acknowledgment number
-                dataofst_i,  # data offset (right padded with 0's from reserved)
-                control_i,   # control bits (left padded with 0's from reserved)
-                header_s['window'],    # window
-                header_s['checksum'],  # checksum
-                header_s['urgt_ptr']   # urgent pointer
-            )
-    return header
+    return HEADER.pack(
+        header.src_port,  # source port
+        header.dst_port,  # destination port
+        header.seq_no,    # sequence number
+        header.ack_no,    # acknowledgment number
+        dataofst_i,       # data offset (right padded with 0's from reserved)
+        control_i,        # control bits (left padded with 0's from reserved)
+        header.window,    # window
+        header.checksum,  # checksum
+        header.urgt_ptr   # urgent pointer
+    ) + bytes(header.options)
 
 
 def encode(payload: bytes, src_port: int, dst_port: int,
            seq_no: int = 0, ack_no: int = 0, window: int = 0,
-           ACK: bool = False, FIN: bool = False,
-           verbose=False) -> bytes:
-    """ encode a TCP segment (header + payload) """
+           ACK: bool = False, SYN: bool = False, FIN: bool = False,
+           RST: bool = False, options: bytes = b'',
+           buf: bytearray = None, offset: int = 0,
+           verbose=False) -> memoryview:
+    """
+    encode a TCP segment (header + options + payload)
+    into buf[offset:] if a reusable buffer is given, else into a new one
+    options are encoded by encode_options, so padded to 32-bit words
+    """
+    header_size = HEADER.size + len(options)
+    assert header_size <= MAX_HEADER_SIZE and not header_size % 4
+    size = header_size + len(payload)
+    if buf is None:
+        buf = bytearray(size)
     # header with checksum 0
-    header_s = {
-        'src_port': src_port,
-        'dst_port': dst_port,
-        'seq_no'  : seq_no,
-        'ack_no'  : ack_no,
-        'dataofst': dataofst,
-        'URG'     : URG,
-        'ACK'     : ACK,
-        'PSH'     : PSH,
-        'RST'     : RST,
-        'SYN'     : SYN,
-        'FIN'     : FIN,
-        'window'  : window,
-        'checksum': 0,
-        'urgt_ptr': urgt_ptr,
-    }
-    header = encode_header(header_s)
-    checksum = cksum(header + payload)
-    # header with computed checksum
-    header_s['checksum'] = checksum
-    header = encode_header(header_s)
-    return header + payload
-
-
-def decode_header(buf: bytes) -> dict:
+    HEADER.pack_into(
+        buf, offset,
+        src_port, dst_port, seq_no, ack_no,
+        pack_dataofst(header_size // 4),
+        pack_control(URG, ACK, PSH, RST, SYN, FIN),
+        window, 0, urgt_ptr
+    )
+    buf[offset+HEADER.size:offset+header_size] = options
+    buf[offset+header_size:offset+size] = payload
+    segment = memoryview(buf)[offset:offset+size]
+    # patch the checksum field in place
+    checksum = cksum(payload, sum16(segment[:header_size]))
+    CHECKSUM.pack_into(buf, offset + CHECKSUM_OFFSET, checksum)
+    return segment
+
+
+def decode_header(buf: bytes) -> Header:
     """ decode a TCP header """
-    # byte layout
-    fmt = '!HHIIBBHHH'
-    # ! network (big-endian)
-    # I 4 bytes
-    # H 2 bytes
-    # B 1 bytes
     # byte -> int
     (src_port,
      dst_port,
@@ -149,59 +342,385 @@ def decode_header(buf: bytes) -> dict:
      control_i,
      window,
      checksum,
-     urgt_ptr) = struct.unpack(fmt, buf)
+     urgt_ptr) = HEADER.unpack_from(buf)
     # unpack
     dataofst = unpack_dataofst(dataofst_i)
-    URG, ACK, PSH, RST, SYN, FIN = unpack_control(control_i)
-    # structure
-    header_s = {
-        'src_port': src_port,
-        'dst_port': dst_port,
-        'seq_no'  : seq_no,
-        'ack_no'  : ack_no,
-        'dataofst': dataofst,
-        'URG'     : URG,
-        'ACK'     : ACK,
-        'PSH'     : PSH,
-        'RST'     : RST,
-        'SYN'     : SYN,
-        'FIN'     : FIN,
-        'window'  : window,
-        'checksum': checksum,
-        'urgt_ptr': urgt_ptr,
-    }
-    return header_s
+    options = bytes(buf[HEADER.size:dataofst*4]) if dataofst > 5 else b''
+    return Header(src_port, dst_port, seq_no, ack_no,
+                  dataofst, *unpack_control(control_i),
+                  window, checksum, urgt_ptr, options)
+
+
+def malformed(segment: bytes) -> bool:
+    """ whether segment is too short for a header, or for the options it claims """
+    return len(segment) < HEADER.size \
+        or not HEADER.size <= unpack_dataofst(segment[12]) * 4 <= len(segment)
 
 
 def decode(segment: bytes, verbose=False) -> tuple:
-    """ decode a TCP segment (header + payload) """
-    header =  segment[:20]
-    payload = segment[20:]
-    header_s = decode_header(header)
-    return cksum(segment), header_s, payload
+    """
+    decode a TCP segment (header + options + payload)
+    options are left encoded in header.options, see decode_options
+    payload is a memoryview into segment, copy it if segment is reused
+    """
+    header = decode_header(segment)
+    payload = memoryview(segment)[header.dataofst*4:]
+    return cksum(segment), header, payload
+
+
+# UDP segmentation offload of Linux, see udp(7)
+SOL_UDP = 17
+UDP_SEGMENT = 103  # send equal-sized datagrams as one buffer
+UDP_GRO = 104  # receive datagrams of a flow coalesced into one buffer
+GSO_SIZE = struct.Struct('=H')
+MAX_GSO_SEGMENTS = 64
+MAX_DATAGRAM_SIZE = 65507
+
+
+def gso_count(segments) -> int:
+    """
+    number of segments from the head to send as one GSO buffer, all of
+    the size of the first but the last, which may be shorter
+    """
+    size = len(segments[0])
+    n = 0
+    for segment in itertools.islice(segments, MAX_GSO_SEGMENTS):
+        if len(segment) > size or (n + 1) * size > MAX_DATAGRAM_SIZE:
+            break
+        n += 1
+        if len(segment) < size:
+            break
+    return n
+
+
+def send_gso(sock, segments: list, addr: tuple) -> int:
+    """ send segments in one call, cut by kernel at the size of the first """
+    return sock.sendmsg(segments, [(SOL_UDP, UDP_SEGMENT,
+                                    GSO_SIZE.pack(len(segments[0])))], 0, addr)
+
+
+def drain(wakeup) -> None:
+    """ read wakeup signals pending on a socket, they carry nothing """
+    try:
+        while wakeup.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def split_gro(view: memoryview, ancdata: list) -> list:
+    """ datagrams coalesced into view by GRO, as memoryviews of it """
+    size = len(view)
+    for level, kind, data in ancdata:
+        if level == SOL_UDP and kind == UDP_GRO:
+            size = int.from_bytes(data[:4], sys.byteorder) or size
+    return [view[i:i+size] for i in range(0, len(view), size)]
+
+
+class RangeSet:
+    """
+    data structure for a set of ranges [start, end),
+    kept sorted, with overlapping or adjacent ranges merged
+    """
+
+    def __init__(self):
+        self._starts: list = list()
+        self._ends: list = list()
+
+    def __repr__(self):
+        return 'RangeSet({})'.format(list(self))
+
+    def __iter__(self):
+        return zip(self._starts, self._ends)
+
+    def __len__(self):
+        return len(self._starts)
+
+    @property
+    def end(self) -> int:
+        """ end of the highest range, 0 if none """
+        return self._ends[-1] if self._ends else 0
+
+    def add(self, start: int, end: int):
+        """ merge [start, end) with overlapping or adjacent ranges """
+        if start >= end:
+            return
+        starts, ends = self._starts, self._ends
+        i = bisect.bisect_left(ends, start)
+        j = bisect.bisect_right(starts, end)
+        if i < j:
+            start = min(start, starts[i])
+            end = max(end, ends[j-1])
+        starts[i:j] = [start]
+        ends[i:j] = [end]
+
+    def advance(self, seq_no: int) -> int:
+        """ end of the range [.., seq_no] reaches, popping ranges below """
+        while self._starts and self._starts[0] <= seq_no:
+            seq_no = max(seq_no, self._ends[0])
+            del self._starts[0], self._ends[0]
+        return seq_no
+
+    def trim(self, seq_no: int):
+        """ forget everything below seq_no """
+        i = bisect.bisect_right(self._ends, seq_no)
+        del self._starts[:i], self._ends[:i]
+        if self._starts and self._starts[0] < seq_no:
+            self._starts[0] = seq_no
+
+    def find(self, seq_no: int) -> tuple:
+        """ range containing seq_no, None if none """
+        i = bisect.bisect_right(self._starts, seq_no) - 1
+        if i >= 0 and seq_no < self._ends[i]:
+            return self._starts[i], self._ends[i]
+        return None
+
+    def gaps(self, start: int, end: int) -> list:
+        """ ranges within [start, end) not in the set """
+        gaps = list()
+        i = bisect.bisect_right(self._ends, start)
+        while start < end:
+            if i == len(self._starts) or self._starts[i] >= end:
+                gaps.append((start, end))
+                break
+            if self._starts[i] > start:
+                gaps.append((start, self._starts[i]))
+            start = self._ends[i]
+            i += 1
+        return gaps
+
+    def clear(self):
+        self._starts.clear()
+        self._ends.clear()
+
+
+class TCPSenderBuffer:
+    """
+    data structure for reading outgoing data without copies
+    maps a regular file into memory, segments are slices of the mapping
+    """
+
+    def __init__(self, f, end: int = None):
+        # raise ValueError on empty file, OSError on non-seekable file
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)[:end]    # data after end left out
+
+    def __repr__(self):
+        return 'TCPSenderBuffer(size={})'.format(len(self._view))
+
+    def peek(self, seq_no: int, size: int) -> memoryview:
+        """ data [seq_no, seq_no + size), shorter at end of file """
+        return self._view[seq_no:seq_no+size]
+
+    def eof(self, seq_no: int) -> bool:
+        """ whether no data will ever follow seq_no """
+        return seq_no >= len(self._view)
+
+    def release(self, seq_no: int):
+        """ data before seq_no is ACKed, it will not be peeked again """
+        pass
+
+    def close(self):
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            pass  # segments still referenced, unmapped once they are freed
+
+
+class TCPSenderStream:
+    """
+    data structure for outgoing data written by an application in memory,
+    or read from a pipe by a thread of its own
+    keeps data [released, written) in a ring of fixed capacity, writers
+    block until ACKs release enough of it, a peek never waits for data
+    """
+
+    def __init__(self, buffer_size: int = 65535, start: int = 0,
+                 coalesce: bool = False):
+        self._coalesce = coalesce   # peek data only once they fill it in full
+        self._ring = bytearray(buffer_size)
+        self._view = memoryview(self._ring)
+        self._base = start  # seq_no of oldest data kept
+        self._end = start   # seq_no after newest data written
+        self._eof = False
+        self._cond = threading.Condition()
+        self._closed = False    # once sender is done, or has given up
+
+    def __repr__(self):
+        return 'TCPSenderStream(base={}, end={}, capacity={})'.format(
+                self._base, self._end, len(self._ring))
+
+    def _slice(self, seq_no: int, end: int) -> memoryview:
+        """ contiguous part of data [seq_no, end) in the ring """
+        i = seq_no % len(self._ring)
+        return self._view[i:i+min(end-seq_no, len(self._ring)-i)]
+
+    def peek(self, seq_no: int, size: int) -> memoryview:
+        """
+        data [seq_no, seq_no + size) written so far, shorter at end of
+        stream, or if coalescing, empty until they are written in full
+        """
+        if seq_no < self._base:
+            raise ValueError('Error in TCPSenderStream peek.\n{}'.format(self))
+        if self._coalesce and not self._eof and self._end < seq_no + size:
+            return memoryview(b'')
+        end = min(seq_no + size, self._end)
+        if end <= seq_no:
+            return memoryview(b'')
+        head = self._slice(seq_no, end)
+        if len(head) == end - seq_no:
+            return head
+        # wraps around, copy both parts out
+        return memoryview(bytes(head) + bytes(self._slice(seq_no+len(head), end)))
+
+    def eof(self, seq_no: int) -> bool:
+        """ whether no data will ever follow seq_no """
+        return self._eof and seq_no >= self._end
+
+    @property
+    def free(self) -> int:
+        """ bytes that may be written without waiting """
+        return len(self._ring) - (self._end - self._base)
+
+    def write(self, data: bytes, timeout: float = None) -> int:
+        """
+        copy as much of data as fits, waiting until any of it does,
+        return bytes written, raise TimeoutError if none in time
+        """
+        data = memoryview(data).cast('B')
+        with self._cond:
+            if self._eof:
+                raise ValueError('write after end of stream')
+            if not self._cond.wait_for(lambda: self.free or self._closed, timeout):
+                raise TimeoutError('send buffer full')
+            if self._closed:
+                raise ConnectionError('connection given up on')
+            n = min(len(data), self.free)
+            written = 0
+            while written < n:  # up to wrap around
+                i = self._end % len(self._ring)
+                j = min(len(self._ring) - i, n - written)
+                self._ring[i:i+j] = data[written:written+j]
+                written += j
+                self._end += j
+        return n
+
+    def write_eof(self):
+        """ no more data will be written, once all are sent FIN follows """
+        self._eof = True
+
+    def read_from(self, f, wake=None):
+        """
+        read f into free space of the ring until end of file, waiting on f
+        or for ACKs to free space, but never in a peek, then write eof,
+        call wake after each read, for the sender to peek data read
+        """
+        capacity = len(self._ring)
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.free)
+                i = self._end % capacity
+                n = min(capacity - i, self.free)
+            # no peek reaches free space, read into it outside the lock
+            n = f.readinto1(self._view[i:i+n])
+            if not n:
+                break
+            with self._cond:
+                self._end += n
+            if wake is not None:
+                wake()
+        self.write_eof()
+        if wake is not None:
+            wake()
+
+    def release(self, seq_no: int):
+        """ data before seq_no is ACKed, it will not be peeked again """
+        with self._cond:
+            self._base = max(self._base, min(seq_no, self._end))
+            self._cond.notify_all()
+
+    def drained(self, timeout: float = None) -> bool:
+        """ wait until data written are all ACKed, return whether they are """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._base >= self._end, timeout)
+
+    def close(self):
+        """ wake up writers waiting for space, no more will be freed """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._view.release()
 
 
 class TCPReceiverBuffer:
-    """ data structure for buffering out-of-order packets """
+    """
+    data structure for buffering out-of-order packets
+    payloads are kept disjoint, indexed by a sorted list of seq_nos
+    popped from its head by moving an index rather than shifting the list,
+    which is compacted once most of it is popped, in amortized O(1)
+    """
 
     def __init__(self, buffer_size: int = 65535):
-        self._buffer: list = list()
+        self._seq_nos: list = list()     # sorted, [head:] buffered
+        self._head = 0                   # index of the lowest seq_no buffered
+        self._payloads: dict = dict()    # {seq_no: payload}
+        self._size = 0                   # running byte count
         self._max_size = buffer_size
 
     def __repr__(self):
         return 'TCPReceiverBuffer(seq_nos={})'.format(self.seq_nos)
 
     def push(self, seq_no: int, payload: bytes):
-        if self.size < self.max_size and seq_no not in self.seq_nos:
-            self.buffer = sorted(self.buffer + [(seq_no, payload)])
+        """
+        buffer payload [seq_no, seq_no + len(payload)),
+        trimming bytes already buffered and replacing payloads it covers
+        payload is kept by reference, do not reuse it afterwards
+        """
+        seq_nos, payloads = self._seq_nos, self._payloads
+        end = seq_no + len(payload)
+        i = bisect.bisect_right(seq_nos, seq_no, self._head)
+        # trim head overlapped by previous payload
+        if i > self._head:
+            prev = seq_nos[i-1]
+            prev_end = prev + len(payloads[prev])
+            if prev_end >= end:
+                return  # duplicate
+            if prev_end > seq_no:
+                payload = memoryview(payload)[prev_end-seq_no:]
+                seq_no = prev_end
+        # skip over payloads covered entirely, trim tail overlapped by next
+        j = i
+        covered = 0
+        while j < len(seq_nos) and seq_nos[j] < end:
+            nxt = seq_nos[j]
+            if nxt + len(payloads[nxt]) > end:
+                payload = memoryview(payload)[:nxt-seq_no]
+                break
+            covered += len(payloads[nxt])
+            j += 1
+        size = self._size - covered + len(payload)
+        if not payload or size > self.max_size:
+            return
+        for nxt in seq_nos[i:j]:
+            del payloads[nxt]
+        if i == j == len(seq_nos):  # above all buffered, as most arrive
+            seq_nos.append(seq_no)
+        elif i == j == self._head > 0:  # fills the hole at the head
+            self._head -= 1
+            seq_nos[self._head] = seq_no
+        else:
+            seq_nos[i:j] = [seq_no]
+        payloads[seq_no] = payload
+        self._size = size
 
     @property
     def seq_nos(self) -> list:
-        return [b[0] for b in self.buffer]
+        return self._seq_nos[self._head:]
 
     @property
     def payloads(self) -> list:
-        return [b[1] for b in self.buffer]
+        return [self._payloads[s] for s in self.seq_nos]
 
     @property
     def max_size(self) -> int:
@@ -209,38 +728,75 @@ class TCPReceiverBuffer:
 
     @property
     def size(self) -> int:
-        return sum([len(b[1]) for b in self.buffer])
+        return self._size
 
     @property
     def buffer(self) -> list:
-        return self._buffer
+        return list(zip(self.seq_nos, self.payloads))
 
-    @buffer.setter
-    def buffer(self, value: list):
-        assert isinstance(value, list)
-        self._buffer = value
+    @property
+    def pending(self) -> bool:
+        """ whether any payload is buffered, without building ranges """
+        return self._head < len(self._seq_nos)
+
+    @property
+    def ranges(self) -> list:
+        """ ranges buffered [start, end), adjacent payloads merged """
+        ranges: list = list()
+        for seq_no in self.seq_nos:
+            end = seq_no + len(self._payloads[seq_no])
+            if ranges and ranges[-1][1] == seq_no:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((seq_no, end))
+        return ranges
+
+    def _compact(self):
+        """ drop seq_nos popped, once they are all or most of the list """
+        if self._head == len(self._seq_nos):
+            self._seq_nos.clear()
+            self._head = 0
+        elif self._head >= 64 and 2 * self._head >= len(self._seq_nos):
+            del self._seq_nos[:self._head]
+            self._head = 0
+
+    def _trim(self, seq_no: int):
+        """ discard bytes before seq_no """
+        seq_nos, payloads = self._seq_nos, self._payloads
+        if self._head == len(seq_nos) or seq_nos[self._head] >= seq_no:
+            return
+        while self._head < len(seq_nos) and seq_nos[self._head] < seq_no:
+            head = seq_nos[self._head]
+            payload = payloads.pop(head)
+            self._size -= len(payload)
+            if head + len(payload) > seq_no:  # partially duplicate
+                payload = memoryview(payload)[seq_no-head:]
+                seq_nos[self._head] = seq_no
+                payloads[seq_no] = payload
+                self._size += len(payload)
+            else:
+                self._head += 1
+        self._compact()
 
     def _popable(self, seq_no: int) -> bool:
         ''' check if seq_no matches start of the buffer '''
-        if self.seq_nos and seq_no > self.seq_nos[0]:
-            raise AttributeError('Error in TCPReceiverBuffer _popable.\n{}'
-                                 .format(self))
-        if self.seq_nos and seq_no == self.seq_nos[0]:
-            return True
-        else:
-            return False
+        self._trim(seq_no)
+        return self._head < len(self._seq_nos) and \
+            seq_no == self._seq_nos[self._head]
 
     def _pop(self, seq_no: int) -> bytes:
         """ concatenate continuous payloads [seq_no, ...) """
-        end = 1
-        expect_next = seq_no
-        for i, (seq_no, payload) in enumerate(self.buffer):
-            if expect_next != seq_no:
-                break
-            end = i + 1
-            expect_next = seq_no + len(payload)
-        payload = b''.join(self.payloads[:end])
-        self.buffer = self.buffer[end:]
+        seq_nos, payloads = self._seq_nos, self._payloads
+        parts = list()
+        i = self._head
+        while i < len(seq_nos) and seq_nos[i] == seq_no:
+            parts.append(payloads.pop(seq_no))
+            seq_no += len(parts[-1])
+            i += 1
+        self._head = i
+        self._compact()
+        payload = b''.join(parts)
+        self._size -= len(payload)
         return payload
 
     def pop(self, seq_no: int) -> bytes:
@@ -252,10 +808,506 @@ class TCPReceiverBuffer:
         if not self._popable(seq_no):
             return b''
         else:
-            payload = self._pop(seq_no)
-            if not payload:
-                AttributeError('Error in TCPReceiverBuffer pop.')
-            return payload
+            return self._pop(seq_no)
+
+
+class TCPReceiverSink:
+    """
+    data structure for writing received data to file behind the ACKs
+    payloads are written at their offset as soon as they arrive, in order
+    or not, coalescing adjacent ones into batches; only the ranges received
+    are kept, to find the contiguous prefix [0, recv_base)
+    if file is unseekable, out-of-order payloads wait in TCPReceiverBuffer
+    a stripe of a file starts at its offset, and the file keeps its size
+    """
+
+    def __init__(self, f, buffer_size: int = 65535, batch_size: int = 1 << 20,
+                 fsync: str = 'never', extent_size: int = 1 << 24,
+                 start: int = 0, size: int = 0):
+        assert fsync in ('never', 'flush', 'close')
+        self._file = f
+        self._fd = f.fileno()
+        self._buf = None if f.seekable() else TCPReceiverBuffer(buffer_size)
+        self._max_size = buffer_size    # accept data [recv_base, +max_size)
+        self._batch_size = batch_size
+        self._fsync = fsync
+        self._extent_size = extent_size
+        self._recv_base = start
+        self._ranges = RangeSet()       # out-of-order ranges [start, end)
+        self._batch = bytearray()       # data [batch_seq, +len(batch)),
+        self._batch_seq = start         # not yet written
+        self._allocated = 0             # file preallocated [0, allocated)
+        self._written = 0               # file written [0, written)
+        self._size = size               # file size, if shared by stripes
+        if size and self._buf is None:  # of the whole file, by any stripe
+            os.ftruncate(self._fd, size)
+            self._allocated = size
+            try:
+                os.posix_fallocate(self._fd, 0, size)
+            except (AttributeError, OSError):
+                pass
+
+    def __repr__(self):
+        return 'TCPReceiverSink(recv_base={}, ranges={})'.format(
+                self.recv_base, self.ranges)
+
+    @property
+    def recv_base(self) -> int:
+        return self._recv_base
+
+    @property
+    def pending(self) -> bool:
+        """ whether out-of-order data are received, in O(1) """
+        if self._buf is not None:
+            return self._buf.pending
+        return bool(self._ranges)
+
+    @property
+    def ranges(self) -> list:
+        """ out-of-order ranges received [start, end) """
+        if self._buf is not None:
+            return self._buf.ranges
+        return list(self._ranges)
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @property
+    def size(self) -> int:
+        """ bytes held in memory """
+        if self._buf is not None:
+            return self._buf.size
+        return len(self._batch)
+
+    @property
+    def window(self) -> int:
+        """
+        bytes that may be received beyond recv_base, i.e. free space
+        in the buffer if out-of-order payloads wait there, else the range
+        accepted as batches are written through to file
+        """
+        if self._buf is not None:
+            return max(self._buf.max_size - self._buf.size, 0)
+        return self._max_size
+
+    def push(self, seq_no: int, payload: bytes):
+        """ accept payload [seq_no, seq_no + len(payload)), copied if kept """
+        end = seq_no + len(payload)
+        if end <= self._recv_base or seq_no >= self._recv_base + self.max_size:
+            return  # duplicate or beyond window
+        if seq_no < self._recv_base:  # partially duplicate
+            payload = memoryview(payload)[self._recv_base-seq_no:]
+            seq_no = self._recv_base
+        if self._buf is not None:
+            self._push_stream(seq_no, payload)
+        else:
+            self._push_file(seq_no, payload)
+
+    def _push_stream(self, seq_no: int, payload: bytes):
+        """ write in-order payload and what follows it, buffer the rest """
+        if seq_no > self._recv_base:
+            self._buf.push(seq_no, bytes(payload))
+            return
+        self._file.write(payload)
+        self._recv_base += len(payload)
+        payload = self._buf.pop(self._recv_base)
+        self._file.write(payload)
+        self._recv_base += len(payload)
+
+    def _push_file(self, seq_no: int, payload: bytes):
+        """ batch payload for writing, and merge its range into the others """
+        end = seq_no + len(payload)
+        if seq_no != self._batch_seq + len(self._batch):
+            self.flush(fsync=False)
+            self._batch_seq = seq_no
+        self._batch += payload
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+        # merge [seq_no, end) with the others, advance contiguous prefix
+        self._ranges.add(seq_no, end)
+        self._recv_base = self._ranges.advance(self._recv_base)
+
+    def _preallocate(self, end: int):
+        """ reserve file space in extents ahead of writes """
+        if not self._extent_size or end <= self._allocated:
+            return
+        size = -(-end // self._extent_size) * self._extent_size
+        try:
+            os.posix_fallocate(self._fd, self._allocated,
+                               size - self._allocated)
+            self._allocated = size
+        except (AttributeError, OSError):  # unsupported, don't try again
+            self._extent_size = 0
+
+    def flush(self, fsync: bool = True):
+        """ write batched data at its offset """
+        if self._buf is not None:
+            self._file.flush()
+        elif self._batch:
+            end = self._batch_seq + len(self._batch)
+            self._preallocate(end)
+            view = memoryview(self._batch)
+            offset = self._batch_seq
+            while view:
+                n = os.pwrite(self._fd, view, offset)
+                view = view[n:]
+                offset += n
+            view.release()
+            self._batch.clear()
+            self._written = max(self._written, end)
+        if fsync and self._fsync == 'flush':
+            os.fsync(self._fd)
+
+    def digest(self, start: int, end: int) -> bytes:
+        """ digest of data [start, end) as written, None if unreadable """
+        if self._buf is not None:
+            return None
+        self.flush(fsync=False)
+        h = digest()
+        while start < end:
+            try:
+                chunk = os.pread(self._fd, min(end - start, 1 << 20), start)
+            except OSError:     # opened write only
+                return None
+            if not chunk:
+                break
+            h.update(chunk)
+            start += len(chunk)
+        return h.digest()
+
+    def close(self):
+        """ flush, and trim the file back from its preallocated size """
+        self.flush(fsync=False)
+        if self._buf is None and self._allocated > max(self._written, self._size):
+            os.ftruncate(self._fd, max(self._written, self._size))
+        if self._fsync != 'never':
+            os.fsync(self._fd)
+
+
+class Checkpoint:
+    """
+    sidecar file of a transfer received into a file, to resume it after
+    a crash or timeout: recv_base, out-of-order ranges above it, and digests
+    of data below it by chunk, for the sender to check against its own data,
+    and send again only from where they stop agreeing
+    saved every interval bytes received, and replaced atomically
+    """
+
+    def __init__(self, path: str, interval: int = 1 << 24,
+                 chunk_size: int = RESUME_CHUNK):
+        self.path = path
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.recv_base = 0              # as of the latest save
+        self.ranges: list = list()      # out-of-order ranges [start, end)
+        self.digests: list = list()     # of chunks of [0, recv_base)
+
+    def __repr__(self):
+        return 'Checkpoint(path={}, recv_base={})'.format(
+                self.path, self.recv_base)
+
+    def offer(self, groups: int = RESUME_GROUPS) -> tuple:
+        """
+        (size of groups, digests of groups) of data [0, recv_base), in at
+        most groups groups of whole chunks, for the sender to match
+        """
+        k = max(-(-len(self.digests) // groups), 1)
+        return k * self.chunk_size, digest_groups(self.digests, k)
+
+    def load(self) -> bool:
+        """ read the sidecar file, return whether there is data to resume after """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            if state['chunk_size'] != self.chunk_size:
+                return False
+            self.recv_base = state['recv_base']
+            self.ranges = [tuple(r) for r in state['ranges']]
+            self.digests = [bytes.fromhex(d) for d in state['digests']]
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return self.recv_base > 0
+
+    def truncate(self, seq_no: int):
+        """ forget data received from seq_no on, as the sender sends them again """
+        self.recv_base = min(self.recv_base, seq_no)
+        self.ranges = list()
+        del self.digests[self.recv_base // self.chunk_size:]
+
+    def update(self, sink, force: bool = False):
+        """ digest data received since, and save if interval bytes came in """
+        if not force and sink.recv_base < self.recv_base + self.interval:
+            return
+        # digest the last chunk again from its start, if it was short
+        n = self.recv_base // self.chunk_size
+        digests = self.digests[:n]
+        for seq_no in range(n * self.chunk_size, sink.recv_base, self.chunk_size):
+            h = sink.digest(seq_no, min(seq_no + self.chunk_size, sink.recv_base))
+            if h is None:   # unreadable, nothing to resume from
+                return
+            digests.append(h)
+        self.recv_base = sink.recv_base
+        self.ranges = sink.ranges
+        self.digests = digests
+        self.save()
+
+    def save(self):
+        state = {'recv_base': self.recv_base, 'ranges': self.ranges,
+                 'chunk_size': self.chunk_size,
+                 'digests': [h.hex() for h in self.digests]}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        """ transfer is complete, nothing to resume """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ResumeCheck:
+    """
+    data structure for matching data of the sender below offset against
+    digests of groups of chunks offered by a checkpoint, a step at a time,
+    so a large file is checked without holding up the sender
+    """
+
+    def __init__(self, peek, offset: int, group: int, offered: bytes,
+                 chunk_size: int = RESUME_CHUNK):
+        self._peek = peek
+        self.offset = offset
+        self.group = group
+        self.chunk_size = chunk_size
+        self._offered = offered
+        self._end = len(peek(0, offset))    # shorter if the file is
+        self.checked = 0                # start of the group being checked
+        self._digests: list = list()    # of its chunks so far
+        self.resumed = None             # where data stop agreeing, once found
+
+    def __repr__(self):
+        return 'ResumeCheck(offset={}, checked={}, resumed={})'.format(
+                self.offset, self.checked, self.resumed)
+
+    def step(self, size: int):
+        """
+        digest up to size bytes more, return the offset to resume at,
+        the start of the first group whose digest differs, or offset
+        if none does, None if not found yet
+        """
+        while self.resumed is None and size > 0:
+            i = self.checked // self.group * 8
+            if i >= len(self._offered):     # all groups agree
+                self.resumed = self.offset
+                break
+            seq_no = self.checked + len(self._digests) * self.chunk_size
+            end = min(self.checked + self.group, self._end)
+            if seq_no < end:
+                n = min(self.chunk_size, end - seq_no)
+                h = digest()
+                h.update(self._peek(seq_no, n))
+                self._digests.append(h.digest())
+                size -= n
+            elif digest_groups(self._digests, len(self._digests) or 1) \
+                    != self._offered[i:i+8]:
+                self.resumed = min(self.checked, self.offset)
+            else:
+                self.checked += self.group
+                self._digests = list()
+        return self.resumed
+
+
+class TCPReceiverStream:
+    """
+    data structure for handing received data to a reader in memory
+    in-order data queue up until read, out-of-order ones wait in
+    TCPReceiverBuffer; both count against the window, so a slow reader
+    closes it, and reads block until data arrive or the stream ends
+    """
+
+    def __init__(self, buffer_size: int = 65535, start: int = 0, wake=None):
+        self._buf = TCPReceiverBuffer(buffer_size)
+        self._max_size = buffer_size
+        self._wake = wake               # called once a read reopens the window
+        self._recv_base = start
+        self._ready: deque = deque()    # in-order payloads not yet read
+        self._offset = 0                # bytes of the first one read
+        self._size = 0                  # bytes ready to read
+        self._digest = digest()         # of data [start, recv_base)
+        self._eof = False
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return 'TCPReceiverStream(recv_base={}, ready={}, ranges={})'.format(
+                self.recv_base, self._size, self.ranges)
+
+    @property
+    def recv_base(self) -> int:
+        return self._recv_base
+
+    @property
+    def pending(self) -> bool:
+        """ whether out-of-order data are received, in O(1) """
+        return self._buf.pending
+
+    @property
+    def ranges(self) -> list:
+        """ out-of-order ranges received [start, end) """
+        return self._buf.ranges
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @property
+    def size(self) -> int:
+        """ bytes held in memory """
+        return self._size + self._buf.size
+
+    @property
+    def window(self) -> int:
+        """ bytes that may be received beyond recv_base, free space left """
+        return max(self._max_size - self.size, 0)
+
+    def push(self, seq_no: int, payload: bytes):
+        """ accept payload [seq_no, seq_no + len(payload)), copied if kept """
+        end = seq_no + len(payload)
+        limit = self._recv_base + self._max_size - self._size
+        if end <= self._recv_base or seq_no >= limit:
+            return  # duplicate or beyond window
+        if seq_no < self._recv_base:  # partially duplicate
+            payload = memoryview(payload)[self._recv_base-seq_no:]
+            seq_no = self._recv_base
+        payload = bytes(memoryview(payload)[:limit-seq_no])
+        if seq_no > self._recv_base:
+            self._buf.push(seq_no, payload)
+            return
+        with self._cond:
+            while payload:
+                self._ready.append(payload)
+                self._size += len(payload)
+                self._digest.update(payload)
+                self._recv_base += len(payload)
+                payload = self._buf.pop(self._recv_base)
+            self._cond.notify_all()
+
+    def read_into(self, buffer, timeout: float = None) -> int:
+        """
+        copy data ready into buffer, waiting until there are any,
+        return bytes read, 0 once the stream ends,
+        raise TimeoutError if none in time
+        """
+        view = memoryview(buffer).cast('B')
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._size or self._eof, timeout):
+                raise TimeoutError('nothing received')
+            closed = self.window < self._max_size // 2
+            n = 0
+            while self._ready and n < len(view):
+                head = memoryview(self._ready[0])[self._offset:]
+                k = min(len(head), len(view) - n)
+                view[n:n+k] = head[:k]
+                n += k
+                if k == len(head):
+                    self._ready.popleft()
+                    self._offset = 0
+                else:
+                    self._offset += k
+            self._size -= n
+            reopened = closed and self.window >= self._max_size // 2
+        # past half of the buffer, no sooner, so as not to update the window
+        # by a little at a time (RFC 1122 4.2.3.3)
+        if reopened and self._wake is not None:
+            self._wake()
+        return n
+
+    def flush(self, fsync: bool = True):
+        pass    # nothing to write
+
+    def digest(self, start: int, end: int) -> bytes:
+        """ digest of data [start, end) received, None unless end is recv_base """
+        return self._digest.digest() if end == self._recv_base else None
+
+    def close(self):
+        """ no more data will arrive, readers get the rest, then 0 """
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+
+class TimerWheel:
+    """
+    data structure for many timers, hashed into slots by deadline tick
+    O(1) to schedule, cancel or expire a timer, whatever the number of them
+    {key: deadline} per slot, deadlines beyond a turn stay until their turn
+    """
+
+    def __init__(self, tick: float = .001, slots: int = 1024,
+                 now: float = None):
+        self._tick = tick
+        self._slots = [dict() for _ in range(slots)]
+        self._where: dict = dict()  # {key: slot}
+        now = time.monotonic() if now is None else now
+        self._cursor = int(now / tick)  # tick expired up to, not through
+
+    def __repr__(self):
+        return 'TimerWheel(timers={}, deadline={:.3f})'.format(
+                len(self), self.deadline)
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, deadline: float):
+        """ set timer of key to deadline, replacing any set before """
+        self.cancel(key)
+        # a deadline passed goes to the current slot, not a turn later
+        i = max(int(deadline / self._tick), self._cursor) % len(self._slots)
+        self._slots[i][key] = deadline
+        self._where[key] = i
+
+    def cancel(self, key):
+        """ unset timer of key if any """
+        i = self._where.pop(key, None)
+        if i is not None:
+            del self._slots[i][key]
+
+    def expire(self, now: float) -> list:
+        """ unset timers due by now, return their keys by slot """
+        keys: list = list()
+        end = int(now / self._tick)
+        # every slot at most once, if a turn or more has passed
+        for t in range(max(self._cursor, end - len(self._slots) + 1), end + 1):
+            slot = self._slots[t % len(self._slots)]
+            if not slot:
+                continue
+            due = [k for k, deadline in slot.items() if deadline <= now]
+            for k in due:
+                del slot[k], self._where[k]
+            keys += due
+        self._cursor = end
+        return keys
+
+    @property
+    def deadline(self) -> float:
+        """ earliest deadline, inf if no timer """
+        if not self._where:
+            return float('inf')
+        n = len(self._slots)
+        for t in range(self._cursor, self._cursor + n):
+            slot = self._slots[t % n]
+            if not slot:
+                continue
+            # skip deadlines of later turns
+            deadlines = [d for d in slot.values() if d < (t + 1) * self._tick]
+            if deadlines:
+                return min(deadlines)
+        return min(min(slot.values()) for slot in self._slots if slot)
 
 
 class TOICalculator:
@@ -266,6 +1318,7 @@ class TOICalculator:
         self.estRTT = estRTT
         self.devRTT = devRTT
         self._threshold = threshold
+        self._sampled = False   # initial estimate until first sample
 
     def __repr__(self):
         return ( 'TOICalculator(estRTT={:.3f}, devRTT={:.3f}, toi={:.3f})'
@@ -279,6 +1332,11 @@ class TOICalculator:
         return min(self.estRTT + 4 * self.devRTT, self.threshold)
 
     def update(self, splRTT: float):
+        """ smooth RTT samples, the first one replacing the initial estimate """
+        if not self._sampled:   # first sample replaces the guess (RFC 6298)
+            self.estRTT, self.devRTT = splRTT, splRTT / 2
+            self._sampled = True
+            return
         self.estRTT = .875 * self.estRTT + .125 * splRTT
         self.devRTT = .75  * self.devRTT + .25  * abs(splRTT - self.estRTT)
 
@@ -291,33 +1349,173 @@ class TOICalculator:
 class RTTSampler:
     """
     data structure for sampling RTT
-    {ack_no: send_time}
+    [ack_no, send_time] of segments in flight, in order of ack_no,
+    popped from the left by cumulative ACKs, amortized O(1) per segment
+    a segment re-sent gives no sample (Karn's algorithm)
+    the last window_size samples are kept for min and percentiles
     """
 
-    def __init__(self):
-        self._records = dict()
+    def __init__(self, window_size: int = 64):
+        self._records: deque = deque()  # [ack_no, send_time]
+        self._index: dict = dict()      # {ack_no: record}
+        self._samples: deque = deque(maxlen=window_size)
+
+    def __repr__(self):
+        return 'RTTSampler(records={}, min={:.6f}, median={:.6f})'.format(
+                len(self), self.min, self.percentile(.5))
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, ack_no: int):
+        return ack_no in self._index
+
+    def update(self, ack_no: int, send_time: float):
+        """ segment ending at ack_no is sent, after those before it """
+        record = [ack_no, send_time]
+        self._records.append(record)
+        self._index[ack_no] = record
+
+    def resent(self, ack_no: int):
+        """ segment ending at ack_no is re-sent, ACK of it is ambiguous """
+        record = self._index.get(ack_no)
+        if record is not None:
+            record[1] = None
+
+    def pop(self, ack_no: int, now: float) -> float:
+        """
+        forget segments ACKed by ack_no, and measure RTT of the one
+        ending at ack_no, None if it is not found or is re-sent
+        """
+        record = None
+        while self._records and self._records[0][0] <= ack_no:
+            record = self._records.popleft()
+            del self._index[record[0]]
+        if record is None or record[0] != ack_no or record[1] is None:
+            return None
+        return now - record[1]
+
+    def sample(self, rtt: float) -> float:
+        """ record a valid sample, as measured by pop or timestamps """
+        self._samples.append(rtt)
+        return rtt
 
     @property
-    def records(self):
-        return self._records
+    def min(self) -> float:
+        """ least RTT of the last samples, inf if none """
+        return min(self._samples, default=float('inf'))
+
+    def percentile(self, q: float) -> float:
+        """ q-quantile RTT of the last samples, inf if none """
+        if not self._samples:
+            return float('inf')
+        samples = sorted(self._samples)
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class Histogram:
+    """
+    data structure for counting durations in log2 buckets of microseconds
+    bucket i holds [2**(i-1), 2**i) us, 0 holds less than 1 us, O(1) to add
+    """
+
+    def __init__(self, buckets: int = 32):
+        self.buckets = [0] * buckets
+        self.count = 0
+        self.sum = 0.
 
     def __repr__(self):
-        return 'RTTSampler({})'.format(self.records)
+        return 'Histogram(count={}, median={:.6f}, p99={:.6f})'.format(
+                self.count, self.percentile(.5), self.percentile(.99))
 
-    def __contains__(self, ack_no: int):
-        return ack_no in self.records
+    def add(self, seconds: float):
+        i = min(int(seconds * 1e6).bit_length(), len(self.buckets) - 1)
+        self.buckets[i] += 1
+        self.count += 1
+        self.sum += seconds
 
-    def update(self, record: dict):
-        self.records.update(record)
+    def bound(self, i: int) -> float:
+        """ upper bound of bucket i in seconds """
+        return (1 << i) / 1e6
 
-    def pop(self, ack_no: int) -> tuple:
-        ks = [k for k, _ in self.records.items() if k < ack_no]
-        for k in ks:
-            del self.records[k]
-        skip_ct = len(ks)  # number of packets skipped by cumulative ack
-        return skip_ct, self.records.pop(ack_no)
+    def percentile(self, q: float) -> float:
+        """ upper bound of the bucket holding the q-quantile, inf if none """
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return self.bound(i)
+        return float('inf')
 
 
+class Metrics:
+    """
+    data structure for counters of one connection, updated per segment,
+    and a ring of its latest events if traced, dumped on demand
+    with tracing off, an event costs one attribute check
+    """
+
+    counters = ('segments_sent', 'bytes_sent', 'segments_received',
+                'bytes_received', 'dup_acks', 'checksum_failures', 'timeouts')
+    causes = ('timeout', 'fast', 'rack', 'tlp', 'probe', 'too_big')
+
+    def __init__(self, trace: int = 0):
+        self.counts = dict.fromkeys(self.counters, 0)
+        self.retransmits = dict.fromkeys(self.causes, 0)   # segments by cause
+        self.ooo_high = 0       # most bytes received beyond recv_base
+        self.rtt = Histogram()  # RTT samples
+        self.toi = Histogram()  # timeout intervals, as RTT samples update them
+        self.tracing = trace > 0
+        self._events: deque = deque(maxlen=trace or None)  # (time, event, args)
+
+    def __repr__(self):
+        return 'Metrics({})'.format(', '.join(
+                f'{k}={v}' for k, v in self.counts.items()))
+
+    def trace(self, event: str, *args):
+        """ record an event in the ring, callers check tracing first """
+        self._events.append((time.monotonic(), event, args))
+
+    def dump(self, f=sys.stderr, label: str = ''):
+        """ write events in the ring, oldest first """
+        for t, event, args in self._events:
+            print(f"{t:.6f} {label}{event}", *args, file=f)
+
+    def json(self) -> dict:
+        return {**self.counts, 'retransmits': dict(self.retransmits),
+                'ooo_high': self.ooo_high,
+                'rtt': {'count': self.rtt.count, 'sum': self.rtt.sum,
+                        'buckets': self.rtt.buckets},
+                'toi': {'count': self.toi.count, 'sum': self.toi.sum,
+                        'buckets': self.toi.buckets}}
+
+    def prometheus(self, labels: str = '') -> str:
+        """ Prometheus text exposition, labels as 'key="value",...' """
+        lines = list()
+        sep = ',' if labels else ''
+        for k, v in self.counts.items():
+            lines.append(f'tcup_{k}_total{{{labels}}} {v}')
+        for cause, v in self.retransmits.items():
+            lines.append(f'tcup_retransmits_total{{{labels}{sep}cause="{cause}"}} {v}')
+        lines.append(f'tcup_ooo_high_water_bytes{{{labels}}} {self.ooo_high}')
+        for name, hist in [('rtt', self.rtt), ('toi', self.toi)]:
+            seen = 0
+            for i, n in enumerate(hist.buckets):
+                seen += n
+                lines.append(f'tcup_{name}_seconds_bucket{{{labels}{sep}'
+                             f'le="{hist.bound(i):g}"}} {seen}')
+            lines.append(f'tcup_{name}_seconds_bucket{{{labels}{sep}le="+Inf"}} {hist.count}')
+            lines.append(f'tcup_{name}_seconds_sum{{{labels}}} {hist.sum}')
+            lines.append(f'tcup_{name}_seconds_count{{{labels}}} {hist.count}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, fmt: str, **labels) -> str:
+        """ stats as 'json' or 'prometheus' text, labeled by labels """
+        if fmt == 'json':
+            return json.dumps({**labels, **self.json()})
+        return self.prometheus(','.join(f'{k}="{v}"' for k, v in labels.items()))
+
 
 if __name__ == '__main__':
 
@@ -325,6 +1523,12 @@ if __name__ == '__main__':
     print(unpack_dataofst(pack_dataofst(dataofst=5)))
     print(unpack_control(pack_control(False, False, True, False, False, True)))
     print(cksum(encode(payload=b'', src_port=1, dst_port=2)))
+    segment = bytearray(encode(payload=b'abc', src_port=1, dst_port=2, seq_no=7))
+    checksum = cksum_update(int.from_bytes(segment[16:18], 'big'),
+                            segment[4:8], (9).to_bytes(4, 'big'))
+    segment[4:8] = (9).to_bytes(4, 'big')
+    segment[16:18] = checksum.to_bytes(2, 'big')
+    print(cksum(segment))
 
     buf = TCPReceiverBuffer()
     buf.push(4, bytes(4))
@@ -335,22 +1539,81 @@ if __name__ == '__main__':
     payload = buf.pop(4)
     print(len(payload))
     print(buf)
+    buf.push(16, bytes(6))  # overlaps [20, 24)
+    buf.push(14, bytes(2))
+    print(buf, buf.size)
+    payload = buf.pop(15)   # [14, 15) already received
+    print(len(payload), buf.size)
+
+    segment = encode(b'abc', src_port=1, dst_port=2, ACK=True,
+                     options=encode_options([encode_sack([(8, 12), (20, 24)])]))
+    _, header, payload = decode(segment)
+    print(header.dataofst, bytes(payload),
+          decode_sack(decode_options(header.options)[SACK]))
+    options = encode_options([encode_wscale(wscale(1 << 24)), (SACK_PERM, b'')])
+    print(options, decode_wscale(decode_options(options)[WSCALE]))
+
+    ranges = RangeSet()
+    ranges.add(8, 12)
+    ranges.add(20, 24)
+    ranges.add(12, 16)
+    print(ranges, ranges.gaps(4, 28), ranges.find(13))
+    ranges.trim(10)
+    print(ranges)
+    print(ranges.advance(10), ranges)
+
+    timers = TimerWheel(tick=.01, slots=8, now=0.)
+    timers.schedule('a', .05)
+    timers.schedule('b', .25)   # a turn later, same slot
+    timers.schedule('c', .03)
+    timers.cancel('c')
+    print(timers)
+    print(timers.expire(.06), timers.expire(.2), timers.deadline)
+    print(timers.expire(1.), len(timers))
 
     toi = TOICalculator()
-    toi.update(0.08)
     print(toi)
+    toi.update(0.08)    # first sample, RTT and half of it as deviation
+    print(toi, (toi.estRTT, toi.devRTT) == (.08, .04))
     toi.update(10.)
     print(toi)
 
     rtt = RTTSampler()
-    rtt.update({5: .3})
-    rtt.update({6: .4})
-    rtt.update({7: .6})
-    rtt.update({8: .8})
-    rtt.update({9: 1.})
-    rtt.pop(5)
-    print(rtt)
-    rtt.pop(7)
-    print(6 in rtt)
-    rtt.pop(8)
-    print(rtt)
+    rtt.update(5, .3)
+    rtt.update(6, .4)
+    rtt.update(7, .6)
+    rtt.update(8, .8)
+    rtt.update(9, 1.)
+    rtt.resent(8)
+    print(rtt.sample(rtt.pop(5, now=1.)))
+    print(rtt.sample(rtt.pop(7, now=1.2)), 6 in rtt)
+    print(rtt.pop(8, now=1.4), rtt)
+    print(rtt.sample(rtt.pop(9, now=1.3)), rtt)
+
+    metrics = Metrics(trace=2)
+    for seconds in [.0004, .003, .003, .1]:
+        metrics.rtt.add(seconds)
+    for seq_no in [1, 2, 3]:
+        if metrics.tracing:
+            metrics.trace('send', seq_no)
+    print(metrics.rtt, metrics.json()['rtt']['count'])
+    metrics.dump(sys.stdout)
+
+    options = encode_options([encode_mss(1452), encode_timestamp(timestamp(), 7)])
+    options = decode_options(options)
+    print(decode_mss(options[MSS]), decode_timestamp(options[TIMESTAMP])[1])
+    options = encode_options([encode_transfer(41190, 1 << 40), (DIGEST, digest().digest())])
+    options = decode_options(options)
+    print(decode_transfer(options[TRANSFER]), len(options[DIGEST]))
+    data = bytearray(5 * 1000)
+    digests = digest_chunks(lambda seq_no, n: data[seq_no:seq_no+n], 0, len(data), 1000)
+    offered = digest_groups(digests, 2)
+    data[2500] = 1     # in group [2000, 4000)
+    check = ResumeCheck(lambda seq_no, n: data[seq_no:seq_no+n], 5000, 2000, offered, 1000)
+    print(decode_resume(encode_resume(5000, 2000)[1]), check.step(1000), check.step(10000))
+
+    segments = [bytes(1000)] * 3 + [bytes(300), bytes(1000)]
+    print(gso_count(segments), gso_count(segments[3:]))
+    buf = bytearray(b'a' * 1000 + b'b' * 1000 + b'c' * 300)
+    ancdata = [(SOL_UDP, UDP_GRO, (1000).to_bytes(4, sys.byteorder))]
+    print([len(datagram) for datagram in split_gro(memoryview(buf), ancdata)])